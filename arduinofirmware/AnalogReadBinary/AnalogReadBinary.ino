@@ -0,0 +1,42 @@
+/*
+  AnalogReadBinary
+
+  Reads analog pin 0 as fast as the ADC allows and sends the samples to
+  ds_arduino.py in binary packets instead of one line of text per sample.
+  Set PROTOCOL to binary in the [DS_arduino] section of config.ini.
+
+  Every packet is
+    0xde 0xad 0xbe 0xef     sync word
+    uint16                  sequence number, counts up by one per packet
+    BLOCK_SIZE x uint16     samples, 0 to 1023
+  with all numbers little endian, as the AVR stores them.
+
+  The samples are 10 bit, so their high byte is at most 3 and the sync word
+  never shows up inside a packet. The sequence number lets ds_arduino.py
+  tell how many samples got lost.
+
+  Each sample is written as soon as it is read: two bytes go out much faster
+  than the next analogRead (about 100 us on an Uno) finishes, so writing
+  never stalls the sampling.
+*/
+
+#define BLOCK_SIZE 32          // samples per packet, BINARY_BLOCK_SIZE in ds_arduino.py
+#define BAUD_RATE 1000000      // BINARY_BAUD_RATE in ds_arduino.py
+
+uint8_t delimiter[] = {0xde, 0xad, 0xbe, 0xef};
+uint16_t sequence = 0;
+
+void setup() {
+  Serial.begin(BAUD_RATE);
+}
+
+void loop() {
+  Serial.write(delimiter, sizeof(delimiter));
+  Serial.write((uint8_t *)&sequence, sizeof(sequence));
+  sequence++;
+
+  for (int i = 0; i < BLOCK_SIZE; i++) {
+    uint16_t sensorValue = analogRead(A0);
+    Serial.write((uint8_t *)&sensorValue, sizeof(sensorValue));
+  }
+}
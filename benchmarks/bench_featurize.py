@@ -0,0 +1,26 @@
+"""
+utils.featurize on one frame of every data handler, for every featurization
+the UI offers for that handler.
+"""
+import numpy as np
+import pytest
+
+import utils
+from benchmarks import frames
+
+
+CASES = [(handler, featurization)
+         for handler, settings in frames.HANDLERS.items()
+         for featurization in settings.featurizations]
+
+
+@pytest.mark.parametrize('handler,featurization', CASES,
+                         ids=['{}-{}'.format(h, f.name) for h, f in CASES])
+def bench_featurize(benchmark, rng, handler, featurization):
+    settings = frames.HANDLERS[handler]
+    # cut the channel indices like ml.py does before featurizing
+    frame = settings.frame(rng)[:, :-2].astype(np.float64)
+
+    benchmark.group = 'featurize-{}'.format(handler)
+    benchmark(utils.featurize, frame, featurization_type=featurization,
+              numbins=settings.numbins, sample_rate=settings.sample_rate)
@@ -0,0 +1,69 @@
+"""
+ml.py: training every algorithm in ml.algos, and the latency of predicting a
+single frame with the sklearn model and with its compiled copy.
+"""
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import utils
+from benchmarks import frames
+
+
+FEATURIZATION = utils.Featurization.Variance
+TRAIN_ROUNDS = 3
+
+_trained = {}
+
+
+def train(ml, training_dir, algo_index):
+    """[le, model, featurization, features, compiled model] of one algorithm, trained once."""
+    if algo_index not in _trained:
+        cwd = os.getcwd()
+        os.chdir(str(training_dir))
+        try:
+            _trained[algo_index] = ml.ml_train(algo_index, FEATURIZATION, [None, None, None, {}])
+        finally:
+            os.chdir(cwd)
+    return _trained[algo_index]
+
+
+def clear_feature_cache():
+    """Removes the cached features, so training featurizes every round again."""
+    for filename in glob.glob('features_*.npz'):
+        os.remove(filename)
+
+
+@pytest.mark.parametrize('algo', ['voting', 'mlp', 'svm', 'rf', 'sgd', 'nb'])
+def bench_train(benchmark, ml, training_dir, monkeypatch, algo):
+    monkeypatch.chdir(str(training_dir))
+    benchmark.group = 'train'
+    result = benchmark.pedantic(ml.ml_train, args=(ml.algos.index(algo), FEATURIZATION, [None, None, None, {}]),
+                                setup=clear_feature_cache, rounds=TRAIN_ROUNDS, iterations=1)
+    assert result is not None
+
+
+@pytest.mark.parametrize('engine', ['sklearn', 'compiled'])
+@pytest.mark.parametrize('algo', ['voting', 'mlp', 'svm', 'rf', 'sgd', 'nb'])
+def bench_predict_frame(benchmark, ml, training_dir, rng, algo, engine):
+    le, model, featurization, features, predictor = train(ml, training_dir, ml.algos.index(algo))
+    if engine == 'compiled':
+        if predictor is None:
+            pytest.skip('{} cannot be compiled'.format(algo))
+        model = predictor
+
+    settings = frames.HANDLERS['mobile']
+    frame = settings.frame(rng)
+
+    def predict_frame():
+        # same steps as ml.predict_frame
+        X_test = frame.astype(np.float64)[:, :-2]
+        X_test = utils.featurize(X_test, featurization_type=featurization,
+                                 numbins=settings.numbins, sample_rate=settings.sample_rate)
+        return le.inverse_transform(model.predict(X_test.T))
+
+    benchmark.group = 'predict-{}'.format(algo)
+    prediction = benchmark(predict_frame)
+    assert prediction[0] in le.classes_
@@ -0,0 +1,48 @@
+"""
+Moving frames between processes and to disk: publishing a frame on the frame
+bus and reading it back (what tmpframe.npy used to do), and appending a
+collected round to a label's training data file.
+"""
+import uuid
+
+import numpy as np
+import pytest
+
+import datastore
+import framebus
+from benchmarks import frames
+
+
+@pytest.fixture
+def frame_bus():
+    name = 't4t_bench_{}'.format(uuid.uuid4().hex[:8])
+    writer = framebus.FrameWriter(name)
+    reader = framebus.FrameReader(name)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+@pytest.mark.parametrize('handler', list(frames.HANDLERS))
+def bench_publish_latest(benchmark, frame_bus, rng, handler):
+    writer, reader = frame_bus
+    frame = frames.HANDLERS[handler].frame(rng)
+
+    def publish_latest():
+        writer.publish(frame)
+        return reader.latest()
+
+    benchmark.group = 'framebus'
+    seq, latest = benchmark(publish_latest)
+    assert np.array_equal(latest, frame)
+
+
+@pytest.mark.parametrize('handler', list(frames.HANDLERS))
+def bench_append_round(benchmark, tmp_path, rng, handler):
+    frame = frames.HANDLERS[handler].frame(rng)
+    round_ = np.array([[frame] * 10])
+    filename = str(tmp_path / datastore.file_name(handler))
+    datastore.append(filename, round_)
+
+    benchmark.group = 'datastore'
+    benchmark(datastore.append, filename, round_)
@@ -0,0 +1,47 @@
+"""
+Regression check of the benchmarks, run from the project directory:
+
+    python benchmarks/check.py
+
+Timings differ between machines, so baselines are saved per machine (in a
+folder per platform and Python version in benchmarks/baselines/) and are not
+committed. The first run on a machine saves its baseline. Every later run is
+compared against it and fails if a benchmark's median got more than
+MAX_SLOWDOWN slower. Extra arguments are passed on to pytest, e.g.
+`-k featurize`. Delete the machine's folder to save a new baseline.
+"""
+import glob
+import os
+import sys
+
+import pytest
+from pytest_benchmark.utils import get_machine_id
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_NAME = 'baseline'
+MAX_SLOWDOWN = '25%'
+
+
+def saved_baseline():
+    """Id of the baseline run saved on this machine, None if there is none."""
+    files = sorted(glob.glob(os.path.join(ROOT, 'benchmarks', 'baselines', get_machine_id(),
+                                          '*_{}.json'.format(BASELINE_NAME))))
+    if not files:
+        return None
+    return os.path.basename(files[0]).split('_')[0]
+
+
+def main(args):
+    # the storage path in pytest.ini is relative to the project directory
+    os.chdir(ROOT)
+    baseline = saved_baseline()
+    if baseline is None:
+        print('No baseline for {} yet, saving this run as the baseline.'.format(get_machine_id()))
+        return pytest.main(['benchmarks', '--benchmark-save={}'.format(BASELINE_NAME)] + args)
+    return pytest.main(['benchmarks', '--benchmark-compare={}'.format(baseline),
+                        '--benchmark-compare-fail=median:{}'.format(MAX_SLOWDOWN)] + args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,47 @@
+"""
+Fixtures of the benchmarks. The T4Train modules are top-level scripts, so the
+project directory is put on the path, and ml.py is imported from it so it
+reads the project's config.ini.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import datastore
+import utils
+from benchmarks import frames
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture(scope='session')
+def ml():
+    """ml.py, imported with the project's config.ini."""
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        import ml
+    finally:
+        os.chdir(cwd)
+    return ml
+
+
+@pytest.fixture(scope='session')
+def training_dir(tmp_path_factory):
+    """Directory with mobile training data and its manifest, like ui.py leaves it."""
+    path = tmp_path_factory.mktemp('training')
+    files = []
+    for label, rounds in frames.training_rounds('mobile', np.random.default_rng(0)).items():
+        filename = str(path / datastore.file_name(label))
+        datastore.append(filename, rounds)
+        files.append(filename)
+    datastore.write_manifest(files, str(path / 'training_data.json'))
+    return path
@@ -0,0 +1,68 @@
+"""
+Synthetic frames shaped like the ones each data handler publishes, for the
+benchmarks.
+
+Each handler has a frame generator, the settings its config uses and the
+featurizations the UI offers for it. Frames end with the two columns the
+handlers append to every channel: the channel index, and 1 on the last
+channel (0 on the others).
+"""
+from collections import namedtuple
+
+import numpy as np
+
+import utils
+
+
+Handler = namedtuple('Handler', ['frame', 'sample_rate', 'numbins', 'featurizations'])
+
+
+def _index_columns(channels):
+    columns = np.zeros((channels, 2), dtype=np.int64)
+    columns[:, 0] = np.arange(channels)
+    columns[-1, 1] = 1
+    return columns
+
+
+def teensy_frame(rng, channels=3, samples=1500):
+    """3 channels of 1500 12 bit ADC samples, uint16 like ds_teensy reads them."""
+    data = rng.integers(0, 4096, size=(channels, samples))
+    return np.hstack([data, _index_columns(channels)]).astype(np.uint16)
+
+
+def microphone_frame(rng, channels=2, chunk=3000):
+    """A CHUNK of int16 audio per channel, as ds_microphone.shape_data builds it."""
+    data = rng.integers(-2 ** 15, 2 ** 15, size=(channels, chunk)).astype(np.int16)
+    return np.hstack([data, _index_columns(channels)])
+
+
+def camera_frame(rng, keypoints=21):
+    """x and y of the 21 hand keypoints, shaped (2, 21, 1) like ds_camera publishes them."""
+    points = rng.uniform(0, 720, size=(keypoints, 2))
+    return np.asarray([points]).T
+
+
+def mobile_frame(rng, channels=6, frame_length=60):
+    """FRAME_LENGTH samples of the accelerometer and gyroscope axes."""
+    data = rng.normal(size=(channels, frame_length))
+    return np.hstack([data, _index_columns(channels)])
+
+
+HANDLERS = {
+    'teensy': Handler(teensy_frame, 60, 30, list(utils.Featurization)),
+    'microphone': Handler(microphone_frame, 48000, 300,
+                          [utils.Featurization.Raw, utils.Featurization.FFT]),
+    'camera': Handler(camera_frame, 60, 30, [utils.Featurization.Raw, utils.Featurization.Delta]),
+    'mobile': Handler(mobile_frame, 60, 30, list(utils.Featurization)),
+}
+
+
+def training_rounds(handler, rng, labels=3, rounds=10, instances=5):
+    """{label: (rounds, instances, ...) array} of frames, each label with its own offset."""
+    data = {}
+    for i in range(labels):
+        frames = [HANDLERS[handler].frame(rng) for _ in range(rounds * instances)]
+        frames = np.array(frames, dtype=np.float64).reshape((rounds, instances) + frames[0].shape)
+        frames += i * frames.std()
+        data['label{}'.format(i)] = frames
+    return data
@@ -0,0 +1,461 @@
+"""
+compiled.py
+
+Trained models compiled to plain NumPy arrays for fast inference.
+
+sklearn validates its input and (for forests) dispatches to joblib on every
+predict call, which is most of the time spent predicting a single frame.
+compile_model() copies what a trained model needs to predict into arrays and
+returns a predictor that evaluates it with a few vectorized NumPy operations:
+
+- RandomForestClassifier: the nodes of all trees are flattened into one set
+  of arrays and every tree is walked at once, one level per step.
+- MLPClassifier: the weight matrices and activations.
+- SVC: the support vectors and the one-vs-one dual coefficients, with
+  libsvm's voting, and its Platt scaling when trained with probability=True.
+- SGDClassifier and GaussianNB: their coefficients.
+- VotingClassifier (hard or soft voting) of any of the above.
+
+Predictors return the same labels as the model's predict, and the class
+probabilities of its predict_proba if it has one. They can be saved
+to and loaded from a directory of .npy files plus a JSON description, so an
+exported model only needs NumPy to predict, and large forests can be
+memory-mapped instead of read into memory.
+"""
+import json
+import os
+
+import numpy as np
+
+from sklearn.ensemble import RandomForestClassifier, VotingClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.svm import SVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.naive_bayes import GaussianNB
+
+
+FORMAT_VERSION = 1
+DESCRIPTION_FILE = 'predictor.json'
+
+
+def softmax(scores):
+    """Rows of scores normalized to probabilities."""
+    exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class Predictor:
+    """A compiled model. Subclasses set kind and implement scores()."""
+
+    kind = None
+
+    def __init__(self, arrays, classes):
+        self.arrays = arrays
+        self.classes = np.asarray(classes)
+
+    def scores(self, X):
+        """(samples, classes) array whose argmax is the predicted class."""
+        raise NotImplementedError
+
+    def probabilities(self, scores):
+        """Class probabilities from scores(), or None if the model has none."""
+        return None
+
+    @property
+    def has_probabilities(self):
+        return type(self).probabilities is not Predictor.probabilities
+
+    def _rows(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        return X
+
+    def _scores(self, X):
+        return self.scores(self._rows(X))
+
+    def predict(self, X):
+        return self.classes[np.argmax(self._scores(X), axis=1)]
+
+    def predict_with_probabilities(self, X):
+        """Labels like predict() and their (samples, classes) probabilities,
+        from one evaluation of the model. The probabilities are None if the
+        model has none."""
+        scores = self._scores(X)
+        return self.classes[np.argmax(scores, axis=1)], self.probabilities(scores)
+
+    def parts(self):
+        """Predictors this one is made of, saved alongside it."""
+        return []
+
+
+class ForestPredictor(Predictor):
+    """Majority of the averaged class probabilities of all trees."""
+
+    kind = 'forest'
+
+    @classmethod
+    def compile(cls, model):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+
+        features, thresholds, children, values = [], [], [], []
+        for offset, tree in zip(offsets, trees):
+            nodes = np.arange(tree.node_count) + offset
+            leaf = tree.children_left == -1
+            # leaves point to themselves, so walking max_depth levels ends in a leaf for every tree
+            left = np.where(leaf, nodes, tree.children_left + offset)
+            right = np.where(leaf, nodes, tree.children_right + offset)
+            features.append(np.where(leaf, 0, tree.feature))
+            thresholds.append(np.where(leaf, np.inf, tree.threshold))
+            children.append(np.stack([left, right], axis=1))
+            value = tree.value[:, 0, :]
+            values.append(value / value.sum(axis=1, keepdims=True))
+
+        arrays = {
+            'feature': np.concatenate(features).astype(np.intp),
+            'threshold': np.concatenate(thresholds),
+            'children': np.concatenate(children).astype(np.intp),
+            'value': np.concatenate(values),
+            'roots': offsets[:-1].astype(np.intp),
+            'depth': np.array(max(tree.max_depth for tree in trees)),
+        }
+        return cls(arrays, model.classes_)
+
+    def scores(self, X):
+        a = self.arrays
+        # sklearn's trees compare float32 features to float64 thresholds
+        X = X.astype(np.float32)
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.broadcast_to(a['roots'], (X.shape[0], len(a['roots'])))
+        for _ in range(int(a['depth'])):
+            go_right = X[rows, a['feature'][nodes]] > a['threshold'][nodes]
+            nodes = a['children'][nodes, go_right.astype(np.intp)]
+        return a['value'][nodes].mean(axis=1)
+
+    def probabilities(self, scores):
+        return scores
+
+
+class MLPPredictor(Predictor):
+    """Forward pass of a multi-layer perceptron."""
+
+    kind = 'mlp'
+    ACTIVATIONS = {
+        'identity': lambda x: x,
+        'relu': lambda x: np.maximum(x, 0),
+        'tanh': np.tanh,
+        'logistic': lambda x: 1 / (1 + np.exp(-x)),
+    }
+
+    @classmethod
+    def compile(cls, model):
+        arrays = {'layers': np.array(len(model.coefs_)),
+                  'activation': np.array(model.activation)}
+        for i, (coef, intercept) in enumerate(zip(model.coefs_, model.intercepts_)):
+            arrays['coef{}'.format(i)] = coef
+            arrays['intercept{}'.format(i)] = intercept
+        return cls(arrays, model.classes_)
+
+    def scores(self, X):
+        a = self.arrays
+        activation = self.ACTIVATIONS[str(a['activation'])]
+        layers = int(a['layers'])
+        for i in range(layers):
+            X = X @ a['coef{}'.format(i)] + a['intercept{}'.format(i)]
+            if i < layers - 1:
+                X = activation(X)
+        # the output activation (softmax or logistic) keeps the order, a
+        # single output is the second class when positive
+        if X.shape[1] == 1:
+            return np.concatenate([np.zeros_like(X), X], axis=1)
+        return X
+
+    def probabilities(self, scores):
+        # softmax, and the logistic output of two classes as scored above
+        return softmax(scores)
+
+
+class SVCPredictor(Predictor):
+    """One-vs-one votes of a support vector classifier, as libsvm counts them."""
+
+    kind = 'svc'
+
+    @classmethod
+    def compile(cls, model):
+        if model.kernel not in ('linear', 'poly', 'rbf', 'sigmoid'):
+            return None
+        dual_coef = model.dual_coef_
+        intercept = model.intercept_
+        if len(model.classes_) == 2:
+            # sklearn flips the signs of a binary SVC, libsvm's are needed for the votes
+            dual_coef = -dual_coef
+            intercept = -intercept
+
+        # one column of coefficients per pair of classes i < j, in libsvm's order
+        n_classes = len(model.classes_)
+        starts = np.concatenate([[0], np.cumsum(model.n_support_)])
+        pairs = [(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)]
+        pair_coef = np.zeros((len(model.support_vectors_), len(pairs)))
+        winners = np.zeros((len(pairs), n_classes))
+        losers = np.zeros((len(pairs), n_classes))
+        for pair, (i, j) in enumerate(pairs):
+            sv_i = slice(starts[i], starts[i + 1])
+            sv_j = slice(starts[j], starts[j + 1])
+            pair_coef[sv_i, pair] = dual_coef[j - 1, sv_i]
+            pair_coef[sv_j, pair] = dual_coef[i, sv_j]
+            winners[pair, i] = 1
+            losers[pair, j] = 1
+
+        arrays = {
+            'support_vectors': model.support_vectors_,
+            'pair_coef': pair_coef,
+            'intercept': intercept,
+            'winners': winners,
+            'losers': losers,
+            'kernel': np.array(model.kernel),
+            'gamma': np.array(float(model._gamma)),
+            'coef0': np.array(float(model.coef0)),
+            'degree': np.array(int(model.degree)),
+        }
+        if model.probability:
+            # Platt scaling of each pair's decision, also in libsvm's order
+            arrays['prob_a'] = model.probA_
+            arrays['prob_b'] = model.probB_
+        return cls(arrays, model.classes_)
+
+    def kernel(self, X):
+        a = self.arrays
+        sv = a['support_vectors']
+        kernel = str(a['kernel'])
+        gamma, coef0 = float(a['gamma']), float(a['coef0'])
+        if kernel == 'rbf':
+            distances = (X ** 2).sum(axis=1)[:, None] - 2 * X @ sv.T + (sv ** 2).sum(axis=1)[None, :]
+            return np.exp(-gamma * np.maximum(distances, 0))
+        K = X @ sv.T
+        if kernel == 'poly':
+            return (gamma * K + coef0) ** int(a['degree'])
+        if kernel == 'sigmoid':
+            return np.tanh(gamma * K + coef0)
+        return K
+
+    def decision(self, X):
+        a = self.arrays
+        return self.kernel(X) @ a['pair_coef'] + a['intercept']
+
+    def votes(self, decision):
+        a = self.arrays
+        # a positive decision is a vote for the first class of the pair
+        positive = decision > 0
+        return positive @ a['winners'] + ~positive @ a['losers']
+
+    def scores(self, X):
+        return self.votes(self.decision(X))
+
+    def predict_with_probabilities(self, X):
+        # the labels come from the votes, like SVC.predict, not the probabilities
+        decision = self.decision(self._rows(X))
+        labels = self.classes[np.argmax(self.votes(decision), axis=1)]
+        if not self.has_probabilities:
+            return labels, None
+        return labels, self.couple(decision)
+
+    @property
+    def has_probabilities(self):
+        return 'prob_a' in self.arrays
+
+    def couple(self, decision):
+        """Class probabilities from the pairwise decisions, as libsvm computes
+        them: each pair's Platt-scaled probability, coupled by Wu, Lin and
+        Weng's method, iterating each row until it converges."""
+        a = self.arrays
+        n_classes = len(self.classes)
+        pair_prob = 1 / (1 + np.exp(decision * a['prob_a'] + a['prob_b']))
+        pair_prob = np.clip(pair_prob, 1e-7, 1 - 1e-7)
+
+        # r[:, i, j] is the probability of i over j
+        r = np.zeros((len(decision), n_classes, n_classes))
+        i, j = np.nonzero(a['winners'])[1], np.nonzero(a['losers'])[1]
+        r[:, i, j] = pair_prob
+        r[:, j, i] = 1 - pair_prob
+        Q = -r.transpose(0, 2, 1) * r
+        diagonal = np.arange(n_classes)
+        Q[:, diagonal, diagonal] = (r ** 2).sum(axis=1)
+
+        p = np.full((len(decision), n_classes), 1 / n_classes)
+        active = np.ones(len(decision), dtype=bool)
+        for _ in range(max(100, n_classes)):
+            Qp = np.einsum('nij,nj->ni', Q, p)
+            pQp = (p * Qp).sum(axis=1)
+            active &= np.abs(Qp - pQp[:, None]).max(axis=1) >= 0.005 / n_classes
+            if not active.any():
+                break
+            for t in range(n_classes):
+                Qtt = Q[:, t, t]
+                diff = np.where(active, (pQp - Qp[:, t]) / Qtt, 0)
+                p[:, t] += diff
+                pQp = (pQp + diff * (diff * Qtt + 2 * Qp[:, t])) / (1 + diff) ** 2
+                Qp = (Qp + diff[:, None] * Q[:, t, :]) / (1 + diff[:, None])
+                p /= (1 + diff[:, None])
+        return p
+
+
+class LinearPredictor(Predictor):
+    """Linear model, e.g. an SGDClassifier."""
+
+    kind = 'linear'
+
+    @classmethod
+    def compile(cls, model):
+        return cls({'coef': model.coef_, 'intercept': model.intercept_}, model.classes_)
+
+    def scores(self, X):
+        a = self.arrays
+        scores = X @ a['coef'].T + a['intercept']
+        if scores.shape[1] == 1:
+            return np.concatenate([np.zeros_like(scores), scores], axis=1)
+        return scores
+
+
+class GaussianNBPredictor(Predictor):
+    """Joint log likelihood of Gaussian naive Bayes."""
+
+    kind = 'gaussian_nb'
+
+    @classmethod
+    def compile(cls, model):
+        arrays = {
+            'log_prior': np.log(model.class_prior_),
+            'theta': model.theta_,
+            # scikit-learn before 1.0 calls the variances sigma_
+            'var': model.var_ if hasattr(model, 'var_') else model.sigma_,
+        }
+        return cls(arrays, model.classes_)
+
+    def scores(self, X):
+        a = self.arrays
+        norm = -0.5 * np.log(2 * np.pi * a['var']).sum(axis=1)
+        sq = ((X[:, None, :] - a['theta'][None]) ** 2 / a['var'][None]).sum(axis=2)
+        return a['log_prior'] + norm - 0.5 * sq
+
+    def probabilities(self, scores):
+        return softmax(scores)
+
+
+class VotingPredictor(Predictor):
+    """Hard voting of compiled estimators, or soft voting of their probabilities."""
+
+    kind = 'voting'
+
+    def __init__(self, arrays, classes, estimators=()):
+        super().__init__(arrays, classes)
+        self.estimators = list(estimators)
+
+    @classmethod
+    def compile(cls, model):
+        estimators = [compile_model(estimator) for estimator in model.estimators_]
+        if any(estimator is None for estimator in estimators):
+            return None
+        if model.voting == 'soft' and not all(estimator.has_probabilities for estimator in estimators):
+            return None
+        weights = model.weights if model.weights is not None else np.ones(len(estimators))
+        arrays = {'weights': np.asarray(weights, dtype=np.float64),
+                  'soft': np.array(model.voting == 'soft')}
+        # the estimators predict indices into model.classes_
+        return cls(arrays, model.classes_, estimators)
+
+    def scores(self, X):
+        weights = self.arrays['weights']
+        if self.has_probabilities:
+            probabilities = [estimator.predict_with_probabilities(X)[1] for estimator in self.estimators]
+            return np.average(probabilities, axis=0, weights=weights)
+
+        votes = np.zeros((X.shape[0], len(self.classes)))
+        rows = np.arange(X.shape[0])
+        for weight, estimator in zip(weights, self.estimators):
+            votes[rows, estimator.predict(X).astype(np.intp)] += weight
+        return votes
+
+    def probabilities(self, scores):
+        return scores if self.has_probabilities else None
+
+    @property
+    def has_probabilities(self):
+        # predictors saved before soft voting was compiled only vote
+        return 'soft' in self.arrays and bool(self.arrays['soft'])
+
+    def parts(self):
+        return self.estimators
+
+
+PREDICTORS = [
+    (RandomForestClassifier, ForestPredictor),
+    (MLPClassifier, MLPPredictor),
+    (SVC, SVCPredictor),
+    (SGDClassifier, LinearPredictor),
+    (GaussianNB, GaussianNBPredictor),
+    (VotingClassifier, VotingPredictor),
+]
+KINDS = {predictor.kind: predictor for _, predictor in PREDICTORS}
+
+
+def compile_model(model):
+    """Returns a Predictor for a trained model, or None if it cannot be compiled."""
+    for model_type, predictor in PREDICTORS:
+        if type(model) is model_type:
+            return predictor.compile(model)
+    return None
+
+
+# ============= Saving and loading ========
+def _describe(predictor, prefix, arrays):
+    """JSON description of predictor, its arrays are added to arrays by file name."""
+    names = {}
+    for name, array in predictor.arrays.items():
+        names[name] = '{}{}.npy'.format(prefix, name)
+        arrays[names[name]] = array
+    classes = '{}classes.npy'.format(prefix)
+    arrays[classes] = predictor.classes
+    return {
+        'kind': predictor.kind,
+        'arrays': names,
+        'classes': classes,
+        'parts': [_describe(part, '{}{}_'.format(prefix, i), arrays)
+                  for i, part in enumerate(predictor.parts())],
+    }
+
+
+def save(predictor, dirname):
+    """Saves predictor to dirname as .npy files and a JSON description."""
+    os.makedirs(dirname, exist_ok=True)
+    arrays = {}
+    description = {'version': FORMAT_VERSION, 'predictor': _describe(predictor, '', arrays)}
+    for filename, array in arrays.items():
+        np.save(os.path.join(dirname, filename), array, allow_pickle=False)
+    with open(os.path.join(dirname, DESCRIPTION_FILE), 'w') as f:
+        json.dump(description, f, indent=1)
+
+
+def _build(description, dirname, mmap_mode):
+    def load_array(filename):
+        array = np.load(os.path.join(dirname, filename), mmap_mode=mmap_mode, allow_pickle=False)
+        # strings and scalars are tiny, mmap is only worth it for the large arrays
+        return array if array.ndim > 0 and array.dtype.kind != 'U' else np.array(array)
+
+    predictor = KINDS[description['kind']]
+    arrays = {name: load_array(filename) for name, filename in description['arrays'].items()}
+    classes = load_array(description['classes'])
+    parts = [_build(part, dirname, mmap_mode) for part in description['parts']]
+    if parts:
+        return predictor(arrays, classes, parts)
+    return predictor(arrays, classes)
+
+
+def load(dirname, mmap_mode='r'):
+    """Loads a predictor saved with save(), memory-mapping its arrays by default."""
+    with open(os.path.join(dirname, DESCRIPTION_FILE), 'r') as f:
+        description = json.load(f)
+    if description.get('version') != FORMAT_VERSION:
+        raise ValueError('{}: unsupported predictor version {}'.format(
+            dirname, description.get('version')))
+    return _build(description['predictor'], dirname, mmap_mode)
@@ -0,0 +1,212 @@
+"""
+datastore.py
+
+Append-only storage of the training data collected by the data handlers.
+
+Every label keeps its rounds in training_data_<label>.npy, which stays a
+regular .npy file that np.load can open. Instead of loading the file,
+appending and saving everything again, a new round is written at the end of
+the file and only the shape in the header is updated, so saving a round costs
+the size of the round no matter how many were collected before. Files are
+written with a padded header so the shape can grow in place; a file written by
+np.save is converted once, the first time a round is appended to it.
+
+The data is written before the header, so a reader never sees a round that is
+only partly on disk. Discarding rounds copies the ones kept to a new file, so a
+reader that has the old file memory-mapped keeps its data.
+
+Compiling the training data for ml.py only writes a manifest that lists the
+files and how many rounds of each to use.
+
+The data handlers save rounds through a Writer, which appends them on a
+background thread so their device keeps being read while the disk is busy.
+"""
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+HEADER_BYTES = 128      # room for the shape to grow without moving the data
+MAGIC_BYTES = 10        # magic string, version and header length of a 1.0 header
+MANIFEST_VERSION = 1
+WRITE_BLOCK_BYTES = 16 * 1024 * 1024  # data copied to a new file at a time
+
+
+def file_name(label):
+    return 'training_data_{}.npy'.format(label)
+
+
+def label_of(filename):
+    """Label of a training_data_<label>.npy file."""
+    return os.path.basename(filename)[len('training_data_'):-len('.npy')]
+
+
+def _header(dtype, shape, size):
+    """Version 1.0 .npy header of exactly size bytes, or None if it does not fit."""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                   'fortran_order': False,
+                   'shape': tuple(int(n) for n in shape)})
+    padding = size - MAGIC_BYTES - len(header) - 1
+    if padding < 0:
+        return None
+    header = (header + ' ' * padding + '\n').encode('latin1')
+    return np.lib.format.magic(1, 0) + np.uint16(len(header)).tobytes() + header
+
+
+def _read_header(f):
+    """Returns (shape, fortran_order, dtype, data offset, header version)."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, fortran_order, dtype, f.tell(), version
+
+
+def _nbytes(shape, dtype):
+    return int(np.prod(shape)) * dtype.itemsize
+
+
+def _write(filename, data):
+    """Writes data to a new file with a padded header."""
+    data = np.ascontiguousarray(data)
+    size = HEADER_BYTES
+    header = _header(data.dtype, data.shape, size)
+    while header is None:
+        size += HEADER_BYTES
+        header = _header(data.dtype, data.shape, size)
+
+    # data may be memory-mapped, only one block of it is read into memory at once
+    block = max(1, WRITE_BLOCK_BYTES // max(1, data[:1].nbytes))
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(header)
+        for start in range(0, len(data), block):
+            f.write(data[start:start + block].tobytes())
+    os.replace(tmp_filename, filename)
+
+
+def num_rounds(filename):
+    """Number of rounds in filename, read from the header only. 0 if missing."""
+    try:
+        with open(filename, 'rb') as f:
+            return int(_read_header(f)[0][0])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def append(filename, rounds):
+    """Appends rounds, shaped (rounds, instances, ...), and returns the new total."""
+    rounds = np.asarray(rounds)
+    if not os.path.exists(filename):
+        _write(filename, rounds)
+        return rounds.shape[0]
+
+    with open(filename, 'r+b') as f:
+        shape, fortran_order, dtype, offset, version = _read_header(f)
+        if tuple(shape[1:]) != rounds.shape[1:]:
+            raise ValueError('{}: rounds of shape {} do not match {}'.format(
+                filename, rounds.shape[1:], tuple(shape[1:])))
+        if not np.can_cast(rounds.dtype, dtype, casting='same_kind'):
+            raise ValueError('{}: cannot append {} to {}'.format(filename, rounds.dtype, dtype))
+        rounds = np.ascontiguousarray(rounds, dtype=dtype)
+
+        new_shape = (shape[0] + rounds.shape[0],) + tuple(shape[1:])
+        header = None
+        if version == (1, 0) and not fortran_order:
+            header = _header(dtype, new_shape, offset)
+
+        if header is not None:
+            # data first, then the header that makes it visible
+            f.seek(offset + _nbytes(shape, dtype))
+            f.write(rounds.tobytes())
+            f.truncate()
+            f.flush()
+            f.seek(0)
+            f.write(header)
+            return new_shape[0]
+
+    # header cannot grow in place (e.g. written by np.save), convert the file
+    _write(filename, np.concatenate([np.load(filename), rounds]))
+    return new_shape[0]
+
+
+def truncate(filename, rounds):
+    """Keeps the first rounds rounds of filename.
+
+    The kept rounds are copied to a new file that replaces filename, the file
+    is never shrunk in place: ml.py may have it memory-mapped while training,
+    and shrinking a mapped file kills the reader (SIGBUS on Linux).
+    """
+    data = np.load(filename, mmap_mode='r')
+    _write(filename, data[:max(0, min(rounds, data.shape[0]))])
+
+
+def load(filename, rounds=None, mmap_mode=None):
+    """Loads the first rounds rounds of filename (all of them if None)."""
+    data = np.load(filename, mmap_mode=mmap_mode)
+    if rounds is not None:
+        data = data[:rounds]
+    return data
+
+
+# ============= Manifest of the compiled training data ========
+def write_manifest(training_data_files, filename):
+    """Records how many rounds every training data file holds right now.
+
+    Handlers only ever append, so these rounds stay the same even if more
+    rounds are collected while ml.py trains.
+    """
+    entries = [{'label': label_of(file),
+                'file': file,
+                'rounds': num_rounds(file)} for file in training_data_files]
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': entries}, f, indent=1)
+    os.replace(tmp_filename, filename)
+
+
+def read_manifest(filename):
+    """Returns [(label, file, rounds), ...] of a manifest."""
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    return [(entry['label'], entry['file'], entry['rounds'])
+            for entry in manifest['files'] if entry['rounds'] > 0]
+
+
+# ============= Writing rounds in the background ==============
+class Writer:
+    """Appends rounds to training data files on a background thread, so the
+    data handler keeps reading its device while the disk is busy.
+
+    Rounds are written in the order they were queued. close() waits for all
+    of them to be on disk.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            filename, rounds = item
+            try:
+                total = append(filename, rounds)
+                print('Training Data SAVED!!! ({} rounds in {})'.format(total, filename))
+            except (OSError, ValueError) as e:
+                print('datastore: could not save {}: {}'.format(filename, e))
+
+    def append(self, filename, rounds):
+        """Queues rounds to be appended to filename, see append()."""
+        self._queue.put((filename, rounds))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,110 @@
+"""
+devicereader.py
+
+Reads a device (a serial port, a UDP socket) on a background thread.
+
+The thread does nothing but read: every read is stamped with the
+time.monotonic() it arrived and put into a bounded queue, which the data
+handler's main loop drains to frame and publish the data. Writing training
+data to disk happens on yet another thread (see datastore.Writer), so
+neither framing nor a slow disk keeps the device from being read and its OS
+buffer from overflowing.
+
+If the main loop falls so far behind that the queue is full, reads are
+dropped and counted instead of blocking the reader.
+"""
+import queue
+import threading
+import time
+
+
+DEFAULT_MAXSIZE = 4096      # reads kept in the queue
+REPORT_INTERVAL = 5         # seconds between reports of dropped reads
+
+
+class DeviceReader:
+    """Calls read() on a background thread and queues what it returns.
+
+    read returns one chunk of data (e.g. the bytes or the line read), or None
+    if there was nothing to read (e.g. a socket timed out). An exception
+    stops the reader and is raised by get() once the queue is drained.
+    """
+
+    def __init__(self, read, name='device', maxsize=DEFAULT_MAXSIZE):
+        self.name = name
+        self._read = read
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+        self.error = None
+
+        self.reads = 0              # reads queued or dropped
+        self.dropped = 0            # reads dropped because the queue was full
+        self.dropped_bytes = 0      # their size, for reads of bytes
+        self._reported = 0
+        self._last_report = time.monotonic()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            try:
+                chunk = self._read()
+            except Exception as e:
+                if not self._closed:
+                    self.error = e
+                break
+            if chunk is None:
+                continue
+            captured = time.monotonic()
+            self.reads += 1
+            try:
+                self._queue.put_nowait((chunk, captured))
+            except queue.Full:
+                self.dropped += 1
+                if hasattr(chunk, '__len__'):
+                    self.dropped_bytes += len(chunk)
+
+    def get(self, timeout=None):
+        """Returns the next (chunk, captured), or None if none arrives within
+        timeout sec."""
+        try:
+            return self._queue.get(timeout=timeout if self.alive() else 0)
+        except queue.Empty:
+            pass
+        if self.error is not None:
+            raise self.error
+        return None
+
+    def poll(self, timeout=None):
+        """Returns all (chunk, captured) read so far, oldest first, waiting up
+        to timeout sec for the first one."""
+        first = self.get(timeout)
+        if first is None:
+            return []
+        chunks = [first]
+        while True:
+            try:
+                chunks.append(self._queue.get_nowait())
+            except queue.Empty:
+                return chunks
+
+    def alive(self):
+        return self._thread.is_alive()
+
+    def report(self):
+        """Prints the number of dropped reads every REPORT_INTERVAL sec, if
+        any were dropped since the last report."""
+        now = time.monotonic()
+        if now - self._last_report < REPORT_INTERVAL or self.dropped == self._reported:
+            return
+        message = '{}: dropped {} of {} reads'.format(self.name, self.dropped, self.reads)
+        if self.dropped_bytes:
+            message += ' ({} bytes)'.format(self.dropped_bytes)
+        print(message + ', the handler cannot keep up')
+        self._reported = self.dropped
+        self._last_report = now
+
+    def close(self):
+        """Stops reading. Close the device too, to unblock a pending read."""
+        self._closed = True
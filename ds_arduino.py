@@ -15,9 +15,7 @@ Setup: <relevant parts of config.ini might need to be adjusted>
 import os
 import sys
 import time
-import signal
 import configparser
-from datetime import timedelta
 
 # Data processing
 import numpy as np
@@ -26,11 +24,13 @@ import numpy as np
 import glob
 import serial
 
-# for windows
-from timeloop import Timeloop
-
 # Self-define functions
-import utils
+import msgbus
+import framebus
+import datastore
+import devicereader
+import serialframes
+import streaming
 
 #================================================================
 # read in configurations
@@ -42,18 +42,31 @@ FRAME_LENGTH=  int(config['GLOBAL'    ]['FRAME_LENGTH'])  # fixed size, need to
 
 T_RECORD    =float(config['DS_arduino']['T_RECORD'    ])  # record for seconds per instances
 T_OVERLAP   =float(config['DS_arduino']['T_OVERLAP'   ])  # overlap seconds                   
+SAMPLE_RATE =  int(config['DS'        ]['SAMPLE_RATE' ])  # samples per second
+PROTOCOL    =config['DS_arduino'].get('PROTOCOL', 'ascii').strip().lower()  # ascii or binary
 #================================================================
 
+COMMAND_CHECK_INTERVAL=0.05         # sec to wait for samples before checking for commands
+HOP=max(1, int(round(T_OVERLAP*SAMPLE_RATE)))  # samples between frames, a frame every T_OVERLAP sec
+
+# binary protocol of arduinofirmware/AnalogReadBinary
+BINARY_SYNC      =b'\xde\xad\xbe\xef'
+BINARY_BLOCK_SIZE=32                # samples per packet, BLOCK_SIZE in AnalogReadBinary.ino
+BINARY_BAUD_RATE =1000000           # BAUD_RATE in AnalogReadBinary.ino
+BINARY_READ_SIZE =16*1024           # most bytes taken from the port in one read
+PACKET_DTYPE     =np.dtype([('seq',     '<u2'),
+                            ('samples', '<u2', (BINARY_BLOCK_SIZE,))])
+
 # Global variables
 is_collecting_dataset      =False   # enabled when spacebar hit
 
 # Static variables
-t_start_collect            =0       # act as static for func
 training_data_frame_counter=0       # counter for spacebar hits, act as static for func
-tmpframe                   =[]      # place to store current data
-previousframe              =[]      # place to store previous data
 training_data              =[[]]    # Store training data 
 
+# a frame of the latest FRAME_LENGTH samples every HOP samples
+window=streaming.SlidingWindow(FRAME_LENGTH, HOP)
+
 
 def serial_ports():
     """ Lists serial port names
@@ -75,7 +88,7 @@ def serial_ports():
 
     return ports
 
-def get_serial():
+def get_serial(baud_rate=9600):
     # Get serial port name based on different OS
 
     # Mac
@@ -95,7 +108,7 @@ def get_serial():
                 # if we have a port with a familiar arduino or teensy name, pick it
                 print("Connecting to preferred port: {}".format(preferred_port))
                 s = serial.Serial(preferred_port,
-                                  9600,
+                                  baud_rate,
                                   timeout=None, 
                                   bytesize=serial.EIGHTBITS,
                                   xonxoff=False,
@@ -105,7 +118,7 @@ def get_serial():
                 # otherwise, just go with the first port
                 print("Connecting to first available port: {}".format(ports[0]))
                 s = serial.Serial(serial_ports()[0],
-                                  9600,
+                                  baud_rate,
                                   timeout=None,
                                   bytesize=serial.EIGHTBITS,
                                   xonxoff=False,
@@ -115,124 +128,147 @@ def get_serial():
     # ubuntu or VM on Windows
     if sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
         # /dev/ttyACM0 if real machine or /dev/ttyS0
-        s = serial.Serial('/dev/ttyACM0', 9600)
+        s = serial.Serial('/dev/ttyACM0', baud_rate)
 
     # Windows
     if sys.platform.startswith('win'):
-        s = serial.Serial('COM4')
+        s = serial.Serial('COM4', baud_rate)
 
     return s
 
-def arduino_data(s):
+class BlockDecoder:
+    """Decodes the binary packets of AnalogReadBinary.ino.
+
+    Packets are found in the bytes read with serialframes.PacketParser and
+    all complete ones are decoded at once with np.frombuffer. Gaps in their
+    sequence numbers are counted as lost samples.
+    """
+
+    def __init__(self):
+        self.parser     =serialframes.PacketParser(BINARY_SYNC, PACKET_DTYPE.itemsize)
+        self.next_seq   =None
+        self.lost       =0      # samples of packets that never arrived
+        self._reported  =0
+        self._last_report=time.monotonic()
+
+    def decode(self, chunk):
+        """Returns the samples of the packets completed by chunk, split at gaps.
+
+        The first run continues the samples of the previous chunk, every
+        later one follows lost packets. The first run is empty if the chunk
+        starts with a gap.
+        """
+        self.parser.feed(chunk)
+        packets=self.parser.packets()
+        if not packets:
+            return []
+        blocks=np.frombuffer(b''.join(packets), dtype=PACKET_DTYPE)
+
+        seq     =blocks['seq'].astype(np.int64)
+        previous=np.empty_like(seq)
+        previous[0] =seq[0]-1 if self.next_seq is None else self.next_seq-1
+        previous[1:]=seq[:-1]
+        missing      =(seq-previous-1)%65536
+        self.lost    +=int(missing.sum())*BINARY_BLOCK_SIZE
+        self.next_seq=(int(seq[-1])+1)%65536
+
+        # split before every packet that follows lost ones
+        runs=np.split(blocks['samples'].astype(np.float64), np.flatnonzero(missing))
+        return [run.ravel() for run in runs]
+
+    def report(self):
+        """Prints the number of lost samples, like DeviceReader.report()."""
+        now=time.monotonic()
+        if now-self._last_report<devicereader.REPORT_INTERVAL or self.lost==self._reported:
+            return
+        print('ds_arduino: lost {} samples, {} bytes out of sync'.format(
+            self.lost, self.parser.discarded))
+        self._reported   =self.lost
+        self._last_report=now
+
+def read_block():
+    """Everything the port has buffered, in one read. Runs on the reader thread."""
+    return s.read(max(1, min(s.in_waiting, BINARY_READ_SIZE)))
+
+def parse_line(b):
+    """The sample of a line printed by AnalogReadSerial.ino."""
+    string_n=b.decode()         # decode byte string into Unicode  
+    string  =string_n.rstrip()  # remove \n and \r
+    return [float(string)]      # convert string to float
+
+def arduino_data(reader):
+    """Handles the samples the reader thread read so far."""
+    try:
+        for chunk, captured in reader.poll(timeout=COMMAND_CHECK_INTERVAL):
+            if decoder is None:
+                add_samples(parse_line(chunk), captured)
+            else:
+                for i, samples in enumerate(decoder.decode(chunk)):
+                    if i>0:
+                        # a frame must not stitch samples across the gap
+                        window.reset()
+                    if len(samples):
+                        add_samples(samples, captured)
+        reader.report()
+        if decoder is not None:
+            decoder.report()
+    except Exception as e:
+        print('ds_arduino:', e)
+        close()
+
+def add_samples(samples, captured):
+    """Adds samples read from the Arduino, publishes a frame every HOP samples."""
     global is_collecting_dataset,       \
-           tmpframe,                    \
-           T_RECORD,                    \
-           T_OVERLAP,                   \
            training_data_frame_counter, \
-           t_start_collect,             \
-           previousframe,               \
-           FRAME_LENGTH,                \
            training_data
-    # while True:
-    # s.xonxoff=1
-    # s.stopbits = 2
-    try:
-        now=time.time()
-        # print("now:", now)
-
-        # Read from Arduino
-        b       =s.readline()
-        string_n=b.decode()         # decode byte string into Unicode  
-        string  =string_n.rstrip()  # remove \n and \r
-        flt     =float(string)      # convert string to float
-        # print(flt)
-        tmpframe.append(flt)
-
-        # 
-        if (now-t_start_collect)>T_OVERLAP:
-            # overlap frames
-            frame        =tmpframe+previousframe
-            previousframe=tmpframe
-            tmpframe     =frame
-
-            # Store data
-            tmpframe=np.asarray(tmpframe)
-            tmpframe=tmpframe[:FRAME_LENGTH] # if needed
-            tmpframe=np.expand_dims(tmpframe, axis=0)
-            print('len:', tmpframe.shape)
-            np.save('tmpframe', tmpframe)
-
-            if is_collecting_dataset:
-                if training_data_frame_counter<INSTANCES:
-                    training_data_frame_counter+=1
-                    training_data[0].append(tmpframe)
-                else:
-
-                    print('Done collecting training data, saving NOW')
-                    training_data_frame_counter=0
-
-                    # get label
-                    f            =open("current_label.txt", "r")
-                    current_label=f.read().strip()
-                    f.close()
-
-                    # create file name based on label
-                    training_data_file_name='training_data_{}.npy'.format(current_label)
-
-                    print('Saving Training Data...')
-
-                    # check if file already exist, if yes, then append
-                    if os.path.exists(os.path.join(os.getcwd(), training_data_file_name)):
-                        existing_training_data=np.load(training_data_file_name)
-                        np.save(training_data_file_name,
-                                np.append(existing_training_data, training_data, axis=0))
-                    # else create a new file
-                    else:
-                        np.save(training_data_file_name, training_data)
-                
-                    training_data = [[]]
-                    is_collecting_dataset = False
 
-                    print('Training Data SAVED!!!')
+    # overlapping frames of the latest FRAME_LENGTH samples, as views into
+    # the window's buffer
+    for tmpframe in window.windows(np.asarray(samples, dtype=np.float64)):
+        framebus.publish(tmpframe, captured)
 
-            tmpframe=[]
-            t_start_collect=time.time()
+        if is_collecting_dataset:
+            if training_data_frame_counter<INSTANCES:
+                training_data_frame_counter+=1
+                training_data[0].append(tmpframe.copy())
+            else:
 
-    except Exception as e:
-        print('ds_arduino:', e)
-        s.close()
-        sys.exit()
+                print('Done collecting training data, saving NOW')
+                training_data_frame_counter=0
 
-    end=time.time()
-    return
+                # get label
+                f            =open("current_label.txt", "r")
+                current_label=f.read().strip()
+                f.close()
 
-def read_message():
-    # Read command
-    try:
-        f = open("ds_cmd.txt", "r")
-        cmd = f.read()
-        f.close()
-    except Exception as e:
-        return
+                # create file name based on label
+                training_data_file_name='training_data_{}.npy'.format(current_label)
+
+                print('Saving Training Data...')
+
+                # append the round to the label's data file, off the read loop
+                writer.append(training_data_file_name, training_data)
+            
+                training_data = [[]]
+                is_collecting_dataset = False
+
+    return
 
-    # Check command
+def read_message(cmd):
+    """Handles a data handler command sent by ui.py."""
     if cmd == 'SPACEBAR':
-        global is_collecting_dataset, t_start_collect
+        global is_collecting_dataset
         is_collecting_dataset = True
-        t_start_collect=time.time()
     elif cmd == 'BYE':
-        s.close()
-        f.close()
-        sys.exit()
-
-    # Clear command
-    f = open("ard_cmd.txt", "w")
-    f.write("")
-    f.close()
+        close()
 
-# MAC/LINUX
-def receive_interrupt(signum, stack):
-    read_message()
+def close():
+    reader.close()
+    s.close()
+    writer.close()
+    framebus.close()
+    commands.close()
+    os._exit(0)
 
 if __name__ == '__main__':
     print('ds_arduino.py: Started')
@@ -246,15 +282,32 @@ if __name__ == '__main__':
     # print("All ports:")
     # print(serial_ports())
     
-    s=get_serial()
+    if PROTOCOL=='binary':
+        # packed blocks of samples of AnalogReadBinary.ino
+        s      =get_serial(BINARY_BAUD_RATE)
+        decoder=BlockDecoder()
+        read   =read_block
+    elif PROTOCOL=='ascii':
+        # one line per sample of AnalogReadSerial.ino
+        s      =get_serial()
+        decoder=None
+        read   =s.readline
+    else:
+        print('ds_arduino.py: unknown PROTOCOL {}, use ascii or binary. Quit.'.format(PROTOCOL))
+        sys.exit()
+
+    # commands sent by ui.py
+    commands = msgbus.CommandServer("ds")
 
-    # Hook up crtl+c to self-define function
-    if utils.does_support_signals():
-        signal.signal(signal.SIGINT, receive_interrupt)
+    # the port is read on its own thread, rounds are saved on another
+    reader=devicereader.DeviceReader(read, 'ds_arduino')
+    writer=datastore.Writer()
 
     # Collect data forever
     while True:
-        arduino_data(s)
+        for cmd in commands.poll():
+            read_message(cmd)
+        arduino_data(reader)
 
     s.close()
     sys.exit()
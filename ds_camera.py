@@ -22,9 +22,7 @@ selects the camera, which by default is camera 0.
 import os
 import sys
 import time
-import signal
 import configparser
-from datetime import timedelta
 
 # Data processing
 import numpy as np
@@ -39,11 +37,10 @@ from hand_tracking.src.hand_tracker import HandTracker
 # tensorflow
 from tensorflow.python.client import device_lib
 
-# for windows
-from timeloop import Timeloop
-
 # Self-define functions
-import utils
+import msgbus
+import framebus
+import datastore
 
 
 #================================================================
@@ -129,6 +126,7 @@ def camera_data():
                              box_enlarge=1.3)
 
         while hasFrame:
+            captured=time.monotonic()  # frame was just read from the camera
             image=cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
             t_start=time.time()
@@ -192,7 +190,7 @@ def camera_data():
                 # sys.exit()
 
                 # save live data
-                np.save('tmpframe'    , tmpframe)
+                framebus.publish(tmpframe, captured)
                 np.save('tmpframe_RGB', tmpframe_RGB)
 
                 # collecting frames but not reached the number of smaples yet
@@ -216,15 +214,8 @@ def camera_data():
 
                     print('Saving Training Data...')
 
-                    # append data to existing file or store to new file
-                    if os.path.exists(os.path.join(os.getcwd(), training_data_file_name)):
-                        existing_training_data=np.load(training_data_file_name, allow_pickle=True)
-
-                        np.save(training_data_file_name,
-                                np.append(existing_training_data, training_data, axis=0))
-
-                    else:
-                        np.save(training_data_file_name, training_data)
+                    # append the round to the label's data file
+                    datastore.append(training_data_file_name, training_data)
 
                     training_data=[[]]
                     is_collecting_dataset=False
@@ -244,35 +235,27 @@ def camera_data():
                 tmpframe_RGB=[]
 
             end=time.time()
-            hasFrame, frame = capture.read()
-    except Exception as e:
-        print(e)
-        return
 
-# MAC/LINUX
-def receive_interrupt(signum, stack):
-    read_message()
+            # handle commands between camera frames
+            for cmd in commands.poll():
+                read_message(cmd)
 
-def read_message():
-    try:
-        f = open("ds_cmd.txt", "r")
-        cmd = f.read()
-        f.close()
+            hasFrame, frame = capture.read()
     except Exception as e:
+        print(e)
         return
 
+def read_message(cmd):
+    """Handles a data handler command sent by ui.py."""
     if cmd == 'SPACEBAR':
         global is_collecting_dataset
         is_collecting_dataset = True
     elif cmd == 'BYE':
         # s.close()
-        f.close()
+        framebus.close()
+        commands.close()
         os._exit(0)
 
-    f = open("ds_cmd.txt", "w")
-    f.write("")
-    f.close()
-
 if __name__ == '__main__':
     print('ds_camera.py: Started')
 
@@ -285,32 +268,13 @@ if __name__ == '__main__':
     # Get GPU device name
     device_lib.list_local_devices()
 
-    # if OS supports signals
-    if utils.does_support_signals():
-        signal.signal(signal.SIGINT, receive_interrupt)
-
-        # Collect data forever
-        while True:
-            camera_data()
-
-    # No signals to use
-    else:
-        timeloop = Timeloop()
-
-        # add timeloop job to handle camera commands
-        @timeloop.job(interval=timedelta(seconds=0.3))
-        def read_message_wrapper():
-            read_message()
+    # commands sent by ui.py
+    commands = msgbus.CommandServer("ds")
 
-        # add timeloop job to collect and write camera data
-        @timeloop.job(interval=timedelta(seconds=0.2))
-        def camera_data_wrapper():
-            camera_data()
-
-        timeloop.start(block=True)
+    # Collect data forever
+    while True:
+        for cmd in commands.poll():
+            read_message(cmd)
+        camera_data()
 
     sys.exit()
-
-
-
-
@@ -31,15 +31,14 @@ Note: Recommended to collect at at least 3-4 times for each label and to start
 """
 # ============================================================================
 
-from datetime import timedelta
-from timeloop import Timeloop
 import glob
 import numpy as np
 import os
-import signal
 import sys
 import time
-import utils
+import msgbus
+import framebus
+import datastore
 import pyaudio
 import wave
 from scipy.io import wavfile
@@ -182,10 +181,11 @@ def microphone_data():
 
         # read data from wav folder (wavs)
         tmpframe = get_wav_from_file()
+        captured = time.monotonic()
         tmpframe = shape_data(tmpframe)
 
-        # saves tmpframe to display points for ui
-        np.save('tmpframe', tmpframe)
+        # publishes tmpframe to display points for ui
+        framebus.publish(tmpframe, captured)
 
     except Exception as e:
         print("Could not get data.")
@@ -213,14 +213,8 @@ def microphone_data():
 
             print('Saving Training Data...')
 
-            # appends training data to existing data or saves as new data
-            if os.path.exists(os.path.join(os.getcwd(), training_data_file_name)):
-                existing_training_data = np.load(training_data_file_name)
-
-                np.save(training_data_file_name,
-                        np.append(existing_training_data, training_data, axis=0))
-            else:
-                np.save(training_data_file_name, training_data)
+            # append the round to the label's data file
+            datastore.append(training_data_file_name, training_data)
             training_data = [[]]
             is_collecting_dataset = False
 
@@ -231,69 +225,29 @@ def microphone_data():
         return
 
 
-# MAC/LINUX
-def receive_interrupt(signum, stack):
-    read_message()
-
-
-def read_message():
+def read_message(cmd):
+    """Handles a data handler command sent by ui.py."""
     global is_collecting_dataset
-    try:
-        f = open("ds_cmd.txt", "r")
-        cmd = f.read()
-        f.close()
-    except Exception as e:
-        return
     if cmd == 'SPACEBAR':
         is_collecting_dataset = True
         print("Spacebar Closing")
     elif cmd == 'BYE':
         print("Microphone WAV Closing")
 
-        # closing the system
-        f = open("ds_cmd.txt", "w")
-        f.write("")
-        f.close()
-
         # closing the audio stream
         stream.stop_stream()
         stream.close()
         p.terminate()
+        framebus.close()
+        commands.close()
 
         os._exit(0)
-    f = open("ds_cmd.txt", "w")
-    f.write("")
-    f.close()
-
-
-if utils.does_support_signals():
-    signal.signal(signal.SIGINT, receive_interrupt)
 
-    while True:
-        microphone_data()
 
-timeloop = Timeloop()
+# commands sent by ui.py
+commands = msgbus.CommandServer("ds")
 
-
-# add timeloop job to handle commands
-@timeloop.job(interval=timedelta(seconds=0.3))
-def read_message_wrapper():
-    read_message()
-
-
-# add timeloop job to collect and write microphone data
-@timeloop.job(interval=timedelta(seconds=(1/chunks_per_second)))
-def microphone_data_wrapper():
+while True:
+    for cmd in commands.poll():
+        read_message(cmd)
     microphone_data()
-
-
-if not utils.does_support_signals():
-    timeloop.start(block=True)
-
-
-print("Microphone WAV Closing")
-
-# closing the audio stream
-stream.stop_stream()
-stream.close()
-p.terminate()
\ No newline at end of file
@@ -11,7 +11,7 @@ determines the rate at which sensor data is sent (a maximum of 100 hz for
 each sensor). Channel data (e.g. x, y, and z for accelerometer) is 
 concatenated in each buffered UDP packet to be read by this handler. When 
 `FRAME_LENGTH` many samples are sent from each sensor, a frame of data is
-written to a tmpframe.npy file to be previewed by the T4Train user interface. 
+published on the frame bus to be previewed by the T4Train user interface. 
 When the user commands this file to begin collecting training data 
 (by pressing space when the UI is running), `INSTANCES`-many frames are 
 received and written to a training_data_{training label selected in UI}.npy 
@@ -42,6 +42,9 @@ import signal
 import sys
 import time
 import utils
+import msgbus
+import framebus
+import datastore
 import configparser
 
 import Adafruit_BluefruitLE
@@ -175,6 +178,7 @@ def mobile_data():
 			# read fresh BLE data
 			phone.clear()
 			samples = phone.read(samples_required=FRAME_LENGTH, timeout_sec=10)
+			captured = time.monotonic()
 			if samples is None:
 				print("Timed out: going to try reconnecting")
 				try_reconnecting = True
@@ -212,9 +216,9 @@ def mobile_data():
 					total_subchannels_added += 1
 			
 			print("Sample collection rate: {} Hz".format(FRAME_LENGTH/(time.time() - now)))
-			# always write tmpframe to file to keep inference up to date
+			# always publish tmpframe to keep inference up to date
 			tmpframe = np.asarray(tmpframe)
-			np.save('tmpframe', tmpframe[:, -(FRAME_LENGTH + 2):]) # write last framelength chunk (+2 to account for channel indices)
+			framebus.publish(tmpframe[:, -(FRAME_LENGTH + 2):], captured) # publish last framelength chunk (+2 to account for channel indices)
 			
 			# only save to training file if in training state
 			if is_collecting_dataset:
@@ -234,14 +238,8 @@ def mobile_data():
 			
 			training_data_file_name = 'training_data_{}.npy'.format(current_label)
 			print('Saving training data to {}'.format(training_data_file_name))
-			if os.path.exists(os.path.join(os.getcwd(), training_data_file_name)):
-				existing_training_data = np.load(training_data_file_name)
-				np.save(training_data_file_name,
-						np.append(existing_training_data,
-						training_data,
-						axis=0))
-			else:
-				np.save(training_data_file_name, training_data)
+			# append the round to the label's data file
+			datastore.append(training_data_file_name, training_data)
 
 			# cleanup global variables
 			training_data = [[]]
@@ -252,26 +250,16 @@ def mobile_data():
 		return
 	
 
-def read_message():
-	try:
-		f = open("ds_cmd.txt", "r")
-		cmd = f.read()
-		f.close()
-		
-		if cmd == 'SPACEBAR':
-			global is_collecting_dataset
-			is_collecting_dataset = True
-		
-		# warning: not working when sigint triggers a readmessage...
-		with open("ds_cmd.txt", "w") as f:
-			f.write("")
-			
-		if cmd == 'BYE':
-			print("Exiting {}".format(_FILENAME_))
-			os._exit(0)
-			
-	except Exception as e:
-		return # when unable to open command file since not existent
+def read_message(cmd):
+	"""Handles a data handler command sent by ui.py."""
+	if cmd == 'SPACEBAR':
+		global is_collecting_dataset
+		is_collecting_dataset = True
+	elif cmd == 'BYE':
+		print("Exiting ds_mobile_ble")
+		framebus.close()
+		commands.close()
+		os._exit(0)
 
 # Main function implements the program logic so it can run in a background
 # thread.  Most platforms require the main thread to handle GUI events and other
@@ -333,7 +321,8 @@ def ble_main():
 				if read_kill_file():
 					print("Exiting {}".format(_FILENAME_))
 					os._exit(0)
-				read_message() # updates is_collecting_dataset
+				for cmd in commands.poll():
+					read_message(cmd) # updates is_collecting_dataset
 				mobile_data()
 				if try_reconnecting: # check in outer loop to exit to outer-most loop
 					break
@@ -368,6 +357,9 @@ if utils.does_support_signals():
 	fork_pid = os.fork()
 	
 	if fork_pid == 0: # case: child process, run BLE on thread here
+		# commands sent by ui.py
+		commands = msgbus.CommandServer("ds")
+
 		# Initialize the BLE system.  MUST be called before other BLE calls!
 		ble = Adafruit_BluefruitLE.get_provider()
 		ble.initialize()
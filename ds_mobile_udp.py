@@ -8,10 +8,13 @@ on the T4Train Github Repository.
 iOS devices running the Mobile data handler simply set the communication mode 
 to UDP and activate sensors like accelerometer and gyroscope. The iOS app 
 determines the rate at which sensor data is sent (a maximum of 100 hz for 
-each sensor). Channel data (e.g. x, y, and z for accelerometer) is 
-concatenated in each buffered UDP packet to be read by this handler. When 
+each sensor). The app batches a few samples of every active sensor into one
+binary UDP packet (a header, the sensor ids and channel counts, then the
+samples as float32, see UDPPacket in UDPManager.swift), which this handler
+decodes at once with NumPy. Text packets of one sample each
+("&acc:x,y,z:&gyro:x,y,z:") from older versions of the app still work. When 
 `FRAME_LENGTH` many samples are sent from each sensor, a frame of data is
-written to a tmpframe.npy file to be previewed by the T4Train user interface. 
+published on the frame bus to be previewed by the T4Train user interface. 
 When the user commands this file to begin collecting training data 
 (by pressing space when the UI is running), `INSTANCES`-many frames are 
 received and written to a training_data_{training label selected in UI}.npy 
@@ -29,20 +32,18 @@ data frames.
 """
 # ============================================================================
 
-from datetime import timedelta
-from scipy import signal
-from timeloop import Timeloop
 import glob
 import numpy as np
 import os
 import serial
-import signal
 import sys
 import time
-import utils
+import msgbus
+import framebus
+import datastore
+import devicereader
 import configparser
 import socket
-import time 
 
 #================================================================
 # udp setup
@@ -70,168 +71,226 @@ FRAME_LENGTH=int(config['GLOBAL'    ]['FRAME_LENGTH'])  # fixed size, need to ad
 
 #================================================================
 
+# binary packets sent by the mobile app (UDPPacket in UDPManager.swift)
+PACKET_MAGIC = b'T4'
+PACKET_VERSION = 1
+HEADER_DTYPE = np.dtype([('magic', 'S2'), ('version', 'u1'), ('num_sensors', 'u1'),
+						 ('num_samples', '<u2'), ('reserved', '<u2'), ('seq', '<u4')])
+SENSOR_DTYPE = np.dtype([('id', 'S4'), ('channels', 'u1'), ('reserved', 'u1', (3,))])
+
+#================================================================
+
 # remaining gloabls
 is_collecting_dataset = False
-frame=[]
-frame_complete = 0
-save_frames = 0
 training_data = [[]]
 training_data_frame_counter = 0
-try_reconnecting = True # used to mark if we should try to reconnect
 command_check_interval = 0.05 # sleep 0.x seconds before checking for spacebar
+udp_timeout = 3 # seconds without a packet before warning that none arrive
+
+def receive():
+	"""One UDP packet, None if none arrived. Runs on the reader thread."""
+	try:
+		data, addr = sock.recvfrom(65535)
+	except socket.timeout:
+		return None
+	return data
+
+class PacketDecoder:
+	"""Decodes the binary packets of the mobile app.
+
+	A packet holds several samples of every active sensor, which are decoded
+	at once with np.frombuffer and a structured dtype made of the sensor ids
+	and channel counts in the packet. Gaps in the packets' sequence numbers
+	are counted as lost packets.
+	"""
+
+	def __init__(self):
+		self.sensors = None # ((id, channels), ...) of the last packet
+		self.dtype = None # one sample of every sensor, e.g. [('acc', '<f4', (3,)), ('gyro', '<f4', (3,))]
+		self.next_seq = None
+		self.lost = 0 # packets that never arrived
+		self._reported = 0
+		self._last_report = time.monotonic()
+
+	def decode(self, data):
+		"""Returns the sensors and the (samples, channels) samples of a packet."""
+		if len(data) < HEADER_DTYPE.itemsize:
+			raise ValueError("packet of {} bytes is shorter than its header".format(len(data)))
+		header = np.frombuffer(data, dtype=HEADER_DTYPE, count=1)[0]
+		if header['version'] != PACKET_VERSION:
+			raise ValueError("unknown packet version {}".format(header['version']))
+		samples_offset = HEADER_DTYPE.itemsize + SENSOR_DTYPE.itemsize * int(header['num_sensors'])
+		if len(data) < samples_offset:
+			raise ValueError("packet of {} bytes is too short for {} sensors".format(
+				len(data), header['num_sensors']))
+		sensors = np.frombuffer(data, dtype=SENSOR_DTYPE, count=header['num_sensors'],
+								offset=HEADER_DTYPE.itemsize)
+		sensors = tuple((sensor['id'].decode(), int(sensor['channels'])) for sensor in sensors)
+		size = samples_offset + 4 * sum(channels for id, channels in sensors) * int(header['num_samples'])
+		if len(data) != size:
+			raise ValueError("packet of {} bytes, its header says {}".format(len(data), size))
+		if sensors != self.sensors:
+			self.sensors = sensors
+			self.dtype = np.dtype([(id, '<f4', (channels,)) for id, channels in sensors])
+		samples = np.frombuffer(data, dtype=self.dtype, count=header['num_samples'],
+								offset=samples_offset)
+
+		seq = int(header['seq'])
+		if self.next_seq is not None:
+			self.lost += (seq - self.next_seq) % 2**32
+		self.next_seq = (seq + 1) % 2**32
+
+		# every field is float32, so the samples are rows of float32 channels
+		return sensors, samples.view('<f4').reshape(len(samples), -1)
+
+	def report(self):
+		"""Prints the number of lost packets, like DeviceReader.report()."""
+		now = time.monotonic()
+		if now - self._last_report < devicereader.REPORT_INTERVAL or self.lost == self._reported:
+			return
+		print("Lost {} UDP packets".format(self.lost))
+		self._reported = self.lost
+		self._last_report = now
+
+def parse_text(data):
+	"""Returns the sensors and the (1, channels) sample of a text packet, e.g.
+	&acc:1,2,3:&gyro:1,2,3: as sent by older versions of the mobile app."""
+	sensors = []
+	values = []
+	for sensor_string in data.decode().split("&")[1:]: # skip first entry to avoid reading into the ampersand
+		label_split = sensor_string.split(":")
+		data_list = label_split[1].split(",") # split comma-separated numbers
+		sensors.append((label_split[0], len(data_list)))
+		values += data_list
+	return tuple(sensors), np.array([values], dtype=np.float64)
+
+class FrameBuilder:
+	"""Collects the samples of the sensors into frames of FRAME_LENGTH samples.
+
+	A frame has a row per channel, followed by the channel index and a flag
+	that is 1 on the last channel. If the active sensors change, the frame
+	being collected is dropped and a new one starts.
+	"""
+
+	def __init__(self, length):
+		self.length = length
+		self.sensors = None
+		self.frame = None
+		self.count = 0 # samples in the frame so far
+		self.started = None # time the frame's first sample arrived
+
+	def _start(self, sensors):
+		if self.sensors is not None:
+			print("Active sensors changed from {} to {}, starting a new frame".format(self.sensors, sensors))
+		self.sensors = sensors
+		channels = sum(channels for id, channels in sensors)
+		self.frame = np.zeros((channels, self.length + 2))
+		self.frame[:, -2] = np.arange(channels) # example: x data with 0,0 at end signifying channel 0, and incomplete frame
+		self.frame[-1, -1] = 1
+		self.count = 0
 
-def exit_with_message(msg):
-	print(msg)
-	os._exit(0)
+	def add(self, sensors, samples, captured):
+		"""Adds (samples, channels) samples, returns a list of the frames they completed."""
+		if sensors != self.sensors:
+			self._start(sensors)
+		if self.count == 0:
+			self.started = captured
+
+		frames = []
+		done = 0
+		while done < len(samples):
+			num_samples = min(len(samples) - done, self.length - self.count)
+			self.frame[:, self.count:self.count + num_samples] = samples[done:done + num_samples].T
+			self.count += num_samples
+			done += num_samples
+			if self.count == self.length:
+				if captured > self.started:
+					print("Sample collection rate: {} Hz".format(self.length / (captured - self.started)))
+				frames.append(self.frame.copy())
+				self.count = 0
+				self.started = captured
+		return frames
 
 def mobile_data():
-	global frame_complete, is_collecting_dataset, \
-			training_data_frame_counter, frame, training_data, try_reconnecting
+	global is_collecting_dataset, training_data_frame_counter, training_data, last_received
 	try:
-	# note: the mobile device is expected to send data for each active sensor in batches, so that there are just as many accelerometer updates as gyro updates
-	# since the number of channels expected starts out unknown to this script, we must bump up the number of samples in need of collection to num_labels * framelength
-		if is_collecting_dataset:
-			print("Collecting {} training samples of size {}".format(INSTANCES, FRAME_LENGTH))
-		
-		tmpframe = []
-		unique_labels = set()
-		channels_per_sensor = dict()
-		flattened_sample_dict = dict() # values reset before each instance
-		num_labels_locked = False # we want to make sure the number of labels we get in this data collection 
-							      # does not suddenly have more labels than we're ok with
-		
-		# only do `INSTANCES` many reads if we are not in the dataset collection mode
-		instances_to_compute = INSTANCES if is_collecting_dataset else 1
-		for instance_idx in range(0, instances_to_compute):
-			now = time.time()
-			# wait on `framelength`-many reads
-			samples = list()
-			for i in range(0, FRAME_LENGTH):
-				# buffer size is 2048 bytes max
-				data = None
-				while data == None:
-					data, addr = sock.recvfrom(2048)
-					if data == None: 
-						print("UPD timed out...")
-					elif data[0] != 38 or data[-1] != 58: # must begin with ampersand and end with colon
-						print(data[-1])
-						print("CORRUPTED UDP PACKET: {}".format(data))
-						data = None
-				samples.append(data)
-			
-			# process our samples of sensor data
-			for sample in samples:
-				sample = str(sample)
-				sensor_split = sample.split("&") # example - &acc:1,2,3:&gyro:1,2,3:
-				for sensor_string in sensor_split[1:]: # skip first entry to avoid reading into the ampersand
-					label_split = sensor_string.split(":")
-					label = label_split[0]
-					data_list = label_split[1].split(",") # split comma-separated numbers
-					if not label in unique_labels: 
-						if num_labels_locked:
-							exit_with_message("Error: number of sensors broadcasting cannot change during collection (for label: {} among {})".format(label, unique_labels))
-						unique_labels.add(label)
-						flattened_sample_dict[label] = []
-						channels_per_sensor[label] = len(data_list) # for xyz on accelerometer, for example
-
-					flattened_sample_dict[label] += data_list
-				# once we read one message, we should know the number of sensors/labels.
-				# disallow new labels. if a sensor stops broadcasting, an error will arise later
-				num_labels_locked = True 
-
-			total_subchannels_added = 0 # to remember that we processed x and y, for example --> total = 2
-			keys = list(flattened_sample_dict.keys())
-			for key in keys:
-				channel_count = channels_per_sensor[key]
-				for c in range(0, channel_count):
-					is_final = 1 if (c == channel_count - 1) and key == keys[-1] else 0
-					# will encounter an error here if one of the sensors stopped sending its data in the middle of 
-					# the stream, because its row of data for at least one of its channels will not be long enough
-					tmpframe.append(flattened_sample_dict[key][c::channel_count] + [total_subchannels_added, is_final]) # example: x data with 0,0 at end signifying channel 0, and incomplete frame
-					total_subchannels_added += 1
-			
-			print("Sample collection rate: {} Hz".format(FRAME_LENGTH/(time.time() - now)))
-			# always write tmpframe to file to keep inference up to date
-			tmpframe = np.asarray(tmpframe)
-			np.save('tmpframe', tmpframe[:, -(FRAME_LENGTH + 2):]) # write last framelength chunk (+2 to account for channel indices)
-			
-			# only save to training file if in training state
-			if is_collecting_dataset:
-				training_data[0].append(tmpframe)
-				for key in flattened_sample_dict.keys():
-					flattened_sample_dict[key] = []
-
-			
-			# empty out tmpframe for next loop 
-			tmpframe = []
-		
-		# now that we have sent `instances` many frames, wrap it up 
-		if is_collecting_dataset:
-			is_collecting_dataset = False
-			f = open("current_label.txt", "r")
-			current_label = f.read().strip()
-			f.close()
-			
-			training_data_file_name = 'training_data_{}.npy'.format(current_label)
-			print('Saving training data to {}'.format(training_data_file_name))
-			if os.path.exists(os.path.join(os.getcwd(), training_data_file_name)):
-				existing_training_data = np.load(training_data_file_name)
-				np.save(training_data_file_name,
-						np.append(existing_training_data,
-						training_data,
-						axis=0))
-			else:
-				np.save(training_data_file_name, training_data)
-
-			# cleanup global variables
-			training_data = [[]]
-			
-			
+		received = reader.poll(timeout=command_check_interval)
+		if not received and time.monotonic() - last_received > udp_timeout:
+			print("UPD timed out...")
+			last_received = time.monotonic()
+
+		for data, captured in received:
+			last_received = captured
+			# a bad packet is dropped, the others drained with it are still used
+			try:
+				if data[:2] == PACKET_MAGIC:
+					sensors, samples = decoder.decode(data)
+				elif data[:1] == b'&' and data[-1:] == b':': # must begin with ampersand and end with colon
+					sensors, samples = parse_text(data)
+				else:
+					print("CORRUPTED UDP PACKET: {}".format(data))
+					continue
+			except Exception as e:
+				print("CORRUPTED UDP PACKET: {} - {}".format(data, e))
+				continue
+
+			for tmpframe in frame_builder.add(sensors, samples, captured):
+				# always publish tmpframe to keep inference up to date
+				framebus.publish(tmpframe, captured)
+
+				# only save to training file if in training state
+				if is_collecting_dataset:
+					training_data[0].append(tmpframe)
+					training_data_frame_counter += 1
+
+				# now that we have collected `instances` many frames, wrap it up
+				if is_collecting_dataset and training_data_frame_counter == INSTANCES:
+					is_collecting_dataset = False
+					training_data_frame_counter = 0
+					f = open("current_label.txt", "r")
+					current_label = f.read().strip()
+					f.close()
+
+					training_data_file_name = 'training_data_{}.npy'.format(current_label)
+					print('Saving training data to {}'.format(training_data_file_name))
+					# append the round to the label's data file, off the read loop
+					writer.append(training_data_file_name, training_data)
+
+					# cleanup global variables
+					training_data = [[]]
+
+		reader.report()
+		decoder.report()
+
 	except Exception as e:
 		print("EXCEPTION: {} - check disabled sensors / ip correctness".format(e))
 		return
 		
-# MAC/LINUX
-def receive_interrupt(signum, stack):
-	read_message()
-	# must immediately call mobile_data to ensure successful append to data
-	mobile_data() 
-
-def read_message():
-	cmd = None
-	try:
-		with open("ds_cmd.txt", "r+") as f:
-			cmd = f.read()			
-			if cmd == 'SPACEBAR':
-				global is_collecting_dataset
-				is_collecting_dataset = True
-			elif cmd == 'BYE':
-				f.write("")
-				f.close()
-				os._exit(0)
-			f.write("")
-			f.close()
-	except Exception as e:
-		print("Exception reading command", e)
-
-if utils.does_support_signals():
-	signal.signal(signal.SIGINT, receive_interrupt)
-
-	while True:
-		mobile_data() # collect a instances many framelengths
+def read_message(cmd):
+	"""Handles a data handler command sent by ui.py."""
+	if cmd == 'SPACEBAR':
+		global is_collecting_dataset
+		is_collecting_dataset = True
+		print("Collecting {} training samples of size {}".format(INSTANCES, FRAME_LENGTH))
+	elif cmd == 'BYE':
+		reader.close()
+		writer.close()
+		framebus.close()
+		commands.close()
+		os._exit(0)
 
-timeloop = Timeloop()
+# commands sent by ui.py
+commands = msgbus.CommandServer("ds")
 
-# add timeloop job to handle teensy commands
-@timeloop.job(interval=timedelta(seconds=0.3))
-def read_message_wrapper():
-	read_message()
+# the socket is read on its own thread, rounds are saved on another
+reader = devicereader.DeviceReader(receive, 'ds_mobile_udp')
+writer = datastore.Writer()
 
-# add timeloop job to collect and write teensy data
-@timeloop.job(interval=timedelta(seconds=0.2))
-def mobile_data_wrapper():
-	print("mobile data called")
-	mobile_data()
+decoder = PacketDecoder()
+frame_builder = FrameBuilder(FRAME_LENGTH)
+last_received = time.monotonic() # time the last packet arrived
 
-if not utils.does_support_signals():
-	timeloop.start(block=True)
+while True:
+	for cmd in commands.poll():
+		read_message(cmd)
+	mobile_data() # handle the packets received so far
@@ -26,23 +26,21 @@ not ``plug-and-play'' for performance.
 import os
 import sys
 import time
-import signal
 import configparser
-from datetime import timedelta
 import glob
 
 # Data processing
 import numpy as np
-from scipy import signal
 
 # serial
 import serial
 
-# for windows
-from timeloop import Timeloop
-
 # Self-define functions
-import utils
+import msgbus
+import framebus
+import datastore
+import devicereader
+import serialframes
 
 # write PID to file
 pidnum = os.getpid()
@@ -119,52 +117,40 @@ class FPSTracker:
         return 1.0 / self.delta
 
 
-# read a certain number of bytes from a data stream
-def readall(s, n):
-    res = bytearray()
-    while len(res) < n:
-        chunk = s.read(n - len(res))
-        if not chunk:
-            raise EOFError()
-        res += chunk
-    return res
-
-
-def resync():
-    res = bytearray()
-    while 1:
-        b = s.read(1)  # Should make s a parameter to stay consistent with readall function
-        if not b:
-            raise EOFError()
-        res += b
-        if res.endswith(b'\xde\xad\xbe\xef'):
-            break
-    return res
-
-
-def getframe(instances):
-    # fps = FPSTracker()
-    counter = 0
-    tmpframe = []
-    frame = []
-    frame_complete = 0
-    now = time.time()
-    while np.shape(frame)[0] < instances:
-        discarded = resync()
-        arr = np.frombuffer(readall(f, framelength), dtype='uint16')
-        if arr[-1] == 0:
-            tmpframe.append(arr)
-        if arr[-1] == 1:
-            tmpframe.append(arr)
-            frame_complete = 1
-        if frame_complete == 1 and np.shape(tmpframe)[0] == 3:
-            tmpframe = np.asarray(tmpframe)
-            tmpframe = tmpframe[tmpframe[:, -2].argsort()]
-            frame.append(tmpframe)
-            frame_complete = 0
-            tmpframe = []
-    end = time.time()
-    return frame
+class ChannelFrame:
+    """Assembles the channel packets of the Teensy into frames.
+
+    Each packet is one channel: samplelength uint16 samples, then the
+    channel index and a flag that is 1 on the last channel of a frame. The
+    channels are copied into a preallocated array and sorted by their
+    index into another one when the last channel arrives.
+    """
+
+    def __init__(self, numchannels, samplelength):
+        self.rows = np.zeros((numchannels, samplelength + 2), dtype=np.uint16)
+        self.frame = np.zeros_like(self.rows)
+        self.count = 0
+
+    def add(self, packet):
+        """Adds a channel packet, returns the frame if it completed one, else None.
+
+        The frame is overwritten by the next one, copy it to keep it.
+        """
+        arr = np.frombuffer(packet, dtype=np.uint16)
+        if self.count == len(self.rows):
+            # the last channel got lost, start over
+            self.count = 0
+        self.rows[self.count] = arr
+        self.count += 1
+        if arr[-1] != 1:
+            return None
+
+        complete = self.count == len(self.rows)
+        self.count = 0
+        if not complete:
+            return None
+        np.take(self.rows, np.argsort(self.rows[:, -2], kind='stable'), axis=0, out=self.frame)
+        return self.frame
 
 
 is_collecting_dataset = False
@@ -205,9 +191,7 @@ if sys.platform.startswith('win'):
 
 
 instances = 10
-tmpframe = []
 frame = []
-frame_complete = 0
 save_frames = 0
 training_data = [[]]
 training_data_frame_counter = 0
@@ -215,119 +199,100 @@ samplelength = 1500
 headerlength = 4
 framelength = int(samplelength*2+headerlength)
 numchannels = 3
+sync = b'\xde\xad\xbe\xef'
+parser = serialframes.PacketParser(sync, framelength)
+channel_frame = ChannelFrame(numchannels, samplelength)
+read_size = 16 * 1024           # most bytes taken from the port in one read
+command_check_interval = 0.05   # sec to wait for data before checking for commands
 print("Starting Teensy")
 
 
+def read_serial():
+    """Everything the port has buffered, in one read. Runs on the reader thread."""
+    return s.read(max(1, min(s.in_waiting, read_size)))
+
+
 def teensy_data():
     """Getting data from teensy, saving # of instances of data as tmpframe"""
-    global tmpframe, frame_complete, is_collecting_dataset, \
-        training_data_frame_counter, save_frames, frame, training_data, instances
     try:
-        now = time.time()
-        discarded = resync()
-        arr = np.frombuffer(readall(s, framelength), dtype='uint16')
-        if arr[-1] == 0:
-            tmpframe.append(arr)
-        if arr[-1] == 1:
-            tmpframe.append(arr)
-            frame_complete = 1
-        
-        if frame_complete == 1 and np.shape(tmpframe)[0] == numchannels:
-            tmpframe = np.asarray(tmpframe)
-
-            tmpframe = tmpframe[tmpframe[:, -2].argsort()]
-            np.save('tmpframe', tmpframe)
-
-            if is_collecting_dataset and training_data_frame_counter < instances:
-                training_data[0].append(tmpframe)
-                training_data_frame_counter += 1
-
-            if training_data_frame_counter == instances:
-                print('Done collecting training data, saving NOW')
-                training_data_frame_counter = 0
-
-                # get label
-                f = open("current_label.txt", "r")
-                current_label = f.read().strip()
-                f.close()
-
-                training_data_file_name = 'training_data_{}.npy'.format(current_label)
-
-                print('Saving Training Data...')
-
-                if os.path.exists(os.path.join(os.getcwd(), training_data_file_name)):
-                    existing_training_data = np.load(training_data_file_name)
-
-                    np.save(training_data_file_name,
-                            np.append(existing_training_data, training_data, axis=0))
-                else:
-                    np.save(training_data_file_name, training_data)
-                training_data = [[]]
-                is_collecting_dataset = False
-
-                print('Training Data SAVED!!!')
-
-            if save_frames == 1 and np.shape(frame)[0] < instances:
-                frame.append(tmpframe)
-
-            elif np.shape(frame)[0] == instances:
-                dataset.append(frame)
-                save_frames = 0
-                frame = []
-            tmpframe = []
-        end = time.time()
-
+        for chunk, captured in reader.poll(timeout=command_check_interval):
+            parser.feed(chunk)
+            # the frame is published after its last channel arrived
+            for packet in parser.packets():
+                tmpframe = channel_frame.add(packet)
+                if tmpframe is not None:
+                    frame_done(tmpframe, captured)
+        reader.report()
     except Exception as e:
         print(e)
+        if not reader.alive():
+            close()
         return
 
 
-# MAC/LINUX
-def receive_interrupt(signum, stack):
-    read_message()
+def frame_done(tmpframe, captured):
+    """Publishes a complete frame and collects it while collecting."""
+    global is_collecting_dataset, training_data_frame_counter, save_frames, \
+        frame, training_data
+    framebus.publish(tmpframe, captured)
 
+    if is_collecting_dataset and training_data_frame_counter < instances:
+        training_data[0].append(tmpframe.copy())
+        training_data_frame_counter += 1
 
-def read_message():
-    try:
-        f = open("ds_cmd.txt", "w")
-        cmd = f.read()
-    except Exception as e:
-        return
-        
-    if cmd == 'SPACEBAR':
-        global is_collecting_dataset
-        is_collecting_dataset = True
-    elif cmd == 'BYE':
-        print("Teensy closing")
-        f.write("")
+    if training_data_frame_counter == instances:
+        print('Done collecting training data, saving NOW')
+        training_data_frame_counter = 0
+
+        # get label
+        f = open("current_label.txt", "r")
+        current_label = f.read().strip()
         f.close()
-        os._exit(0)
-        
-    f.write("")
-    f.close()
 
+        training_data_file_name = 'training_data_{}.npy'.format(current_label)
+
+        print('Saving Training Data...')
+
+        # append the round to the label's data file, off the read loop
+        writer.append(training_data_file_name, training_data)
+        training_data = [[]]
+        is_collecting_dataset = False
 
-if utils.does_support_signals():
-    signal.signal(signal.SIGINT, receive_interrupt)
+    if save_frames == 1 and np.shape(frame)[0] < instances:
+        frame.append(tmpframe.copy())
 
-    while True:
-        teensy_data()
+    elif np.shape(frame)[0] == instances:
+        dataset.append(frame)
+        save_frames = 0
+        frame = []
 
 
-timeloop = Timeloop()
+def read_message(cmd):
+    """Handles a data handler command sent by ui.py."""
+    if cmd == 'SPACEBAR':
+        global is_collecting_dataset
+        is_collecting_dataset = True
+    elif cmd == 'BYE':
+        close()
 
-# add timeloop job to handle teensy commands
-@timeloop.job(interval=timedelta(seconds=0.3))
-def read_message_wrapper():
-    read_message()
 
+def close():
+    print("Teensy closing")
+    reader.close()
+    writer.close()
+    framebus.close()
+    commands.close()
+    os._exit(0)
 
-# add timeloop job to collect and write teensy data
-@timeloop.job(interval=timedelta(seconds=0.2))
-def teensy_data_wrapper():
-    teensy_data()
 
+# commands sent by ui.py
+commands = msgbus.CommandServer("ds")
 
-if not utils.does_support_signals():
-    timeloop.start(block=True)
+# the port is read on its own thread, rounds are saved on another
+reader = devicereader.DeviceReader(read_serial, 'ds_teensy', maxsize=1024)
+writer = datastore.Writer()
 
+while True:
+    for cmd in commands.poll():
+        read_message(cmd)
+    teensy_data()
@@ -0,0 +1,91 @@
+"""
+featcache.py
+
+On-disk cache of featurized training data used by ml.py, so TRAIN, CONFUSION
+and FEATURE_IMPORTANCE only featurize rounds they have not seen before.
+
+Features are cached per label in features_<label>.npz, next to the training
+data files. An entry is only reused when it was made with the same settings
+key (featurization type, NUM_BINS, SAMPLE_RATE and the shape and dtype of a
+round) and the rounds it was made from are still byte for byte the same, which
+is checked with an md5 digest of the raw data. Collecting more rounds for a
+label only featurizes the new rounds and appends them to the entry.
+"""
+import hashlib
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+HASH_BLOCK_BYTES = 16 * 1024 * 1024     # raw data hashed at a time
+
+
+def settings_key(*settings):
+    """Hash of everything besides the data that changes the features."""
+    text = repr((FORMAT_VERSION,) + tuple(settings))
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def _hash_rounds(hasher, rounds):
+    """Feeds the raw bytes of rounds to hasher, a block at a time.
+
+    rounds may be memory-mapped, only one block is read into memory at once.
+    """
+    block = max(1, HASH_BLOCK_BYTES // max(1, rounds[:1].nbytes))
+    for start in range(0, rounds.shape[0], block):
+        hasher.update(np.ascontiguousarray(rounds[start:start + block]).reshape(-1).view(np.uint8))
+
+
+def cache_file(label):
+    return 'features_{}.npz'.format(label)
+
+
+class FeatureCache:
+    """Featurized rounds of every label, for one settings key."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def _load(self, label, data_key):
+        """Returns (rounds, digest, features) of the cached entry for label."""
+        try:
+            with np.load(cache_file(label)) as entry:
+                if str(entry['key']) != self.key or str(entry['data_key']) != data_key:
+                    return 0, None, None
+                return int(entry['rounds']), str(entry['digest']), entry['features']
+        except (OSError, KeyError, ValueError):
+            return 0, None, None
+
+    def features(self, label, rounds, featurize):
+        """Returns featurize(rounds) for the rounds of one label.
+
+        rounds is a (rounds, instances, ...) array, it may be memory-mapped.
+        featurize maps such an array to (rounds * instances, features) and is
+        only called for rounds that are not cached yet.
+        """
+        num_rounds = rounds.shape[0]
+        data_key = settings_key(rounds.shape[1:], rounds.dtype.str)
+
+        # reuse the cached rounds if they are an unchanged prefix of rounds
+        usable = 0
+        hasher = hashlib.md5()
+        cached_rounds, cached_digest, cached = self._load(label, data_key)
+        if cached is not None and 0 < cached_rounds <= num_rounds:
+            _hash_rounds(hasher, rounds[:cached_rounds])
+            if hasher.hexdigest() == cached_digest:
+                usable = cached_rounds
+            else:
+                hasher = hashlib.md5()
+
+        if usable == num_rounds:
+            return cached
+
+        if usable == 0:
+            features = featurize(rounds)
+        else:
+            features = np.concatenate([cached, featurize(rounds[usable:])])
+        _hash_rounds(hasher, rounds[usable:])
+
+        np.savez(cache_file(label), key=self.key, data_key=data_key,
+                 rounds=num_rounds, digest=hasher.hexdigest(), features=features)
+        return features
@@ -0,0 +1,332 @@
+"""
+framebus.py
+
+Shared-memory ring buffer that carries live frames from the data handler to
+ui.py and ml.py. Replaces the tmpframe.npy file.
+
+There is a single producer (the data handler) and any number of consumers.
+The producer never waits on a consumer: every frame is copied once into the
+next slot of the ring and stamped with a sequence number. Consumers either
+grab the latest frame or walk the sequence numbers to see every frame. Each
+slot carries the sequence number twice (written before and after the
+payload), so a reader can always tell when a slot was overwritten while it
+was copying it and never returns a half-written frame.
+
+Layout of the shared memory segment:
+
+    header   HEADER_FIELDS int64
+    meta     capacity x META_FIELDS int64 (sequence numbers, shape, dtype, timestamps)
+    payload  capacity x slot_bytes bytes
+
+Every frame is stamped with the time.monotonic() its newest samples arrived
+at the data handler and the time it was published, so consumers can tell
+how old a frame is (see latency.py).
+
+The data handler also announces every frame of the session's bus on the
+msgbus channel NOTIFY_NAME, so a consumer can sleep until a frame arrives
+(see subscribe()) instead of checking the sequence number in a loop.
+"""
+from multiprocessing import shared_memory
+import time
+import os
+
+import numpy as np
+
+import utils
+import msgbus
+
+if os.name == 'posix':
+    from multiprocessing import resource_tracker
+
+
+DEFAULT_CAPACITY = 64           # frames kept in the ring
+MIN_SLOT_BYTES = 64 * 1024      # smallest payload size of a slot
+MAX_DIMS = 4                    # frames have at most 4 dimensions
+NOTIFY_NAME = 'frames'          # msgbus channel announcing the frames of the session's bus
+
+MAGIC = 0x54345442              # "T4TB"
+
+# header fields
+H_MAGIC, H_CAPACITY, H_SLOT_BYTES, H_HEAD, H_CLOSED = range(5)
+HEADER_FIELDS = 8
+
+# per slot meta fields, the dtype string takes the last two fields
+M_SEQ_BEGIN, M_SEQ_END, M_NBYTES, M_NDIM = range(4)
+M_SHAPE = 4
+M_DTYPE = M_SHAPE + MAX_DIMS
+M_CAPTURED = M_DTYPE + 2        # time.monotonic_ns() the samples arrived
+M_PUBLISHED = M_CAPTURED + 1    # time.monotonic_ns() the frame was published
+META_FIELDS = 16
+DTYPE_BYTES = 16
+
+
+def default_name():
+    """Name of the frame bus for the T4Train session in the current dir."""
+    return 't4t_frames_{}'.format(utils.session_id())
+
+
+# segments created by this process
+_owned = set()
+
+
+def _attach(name):
+    """Opens an existing segment without taking ownership of it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always tracks the segment
+        shm = shared_memory.SharedMemory(name=name)
+
+    # readers must not unlink the producer's segment when they exit
+    if os.name == 'posix' and name not in _owned:
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+    return shm
+
+
+class _Ring:
+    """NumPy views onto a frame bus segment."""
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        self.capacity = int(self.header[H_CAPACITY])
+        self.slot_bytes = int(self.header[H_SLOT_BYTES])
+
+        meta_offset = HEADER_FIELDS * 8
+        self.meta = np.ndarray((self.capacity, META_FIELDS), dtype=np.int64,
+                               buffer=shm.buf, offset=meta_offset)
+
+        payload_offset = meta_offset + self.capacity * META_FIELDS * 8
+        self.payload = np.ndarray((self.capacity, self.slot_bytes), dtype=np.uint8,
+                                  buffer=shm.buf, offset=payload_offset)
+
+    @staticmethod
+    def size(capacity, slot_bytes):
+        return (HEADER_FIELDS + capacity * META_FIELDS) * 8 + capacity * slot_bytes
+
+    def release(self):
+        # drop the views before closing, mmap refuses to close while exported
+        self.header = self.meta = self.payload = None
+        self.shm.close()
+
+
+class FrameWriter:
+    """Producer side of the frame bus, owned by the data handler."""
+
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY):
+        self.name = name or default_name()
+        self.capacity = capacity
+        self._ring = None
+
+    def _create(self, slot_bytes):
+        # remove a segment left behind by a previous session
+        try:
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+
+        shm = shared_memory.SharedMemory(name=self.name, create=True,
+                                         size=_Ring.size(self.capacity, slot_bytes))
+        _owned.add(self.name)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[H_CAPACITY] = self.capacity
+        header[H_SLOT_BYTES] = slot_bytes
+        header[H_MAGIC] = MAGIC
+        del header
+
+        ring = _Ring(shm)
+        ring.meta[:] = 0
+        return ring
+
+    def publish(self, frame, captured=None):
+        """Copies frame into the next slot and returns its sequence number.
+
+        captured is the time.monotonic() the newest samples of the frame
+        arrived, the time of publishing if None.
+        """
+        published = time.monotonic_ns()
+        frame = np.ascontiguousarray(frame)
+        if frame.dtype.hasobject:
+            raise ValueError('framebus: object arrays cannot be shared')
+        if frame.ndim > MAX_DIMS:
+            raise ValueError('framebus: frames have at most {} dims'.format(MAX_DIMS))
+
+        # the ring is sized from the first frame, grow it if a frame outgrows it
+        if self._ring is None or frame.nbytes > self._ring.slot_bytes:
+            head = 0
+            if self._ring is not None:
+                head = int(self._ring.header[H_HEAD])
+                self.close()
+            self._ring = self._create(max(MIN_SLOT_BYTES, 2 * frame.nbytes))
+            self._ring.header[H_HEAD] = head
+
+        ring = self._ring
+        seq = int(ring.header[H_HEAD]) + 1
+        meta = ring.meta[seq % ring.capacity]
+
+        # mark slot as being written, readers holding the old frame will notice
+        meta[M_SEQ_BEGIN] = seq
+        meta[M_NBYTES] = frame.nbytes
+        meta[M_NDIM] = frame.ndim
+        meta[M_SHAPE:M_SHAPE + MAX_DIMS] = 0
+        meta[M_SHAPE:M_SHAPE + frame.ndim] = frame.shape
+        meta[M_DTYPE:M_DTYPE + 2] = np.frombuffer(
+            frame.dtype.str.encode().ljust(DTYPE_BYTES, b'\0'), dtype=np.int64)
+        meta[M_CAPTURED] = published if captured is None else int(captured * 1e9)
+        meta[M_PUBLISHED] = published
+        ring.payload[seq % ring.capacity, :frame.nbytes] = frame.reshape(-1).view(np.uint8)
+
+        # frame complete
+        meta[M_SEQ_END] = seq
+        ring.header[H_HEAD] = seq
+        return seq
+
+    def close(self):
+        """Marks the bus closed and removes the segment."""
+        if self._ring is None:
+            return
+        self._ring.header[H_CLOSED] = 1
+        shm = self._ring.shm
+        self._ring.release()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        _owned.discard(self.name)
+        self._ring = None
+
+
+class FrameReader:
+    """Consumer side of the frame bus, used by ui.py and ml.py.
+
+    A reader attaches lazily, so it can be created before the data handler
+    has published its first frame. `latest()` returns the newest frame,
+    `next()` returns every frame in order and counts the ones it missed
+    because the ring wrapped around before they were read. `captured` and
+    `published` are the timestamps of the last frame read.
+    """
+
+    def __init__(self, name=None):
+        self.name = name or default_name()
+        self.last_seq = 0
+        self.dropped = 0
+        self.captured = None
+        self.published = None
+        self._ring = None
+
+    def _connected(self):
+        if self._ring is not None and self._ring.header[H_CLOSED]:
+            # the producer replaced or closed the segment
+            self._ring.release()
+            self._ring = None
+
+        if self._ring is None:
+            try:
+                ring = _Ring(_attach(self.name))
+            except (FileNotFoundError, ValueError):
+                return False
+            if ring.header[H_MAGIC] != MAGIC or ring.header[H_CLOSED]:
+                ring.release()
+                return False
+            self._ring = ring
+            if ring.header[H_HEAD] < self.last_seq:
+                # new producer, start counting from scratch
+                self.last_seq = 0
+        return True
+
+    @property
+    def head(self):
+        """Sequence number of the newest frame, 0 if nothing was published."""
+        if not self._connected():
+            return 0
+        return int(self._ring.header[H_HEAD])
+
+    def read(self, seq):
+        """Returns a copy of frame seq, or None if it is gone or not written yet."""
+        if seq <= 0 or not self._connected():
+            return None
+        ring = self._ring
+        meta = ring.meta[seq % ring.capacity]
+        if meta[M_SEQ_END] != seq:
+            return None
+
+        nbytes = int(meta[M_NBYTES])
+        shape = tuple(int(n) for n in meta[M_SHAPE:M_SHAPE + int(meta[M_NDIM])])
+        dtype = meta[M_DTYPE:M_DTYPE + 2].tobytes().rstrip(b'\0').decode()
+        captured, published = int(meta[M_CAPTURED]), int(meta[M_PUBLISHED])
+        data = ring.payload[seq % ring.capacity, :nbytes].copy()
+
+        # the producer lapped us while copying
+        if meta[M_SEQ_BEGIN] != seq:
+            return None
+        self.captured, self.published = captured / 1e9, published / 1e9
+        return data.view(np.dtype(dtype)).reshape(shape)
+
+    def latest(self):
+        """Returns (seq, frame) for the newest frame or (0, None)."""
+        for _ in range(3):
+            seq = self.head
+            if seq == 0:
+                return 0, None
+            frame = self.read(seq)
+            if frame is not None:
+                self.last_seq = seq
+                return seq, frame
+        return 0, None
+
+    def next(self):
+        """Returns the frame after the last one read, or None if none is new."""
+        head = self.head
+        while self.last_seq < head:
+            seq = max(self.last_seq + 1, head - self._ring.capacity + 1)
+            self.dropped += seq - self.last_seq - 1
+            self.last_seq = seq
+            frame = self.read(seq)
+            if frame is not None:
+                return frame
+            # overwritten while reading, skip it
+            self.dropped += 1
+        return None
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.release()
+            self._ring = None
+
+
+# ============= Default bus of the current session ========
+_writer = None
+_notifier = None
+
+
+def publish(frame, captured=None):
+    """Publishes a frame on the session's frame bus (data handler side)."""
+    global _writer, _notifier
+    if _writer is None:
+        _writer = FrameWriter()
+        # a subscriber that is behind only needs one wake up, the others are dropped
+        _notifier = msgbus.Publisher(NOTIFY_NAME, maxsize=1)
+    seq = _writer.publish(frame, captured)
+    _notifier.publish(seq)
+    return seq
+
+
+def subscribe(callback):
+    """Calls callback(seq) on a background thread when a frame is published
+    on the session's bus. Several frames may be announced by one call, read
+    the bus to see them all. Returns the msgbus.Subscriber."""
+    return msgbus.Subscriber(NOTIFY_NAME, callback=callback)
+
+
+def close():
+    """Removes the session's frame bus, called when the data handler exits."""
+    if _writer is not None:
+        _writer.close()
+    if _notifier is not None:
+        _notifier.close()
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# ============================================================================
+"""
+headless.py
+
+Runs T4Train without the Qt UI, e.g. on a server without a display.
+
+Starts the data handler picked in config.ini and ml.py like ui.py does and
+drives them over the msgbus with the same commands ui.py sends for its keys.
+Pipeline can be used from other Python code; run as a script it reads one
+command per line from stdin:
+
+    label <name>        select the label to collect (default: the first)
+    collect [name]      collect a round of INSTANCES frames (Space)
+    delete [name]       delete the last round of a label (Backspace)
+    train               train, or retrain while predicting (T)
+    stop                stop predicting
+    algo <index>        switch the ML algorithm (M)
+    feat <name>         switch the featurization, e.g. feat FFT
+    save                save the training data and model (S)
+    load [dir]          load saved training data and its model (L)
+    confusion           write the confusion matrix (C)
+    importance          write the feature importances (I)
+    quit
+
+Every prediction is pushed by ml.py on the 'predictions' channel. They are
+printed to stdout, one line per prediction, or with --serve PORT sent to
+every TCP client as JSON lines.
+"""
+# ============================================================================
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import socket
+import argparse
+import threading
+import subprocess
+import configparser
+
+# Self-define functions
+import utils
+import msgbus
+import datastore
+import latency
+
+#================================================================
+# read in configuration
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+LABELS = config['GLOBAL']['LABELS'][1:-1].split(', ')
+INSTANCES = int(config['GLOBAL']['INSTANCES'])
+ALGOS = config['GLOBAL']['ALGOS'][1:-1].split(', ')
+DS_HANDLERS = config['DS']['DS_HANDLERS'][1:-1].split(', ')
+DS_FILENAMES = config['DS']['DS_FILENAMES'][1:-1].split(', ')
+DS_FILE_NUM = int(config['DS']['DS_FILE_NUM'])
+LATENCY_LOG_INTERVAL = float(config['ML'].get('LATENCY_LOG_INTERVAL', 0))
+#================================================================
+
+SESSION_FILES = [".npy", ".txt", ".png", ".wav"]
+SESSION_FILE_PATTERNS = ["training_data.json", "features_*.npz"]  # manifest and feature cache
+STARTUP_TIMEOUT = 60    # sec for the subprocesses to write their pid numbers
+COLLECT_TIMEOUT = 60    # sec for the data handler to save a round
+POLL_INTERVAL = 0.01    # sec
+
+
+def sanitize(label):
+    """Label as it appears in training data file names."""
+    return label.lower().strip().replace(" ", "_")
+
+
+class Pipeline:
+    """A data handler and ml.py, controlled without the UI."""
+
+    def __init__(self, ds_filename, labels=LABELS):
+        self.ds_filename = ds_filename
+        self.labels = list(labels)
+        self.current_label = self.labels[0]
+        self.algo_index = int(config['GLOBAL']['CURR_ALGO_INDEX'])
+        self.is_predicting = False
+
+        self.feature = utils.Featurization.Raw
+        if "microphone" in ds_filename:
+            self.feature = utils.Featurization.FFT
+
+        # delete any existing files from a previous session
+        utils.delete_files_ending_in(SESSION_FILES)
+        utils.delete_files_matching(SESSION_FILE_PATTERNS)
+        self.write_featurization()
+
+        self.ds_subprocess = subprocess.Popen([sys.executable, "{}.py".format(ds_filename)])
+        self.ml_subprocess = subprocess.Popen([sys.executable, "ml.py"])
+        self.ds_pid = self._wait_for_pid("ds_pidnum.txt", self.ds_subprocess)
+        self.ml_pid = self._wait_for_pid("ml_pidnum.txt", self.ml_subprocess)
+
+        # command channels to the ML and data handler processes
+        self.ml_bus = msgbus.CommandClient("ml")
+        self.ds_bus = msgbus.CommandClient("ds")
+
+        # progress of long ML tasks and every prediction, in one queue
+        self._events = queue.Queue()
+        self.ml_events = msgbus.Subscriber("ml_events", callback=self._events.put)
+        self.predictions = msgbus.Subscriber("predictions", callback=self._prediction_received)
+        self.latency_stats = latency.LatencyStats("headless.py", LATENCY_LOG_INTERVAL)
+
+    def _wait_for_pid(self, filename, process):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("{} exited with code {}".format(
+                    " ".join(process.args), process.returncode))
+            try:
+                return utils.read_pid_num(filename)
+            except (OSError, ValueError):
+                time.sleep(POLL_INTERVAL)
+        raise RuntimeError("{} did not start within {} sec".format(
+            " ".join(process.args), STARTUP_TIMEOUT))
+
+    def write_featurization(self):
+        with open("feat.txt", "w") as f:
+            f.write(self.feature.value)
+
+    def set_featurization(self, name):
+        """Featurization used by the next training, by name or value (e.g. FFT)."""
+        for feature in utils.Featurization:
+            if name.lower() in (feature.name.lower(), feature.value.lower()):
+                self.feature = feature
+                self.write_featurization()
+                return feature
+        raise ValueError("unknown featurization {}".format(name))
+
+    def set_label(self, label):
+        if sanitize(label) not in [sanitize(l) for l in self.labels]:
+            raise ValueError("unknown label {}, the labels are {}".format(
+                label, ", ".join(self.labels)))
+        self.current_label = label
+
+    def training_data_file(self, label=None):
+        return 'training_data_{}.npy'.format(sanitize(label or self.current_label))
+
+    def num_rounds(self, label=None):
+        """Rounds collected for label (default: the current label)."""
+        filename = self.training_data_file(label)
+        if not os.path.exists(filename):
+            return 0
+        return datastore.num_rounds(filename)
+
+    def collect(self, label=None):
+        """Collects a round of INSTANCES frames, returns the rounds of the label."""
+        if label is not None:
+            self.set_label(label)
+        self.stop_predicting()
+        utils.write_label(self.current_label, "current_label.txt")
+        num_collected = self.num_rounds()
+
+        # tell the data handler to collect, then wait until it saved the round
+        self.ds_bus.send("SPACEBAR")
+        deadline = time.monotonic() + COLLECT_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.ds_subprocess.poll() is not None:
+                raise RuntimeError("{}.py exited".format(self.ds_filename))
+            try:
+                if self.num_rounds() == num_collected + 1:
+                    return num_collected + 1
+            except (OSError, ValueError):
+                pass # the handler is writing the file
+            time.sleep(POLL_INTERVAL)
+        raise RuntimeError("no round was collected within {} sec".format(COLLECT_TIMEOUT))
+
+    def delete(self, label=None):
+        """Deletes the last round of label (default: the current label)."""
+        if label is not None:
+            self.set_label(label)
+        self.stop_predicting()
+        num_collected = self.num_rounds()
+        if num_collected > 0:
+            datastore.truncate(self.training_data_file(), num_collected - 1)
+        return max(0, num_collected - 1)
+
+    def prepare_ml_input_files(self):
+        """Create training_data.json, the manifest of the training data, for training."""
+        try:
+            os.remove("training_data.json")
+        except OSError:
+            pass
+        training_data_files, labels = utils.get_training_data_files_and_labels(self.labels)
+        if not training_data_files:
+            raise RuntimeError("no training data, collect some rounds first")
+        utils.compile_all_training_data(training_data_files, "training_data.json")
+
+    def train(self):
+        """Trains on all collected rounds and starts predicting.
+
+        While predicting, the current model keeps predicting until the new one
+        is trained.
+        """
+        self.prepare_ml_input_files()
+        self.ml_bus.send("TRAIN")
+        self.is_predicting = True
+
+    def stop_predicting(self):
+        if self.is_predicting:
+            self.is_predicting = False
+            self.ml_bus.send("STOP PREDICTING")
+
+    def toggle_algo(self, index=None):
+        """Switches to ALGOS[index], or the next algorithm. Needs a new training."""
+        if index is None:
+            index = utils.increment_algo_ind(self.algo_index, ALGOS)
+        if not 0 <= index < len(ALGOS):
+            raise ValueError("algo index must be 0 to {}".format(len(ALGOS) - 1))
+        self.algo_index = index
+        self.is_predicting = False
+        self.ml_bus.send("TOGGLE_ALGO_" + str(index))
+        return ALGOS[index]
+
+    def save(self):
+        """Saves the training data and the model to saved_files/<time>/."""
+        curr_time = time.strftime("%Y_%m_%d-%H_%M")
+        dirname = os.path.join("saved_files", curr_time)
+        os.makedirs(dirname, exist_ok=True)
+
+        # tell ml to save model
+        self.ml_bus.send("SAVE, {}".format(curr_time))
+
+        for item in os.listdir(os.getcwd()):
+            if item.startswith('training_data_') and item.endswith('.npy'):
+                shutil.copy(item, dirname)
+        return dirname
+
+    def load(self, dirname="saved_files/import/"):
+        """Loads saved training data, and predicts with its model if it has one.
+
+        Returns True if a saved model was loaded.
+        """
+        if not os.path.isdir(dirname):
+            raise RuntimeError("no such path {}".format(dirname))
+        self.stop_predicting()
+        for item in os.listdir(dirname):
+            if os.path.isfile(os.path.join(dirname, item)):
+                shutil.copy(os.path.join(dirname, item), os.getcwd())
+
+        if os.path.isdir(os.path.join(dirname, "model_bundle")):
+            self.ml_bus.send("LOAD_MODEL, {}".format(os.path.join(dirname, "model_bundle")))
+            self.is_predicting = True
+            return True
+        return False
+
+    def confusion_matrix(self):
+        self.prepare_ml_input_files()
+        self.ml_bus.send("CONFUSION")
+
+    def feature_importance(self):
+        self.prepare_ml_input_files()
+        self.ml_bus.send("FEATURE_IMPORTANCE")
+
+    def _prediction_received(self, prediction):
+        self._events.put(dict(prediction, task='prediction'))
+
+    def events(self, timeout=None):
+        """Events from ml.py received within timeout sec, oldest first.
+
+        Predictions are events with task 'prediction', they only come through
+        while predicting. A model that failed to load stops predicting.
+        """
+        try:
+            events = [self._events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while not self._events.empty():
+            events.append(self._events.get())
+
+        kept = []
+        for event in events:
+            if event.get('task') == 'prediction':
+                if not self.is_predicting:
+                    continue
+                self.latency_stats.since('display', event['predicted'])
+                self.latency_stats.since('total', event['captured'])
+            elif event.get('task') == 'load' and event['total'] == 0:
+                self.is_predicting = False
+            kept.append(event)
+        return kept
+
+    def processes_alive(self):
+        return self.ds_subprocess.poll() is None and self.ml_subprocess.poll() is None
+
+    def close(self):
+        """Stops the data handler and ml.py and deletes the session files."""
+        for bus, process in ((self.ds_bus, self.ds_subprocess), (self.ml_bus, self.ml_subprocess)):
+            if process.poll() is None:
+                bus.send("BYE")
+            bus.close()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.ml_events.close()
+        self.predictions.close()
+        utils.delete_files_ending_in(SESSION_FILES)
+        utils.delete_files_matching(SESSION_FILE_PATTERNS)
+
+
+class PredictionServer:
+    """Sends events as JSON lines to every client connected to a TCP port.
+
+    A client that cannot keep up or hangs up is disconnected.
+    """
+
+    def __init__(self, port, host=''):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen()
+        self._clients = []
+        self._lock = threading.Lock()
+
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            client.settimeout(1)
+            with self._lock:
+                self._clients.append(client)
+
+    def send(self, event):
+        line = (json.dumps(event) + '\n').encode()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.sendall(line)
+            except OSError:
+                client.close()
+                with self._lock:
+                    self._clients.remove(client)
+
+    def close(self):
+        self._socket.close()
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+
+
+def print_event(event):
+    """One line of stdout per prediction or message from ml.py."""
+    if event.get('task') == 'prediction':
+        probability = ""
+        if event['probabilities'] is not None:
+            probability = " {:.2f}".format(event['probabilities'][event['label']])
+        print("prediction {} {}{} ({:.1f} ms)".format(
+            event['seq'], event['label'], probability,
+            1000 * (time.monotonic() - event['captured'])), flush=True)
+    elif event.get('task') == 'load' and event['total'] == 0:
+        print("could not load the saved model, train first", flush=True)
+    elif event.get('task') == 'confusion' and event['total'] > 0 \
+            and event['done'] == event['total']:
+        print("confusion matrix written to file", flush=True)
+
+
+def run_command(pipeline, line):
+    """Runs one command line, returns False on quit."""
+    words = line.split(maxsplit=1)
+    if not words:
+        return True
+    cmd, arg = words[0].lower(), (words[1].strip() if len(words) > 1 else None)
+
+    if cmd in ('quit', 'exit', 'bye'):
+        return False
+    elif cmd == 'label':
+        pipeline.set_label(arg)
+        print("label {}".format(pipeline.current_label))
+    elif cmd == 'collect':
+        rounds = pipeline.collect(arg)
+        print("collected {} rounds of {}".format(rounds, pipeline.current_label))
+    elif cmd == 'delete':
+        rounds = pipeline.delete(arg)
+        print("{} rounds of {} left".format(rounds, pipeline.current_label))
+    elif cmd == 'train':
+        pipeline.train()
+        print("training with {} on {} features".format(
+            ALGOS[pipeline.algo_index], pipeline.feature.value))
+    elif cmd == 'stop':
+        pipeline.stop_predicting()
+    elif cmd == 'algo':
+        print("algorithm {}".format(pipeline.toggle_algo(int(arg) if arg else None)))
+    elif cmd == 'feat':
+        print("featurization {}".format(pipeline.set_featurization(arg).value))
+    elif cmd == 'save':
+        print("saved to {}".format(pipeline.save()))
+    elif cmd == 'load':
+        if pipeline.load(arg or "saved_files/import/"):
+            print("loaded the saved data and model")
+        else:
+            print("loaded the saved data, train to predict")
+    elif cmd == 'confusion':
+        pipeline.confusion_matrix()
+    elif cmd == 'importance':
+        pipeline.feature_importance()
+        print("feature importances written to feature_importances.csv")
+    else:
+        print("unknown command {}".format(cmd))
+    sys.stdout.flush()
+    return True
+
+
+def read_lines(stream, lines):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handler', default=DS_FILENAMES[DS_FILE_NUM],
+                        help="data handler script without .py (default: from config.ini)")
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help="send predictions as JSON lines to TCP clients instead of stdout")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args.handler)
+    server = PredictionServer(args.serve) if args.serve else None
+    print("Processes:", pipeline.ml_pid, pipeline.ds_pid, os.getpid(), flush=True)
+
+    # commands come in on their own thread, so predictions never wait for input
+    lines = queue.Queue()
+    threading.Thread(target=read_lines, args=(sys.stdin, lines), daemon=True).start()
+
+    try:
+        while pipeline.processes_alive():
+            for event in pipeline.events(timeout=POLL_INTERVAL):
+                if server is not None:
+                    server.send(event)
+                else:
+                    print_event(event)
+            pipeline.latency_stats.report()
+
+            try:
+                line = lines.get_nowait()
+            except queue.Empty:
+                continue
+            # without stdin (e.g. run as a service) keep predicting
+            if line is None:
+                lines = queue.Queue()
+                continue
+            try:
+                if not run_command(pipeline, line):
+                    break
+            except (ValueError, RuntimeError) as e:
+                print(e, flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.close()
+        pipeline.close()
+        print("Closing headless T4Train")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+latency.py
+
+Latency of the stages a frame goes through, from its samples arriving at
+the data handler to its prediction showing up in the UI:
+
+    capture    samples arrived -> frame published by the data handler
+    transport  frame published -> frame read by ml.py
+    featurize  featurizing the frame (or window) in ml.py
+    predict    predicting and writing the prediction in ml.py
+    display    prediction made -> prediction shown by ui.py
+    total      samples arrived -> prediction made (ml.py) or shown (ui.py)
+
+Timestamps are time.monotonic(), which is the same clock in every process.
+Each stage is recorded in a histogram with logarithmic buckets, so recording
+is cheap and the percentiles hold for any range of latencies. Every
+LATENCY_LOG_INTERVAL sec the stats are printed and reset.
+"""
+import bisect
+import time
+
+
+STAGES = ('capture', 'transport', 'featurize', 'predict', 'display', 'total')
+
+
+class Histogram:
+    """Durations in sec, in buckets of 10 per decade from 10 us to 100 sec."""
+
+    BOUNDS = [10 ** (exponent / 10) for exponent in range(-50, 21)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """Upper bound of the bucket that holds the q-th percentile."""
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.BOUNDS[bucket], self.max) if bucket < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        """Count and the mean, median, 90th and 99th percentile and max in ms."""
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / max(1, self.count),
+            'p50_ms': 1000 * self.percentile(50),
+            'p90_ms': 1000 * self.percentile(90),
+            'p99_ms': 1000 * self.percentile(99),
+            'max_ms': 1000 * self.max,
+        }
+
+
+class LatencyStats:
+    """Histograms of the stages one process sees."""
+
+    def __init__(self, name, interval=0):
+        self.name = name
+        self.interval = interval
+        self.histograms = {}
+        self._since = time.monotonic()
+
+    def record(self, stage, seconds):
+        if seconds < 0:
+            return
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        self.histograms[stage].record(seconds)
+
+    def since(self, stage, start):
+        """Records the time from start, a time.monotonic(), to now."""
+        if start is not None:
+            self.record(stage, time.monotonic() - start)
+
+    def summary(self):
+        """{stage: Histogram.summary()} of the stages recorded so far."""
+        return {stage: self.histograms[stage].summary()
+                for stage in STAGES if stage in self.histograms}
+
+    def report(self):
+        """Prints and returns the summary if it is due, then starts over.
+
+        Returns None if LATENCY_LOG_INTERVAL did not pass yet or is 0.
+        """
+        now = time.monotonic()
+        if self.interval <= 0 or now - self._since < self.interval:
+            return None
+        summary = self.summary()
+        if summary:
+            print(format_summary(self.name, summary))
+        self.histograms = {}
+        self._since = now
+        return summary
+
+
+def format_summary(name, summary):
+    """One log line per stage."""
+    lines = ['{} latency:'.format(name)]
+    for stage, stats in summary.items():
+        lines.append('  {:<9} n={:<6} mean {:8.2f} ms  p50 {:8.2f}  p90 {:8.2f}  '
+                     'p99 {:8.2f}  max {:8.2f}'.format(
+                         stage, stats['count'], stats['mean_ms'], stats['p50_ms'],
+                         stats['p90_ms'], stats['p99_ms'], stats['max_ms']))
+    return '\n'.join(lines)
@@ -6,45 +6,49 @@ Detailed but concise file description here
 # ============================================================================
 
 import os
-import sys
 import time
-import signal
+import copy
+import functools
 import configparser
-from timeloop import Timeloop
-from datetime import timedelta
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # Data processing
 import numpy as np
-import json
 
 ### SKLEARN Stuff
 from sklearn.ensemble import VotingClassifier, VotingRegressor
 from sklearn import preprocessing
+from sklearn.base import clone
 from sklearn.metrics import confusion_matrix as sk_confusion
 
 ### Classifiers
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.svm import SVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.naive_bayes import GaussianNB
 
 ### Regressors
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.svm import SVR
 from sklearn.neural_network import MLPRegressor
+from sklearn.linear_model import SGDRegressor
 
 ### Kfold
 from sklearn.model_selection import KFold
 
 # Self-define functions
 import utils
-
-# Get PID
-pidnum=os.getpid()
-
-# Store PID
-f=open("ml_pidnum.txt", "w")
-f.write(str(pidnum))
-f.close()
+import msgbus
+import framebus
+import featcache
+import datastore
+import streaming
+import compiled
+import modelbundle
+import latency
+import smoothing
 
 #================================================================
 # read in configurations
@@ -55,6 +59,17 @@ INSTANCES = int(config['GLOBAL']['INSTANCES'])  # number of instances recorded w
 FRAME_LENGTH = int(config['GLOBAL']['FRAME_LENGTH'])  # fixed size, need to adjust
 
 NUM_BINS = int(config['ML']['NUM_BINS'])  # feturization bins
+MAX_INFERENCE_RATE = float(config['ML'].get('MAX_INFERENCE_RATE', 0))  # predictions per sec, 0 for no cap
+TRAINING_BLOCK_MB = float(config['ML'].get('TRAINING_BLOCK_MB', 64))  # training data featurized at a time
+INCREMENTAL_TRAINING = config['ML'].getboolean('INCREMENTAL_TRAINING', False)  # update the model with new rounds only
+CV_WORKERS = int(config['ML'].get('CV_WORKERS', 0))  # processes for the confusion matrix folds, 0 for all cores
+INFERENCE_HOP = int(config['ML'].get('INFERENCE_HOP', 0))  # samples between sliding windows, 0 to predict per frame
+COMPILED_INFERENCE = config['ML'].getboolean('COMPILED_INFERENCE', True)  # predict with the compiled model
+LATENCY_LOG_INTERVAL = float(config['ML'].get('LATENCY_LOG_INTERVAL', 0))  # sec between latency logs, 0 for none
+PREDICT_PROBA = config['ML'].getboolean('PREDICT_PROBA', False)  # SVM probabilities and soft voting
+SMOOTHING = config['ML'].get('SMOOTHING', 'none').strip().lower()  # ema, majority, hmm or none
+SMOOTHING_WINDOW = int(config['ML'].get('SMOOTHING_WINDOW', 5))  # predictions smoothed over
+CV_FOLDS = 10
 SAMPLE_RATE = int(config['DS']['SAMPLE_RATE'])
 
 DS_HANDLERS = config['DS']['DS_HANDLERS'][1:-1].split(',')
@@ -69,8 +84,12 @@ ds_handler = DS_HANDLERS[DS_FILE_NUM]
 
 is_training = False
 is_inferencing = False
+le = None
 model = None
-algos = ['voting', 'mlp', 'svm', 'rf']
+predictor = None  # model compiled by compiled.py, None to predict with sklearn
+input_shape = None  # shape of the frames the model was trained on
+saved_model = None  # bundle the model was loaded from, until it is retrained
+algos = ['voting', 'mlp', 'svm', 'rf', 'sgd', 'nb']
 
 # algorithm and mode to run
 algo = algos[curr_algo_index]
@@ -86,9 +105,78 @@ if "Camera" in ds_handler:
     feat = utils.Featurization.Raw
 feat_from_last_train = feat
 
+# live frames published by the data handler and their announcements, commands
+# sent by ui.py, progress events for ui.py and every prediction, all set up in main()
+frame_reader = None
+frame_notices = None
+commands = None
+events = None
+predictions = None
+
+smoother = None       # smooths the predictions, see smoothing.py
+last_seq = 0          # sequence number of the last frame predicted on
+last_inference = 0    # time.monotonic() of the last prediction
+frame_pending = False # a FRAME command is queued and not handled yet
+skipped_frames = set()  # reasons frames were not predicted on, each printed once
+latency_stats = latency.LatencyStats('ml.py', LATENCY_LOG_INTERVAL)
+
+# features of the sliding windows over the sample stream when INFERENCE_HOP is set
+stream_featurizer = None
+dropped_frames = 0    # frame_reader.dropped when the featurizer last saw a frame
+MAX_STREAM_BACKLOG = 8  # frames we may fall behind before skipping ahead
+PREDICTION_QUEUE_SIZE = 1024  # predictions a slow subscriber may fall behind before missing some
+
+# features of each label the current model was trained on, for incremental training
+trained_features = {}
+FOREST_TREES_PER_UPDATE = 50  # trees added to a random forest for each update
+
+# models are trained on a background thread while the current one keeps predicting
+trainer = ThreadPoolExecutor(max_workers=1)
+training = None          # future of the model being trained
+model_generation = 0     # bumped when the algorithm is toggled
+training_generation = 0  # model_generation when the training started
+
 def save_model(curr_time):
     """Saves model when user presses 'S'."""
-    np.save('saved_files/{}/model'.format(curr_time), model)
+    estimator, estimator_algo = model, algo
+    if model is None and saved_model is not None:
+        # loaded from a bundle, its estimator was not needed so far
+        estimator, estimator_algo = saved_model.model, saved_model.algo
+    if estimator is None or le is None:
+        return
+    modelbundle.save('saved_files/{}/model_bundle'.format(curr_time), le, estimator, predictor,
+                     feat_from_last_train, NUM_BINS, SAMPLE_RATE, input_shape, estimator_algo)
+
+
+def load_model(dirname):
+    """Predicts with the model bundle in dirname instead of training one."""
+    global le, model, predictor, feat_from_last_train, trained_features, \
+                    input_shape, saved_model, is_inferencing, model_generation, smoother
+
+    try:
+        bundle = modelbundle.load(dirname)
+        # the estimator is only read if there is no compiled model to predict with
+        estimator = bundle.model if bundle.predictor is None else None
+    except (ValueError, OSError, KeyError, EOFError) as e:
+        print(e)
+        publish_progress('load', 0, 0)
+        return
+    if bundle.numbins != NUM_BINS or bundle.sample_rate != SAMPLE_RATE:
+        print("{} was trained with NUM_BINS {} and SAMPLE_RATE {}, not {} and {}".format(
+            dirname, bundle.numbins, bundle.sample_rate, NUM_BINS, SAMPLE_RATE))
+        publish_progress('load', 0, 0)
+        return
+
+    # a model still training was started before the load, drop it when it is done
+    model_generation += 1
+    le, predictor, model = bundle.le, bundle.predictor, estimator
+    feat_from_last_train = bundle.featurization
+    input_shape = bundle.input_shape
+    trained_features = {}
+    saved_model = bundle
+    smoother = None
+    is_inferencing = True
+    publish_progress('load', 1, 1)
 
 
 def init_machine_learning(algo='voting', mode='classifier'):
@@ -99,14 +187,14 @@ def init_machine_learning(algo='voting', mode='classifier'):
     if algo == 'voting':
         mlpclf = MLPClassifier()
         mlpreg = MLPRegressor()
-        svmclf = SVC(kernel='rbf')
+        svmclf = SVC(kernel='rbf', probability=PREDICT_PROBA)
         svmreg = SVR(kernel='rbf')
         rfclf = RandomForestClassifier(n_jobs=-1, n_estimators=500)
         rfreg = RandomForestRegressor(n_jobs=-1,n_estimators=500)
         clf = VotingClassifier(estimators=[('mlp', mlpclf),
                                            ('svm', svmclf),
                                            ('rf', rfclf)],
-                               voting='hard')
+                               voting='soft' if PREDICT_PROBA else 'hard')
         reg = VotingRegressor([('mlp', mlpreg),
                                ('svm', svmreg),
                                ('rf', rfreg)])
@@ -114,11 +202,17 @@ def init_machine_learning(algo='voting', mode='classifier'):
         clf = MLPClassifier()
         reg = MLPRegressor()
     elif algo == 'svm':
-        clf = SVC(kernel='poly')
+        clf = SVC(kernel='poly', probability=PREDICT_PROBA)
         reg = SVR(kernel='poly')
     elif algo == 'rf':
         clf = RandomForestClassifier(n_jobs=-1, n_estimators=500)
         reg = RandomForestRegressor(n_jobs=-1, n_estimators=500)
+    elif algo == 'sgd':
+        clf = SGDClassifier()
+        reg = SGDRegressor()
+    elif algo == 'nb':
+        clf = GaussianNB()
+        reg = SGDRegressor() # there is no naive bayes regressor
     else:
         clf = RandomForestClassifier(n_jobs=-1, n_estimators=500)
         reg = RandomForestRegressor(n_jobs=-1, n_estimators=500)
@@ -131,47 +225,115 @@ def init_machine_learning(algo='voting', mode='classifier'):
         return reg
 
 
+def featurize_training_data(training_data, featurization=None):
+    """Featurizes (rounds, instances, channels, samples) training data.
+
+    training_data may be memory-mapped. It is converted to float and
+    featurized a block of rounds at a time, so only one block of it is in
+    memory. Cuts out the channel indices stored in the last two columns the
+    same way ml_main does for live frames, so training and prediction see the
+    same features.
+    """
+    featurization = featurization or feat
+    round_bytes = max(1, int(np.prod(training_data.shape[1:])) * np.dtype(np.float).itemsize)
+    block = max(1, int(TRAINING_BLOCK_MB * 1024 * 1024) // round_bytes)
+
+    features = []
+    for start in range(0, training_data.shape[0], block):
+        rounds = training_data[start:start + block, :, :, :-2].astype(np.float)
+        features.append(utils.featurize_batch(rounds, featurization_type=featurization,
+                                              numbins=NUM_BINS, sample_rate=SAMPLE_RATE))
+    return np.concatenate(features)
+
+
+def load_label_features(featurization=None):
+    """Loads the training data in the manifest, returns {label: features per instance}.
+
+    Goes through the feature cache, so rounds that were featurized with the
+    same settings before are not featurized again.
+    """
+    featurization = featurization or feat
+    cache = featcache.FeatureCache(featcache.settings_key(featurization.value, NUM_BINS, SAMPLE_RATE))
+    featurize = functools.partial(featurize_training_data, featurization=featurization)
+
+    features = {}
+    for label, file, rounds in datastore.read_manifest('training_data.json'):
+        training_data = datastore.load(file, rounds, mmap_mode='r')
+        features[label] = cache.features(label, training_data, featurize)
+    return features
+
+
+def stack_features(features):
+    """Stacks {label: features} into X and one label per row."""
+    X = np.concatenate(list(features.values()))
+    y = np.concatenate([np.repeat(label, len(X_label)) for label, X_label in features.items()])
+    return X, y
+
+
+def load_training_features():
+    """Loads the training data in the manifest, returns features and labels per instance."""
+    return stack_features(load_label_features())
+
+
+def fit_fold(clf, X_train, y_train, X_test, y_test, numclasses):
+    """Trains clf on one K-fold split, returns its accuracy and confusion matrix."""
+    clf = clone(clf)
+    clf.fit(X_train, y_train.ravel()) # trains the model
+    y_pred = clf.predict(X_test) # classification
+    accuracy = np.mean(y_pred == y_test) # gets the accuracy of the classifier
+    return accuracy, sk_confusion(y_test, y_pred, labels=range(numclasses)) # creates confusion matrix
+
+
+def publish_progress(task, done, total):
+    """Tells ui.py how far a long task got."""
+    if events is not None:
+        events.publish({'task': task, 'done': done, 'total': total})
+
+
 def confusion_matrix():
     clf_conf = init_machine_learning(algos[curr_algo_index], mode)
     print("init ml for confusion")
     # load training data
     try:
-        training_data = np.load('training_data.npy').astype('float')
-        training_labels = np.load('training_labels.npy')
+        X, y = load_training_features()
     except Exception as e:
         print(e)
+        publish_progress('confusion', 0, 0)
         return
-    X_train = []
-    Y_train = []
-    # featurizes the data
-    for i in range(0, np.shape(training_data)[0]):
-        for j in range(0, np.shape(training_data)[1]):
-            tmptrain = training_data[i, j, :, :-2]
-            tmptrain = np.ravel(tmptrain)
-            tmptrain = utils.featurize(tmptrain, featurization_type=feat, numbins=NUM_BINS, sample_rate=SAMPLE_RATE)
-            X_train.append(tmptrain)
-            Y_train.append(training_labels[i])
-
-    X = np.array(X_train)[:, :, 0]
-    y = np.array(Y_train)
 
     le = preprocessing.LabelEncoder()
     le.fit(y)
     y = le.transform(y)
     numclasses = len(le.classes_)
-    kf = KFold(n_splits=10, shuffle=True)
-    kf.get_n_splits(X)
+    kf = KFold(n_splits=CV_FOLDS, shuffle=True)
+    splits = list(kf.split(X))
+    workers = min(CV_WORKERS or os.cpu_count() or 1, len(splits))
+    publish_progress('confusion', 0, len(splits))
+
     acc=[]
     cnf=[]
-    # test train split
-    for train_index, test_index in kf.split(X):
-        X_train, X_test = X[train_index], X[test_index]
-        y_train, y_test = y[train_index], y[test_index]
-        clf_conf.fit(X_train,y_train.ravel()) # trains the model
-        tmpacc = clf_conf.score(X_test,y_test) # gets the accuracy of the classifier
-        y_pred = clf_conf.predict(X_test) # classification
-        cnf.append(sk_confusion(y_test,y_pred)) # creates confusion matrix
-        acc.append(tmpacc)
+    if workers > 1:
+        # the folds already use every worker, don't let each fit spread over all cores too
+        clf_conf.set_params(**{param: 1 for param in clf_conf.get_params() if param.endswith('n_jobs')})
+
+        # spawn, forking a process that runs threads is not safe
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            folds = [pool.submit(fit_fold, clf_conf, X[train_index], y[train_index],
+                                 X[test_index], y[test_index], numclasses)
+                     for train_index, test_index in splits]
+            for fold in as_completed(folds):
+                tmpacc, tmpcnf = fold.result()
+                acc.append(tmpacc)
+                cnf.append(tmpcnf)
+                publish_progress('confusion', len(acc), len(splits))
+    else:
+        for train_index, test_index in splits:
+            tmpacc, tmpcnf = fit_fold(clf_conf, X[train_index], y[train_index],
+                                      X[test_index], y[test_index], numclasses)
+            acc.append(tmpacc)
+            cnf.append(tmpcnf)
+            publish_progress('confusion', len(acc), len(splits))
 
     finalacc, finalcnf = [], []
     finalacc.append(np.mean(acc))
@@ -187,23 +349,10 @@ def confusion_matrix():
 def feature_importances():
     # load training data
     try:
-        training_data = np.load('training_data.npy').astype(np.float)
-        training_labels = np.load('training_labels.npy')
+        X_train, Y_train = load_training_features()
     except Exception as e:
         print(e)
         return
-    X_train = []
-    Y_train = []
-    # featurizes the data
-    for i in range(0, np.shape(training_data)[0]):
-        for j in range(0, np.shape(training_data)[1]):
-            tmptrain = training_data[i, j, :, :-2] # cut out channel index flags
-            tmptrain = utils.featurize(tmptrain, featurization_type=feat, numbins=NUM_BINS, sample_rate=SAMPLE_RATE)
-            X_train.append(tmptrain)
-            Y_train.append(training_labels[i])
-
-    X_train = np.array(X_train)[:, :, 0]
-    Y_train = np.array(Y_train)
 
     le = preprocessing.LabelEncoder()
     le.fit(Y_train)
@@ -214,149 +363,467 @@ def feature_importances():
     np.savetxt('feature_importances.csv', model.feature_importances_, delimiter=',')
 
 
-def read_message():
-    """Handles ML commands written by ui.py."""
-    global is_training, le, model, is_training, is_inferencing, \
-                    curr_algo_index, algo
-
-    # tests to see if the file can be open  
-
-    try:
-        f = open("ml_cmd.txt", "r")
-        cmd = f.read()
-        f.close()
-    except Exception as e:
-        return
-        
+def read_featurization():
+    """Featurization picked in the UI, written to feat.txt."""
     try:
         with open("feat.txt", "r") as f:
-            feat = utils.Featurization(f.read())
+            return utils.Featurization(f.read())
     except Exception as e: # if no file, assume raw by default
 #        print("Error: unable to read featurization method ml.py")
-        feat = utils.Featurization.Raw
-
-    if cmd == 'TRAIN':
+        return utils.Featurization.Raw
+
+
+def read_message(cmd):
+    """Handles an ML command sent by ui.py."""
+    global is_training, model, is_inferencing, \
+                    curr_algo_index, algo, feat, model_generation, predictor, saved_model, smoother, \
+                    frame_pending
+
+    # FRAME comes with every frame while predicting, no file is read for it
+    if cmd == 'FRAME':
+        frame_pending = False
+    elif cmd == 'TRAINED':
+        swap_model()
+    elif cmd == 'TRAIN':
+        feat = read_featurization()
+        # the current model keeps predicting until the new one is trained
         is_training = True
-        le = None
-        model = None
     elif cmd == 'FEATURE_IMPORTANCE':
+        feat = read_featurization()
         feature_importances()
     elif 'TOGGLE_ALGO' in cmd:
         curr_algo_index = int(cmd[-1])
         algo = algos[curr_algo_index]
         model = None
+        predictor = None
+        saved_model = None
+        model_generation += 1
         is_inferencing = False
         is_training = False
     elif cmd == 'CONFUSION':
+        feat = read_featurization()
         confusion_matrix()
     elif cmd == 'STOP PREDICTING':
         is_inferencing = False
+        smoother = None
     elif cmd == 'BYE':
+        commands.close()
         os._exit(0)
+    elif cmd.startswith('LOAD_MODEL'):
+        load_model(cmd.split(',', 1)[1].strip())
     elif 'SAVE' in cmd:
         curr_time = cmd.split()[1].strip()
         save_model(curr_time)
-    try:
-        f = open("ml_cmd.txt", "w")
-        f.write("")
-        f.close()
-    except Exception as e:
-        return
 
 
-def receive_interrupt(signum, stack):
-    """Catches signals from ui.py and handles ml commands."""
-    read_message()
-
-
-def ml_train():
-    """Trains the ml algorithm."""
-    global feat_from_last_train, feat
-
+def update_model(current, features, featurization):
+    """Updates a copy of the current model with rounds it was not trained on yet.
+
+    Only possible when the labels and featurization did not change and every
+    label still starts with the rounds the model saw. Models with partial_fit
+    (MLP, SGD, Naive Bayes) learn from the new rounds, a random forest grows
+    trees on them. Either way the cost depends on the new rounds only.
+    Returns None if the model has to be trained from scratch instead.
+    """
+    le, model, last_featurization, seen_features = current
+    if model is None or le is None or featurization != last_featurization:
+        return None
+    if set(features) != set(le.classes_) or set(features) != set(seen_features):
+        return None
+    if not hasattr(model, 'partial_fit') and not isinstance(model, RandomForestClassifier):
+        return None
+
+    new_features = {}
+    for label, X_label in features.items():
+        seen = seen_features[label]
+        if len(X_label) < len(seen) or not np.array_equal(X_label[:len(seen)], seen):
+            return None # rounds were deleted or changed
+        if len(X_label) > len(seen):
+            new_features[label] = X_label[len(seen):]
+
+    # the current model keeps predicting while the copy is updated
+    model = copy.deepcopy(model)
+    if new_features:
+        X_new, y_new = stack_features(new_features)
+        X, y = X_new, y_new
+        if not isinstance(model, GaussianNB): # naive bayes keeps exact counts, it does not forget
+            X_old, y_old = replay_instances(seen_features, len(X_new))
+            X = np.concatenate([X_new, X_old])
+            y = np.concatenate([y_new, y_old])
+        y = le.transform(y)
+        if hasattr(model, 'partial_fit'):
+            model.partial_fit(X, y)
+        else:
+            # warm start keeps the trees and fits the new ones on X only
+            model.set_params(warm_start=True,
+                             n_estimators=model.n_estimators + FOREST_TREES_PER_UPDATE)
+            model.fit(X, y)
+        print("Updated model with {} new instances".format(len(X_new)))
+
+    return [le, model, featurization, features]
+
+
+def replay_instances(seen_features, count):
+    """Draws about count instances the model was trained on, from every label.
+
+    A round only holds one label. Updating on it alone would make the model
+    forget the others (and new forest trees would only know that label), so
+    every update mixes in as many old instances.
+    """
+    per_label = int(np.ceil(count / len(seen_features)))
+    X_old, y_old = [], []
+    for label, seen in seen_features.items():
+        rows = np.random.choice(len(seen), size=min(len(seen), per_label), replace=False)
+        X_old.append(seen[rows])
+        y_old.append(np.repeat(label, len(rows)))
+    return np.concatenate(X_old), np.concatenate(y_old)
+
+
+def ml_train(algo_index, featurization, current):
+    """Trains the ml algorithm, or updates the current model in incremental mode.
+
+    Runs on the trainer thread and only reads its arguments, the model that
+    is predicting is swapped for the result in swap_model(). Returns
+    [le, model, featurization, features per label, compiled model] or None
+    if there is no training data.
+    """
     try:
-        training_data = np.load('training_data.npy').astype(np.float)
+        features = load_label_features(featurization)
+        X_train, Y_train = stack_features(features)
     except Exception as e:
         print(e)
-        return None, None
-
-
-    if "Camera" not in ds_handler:
-        training_data = training_data[:, :, :, :-2] # cut out channel indices stored in last two cols of all rows
-    training_labels = np.load('training_labels.npy')
-    X_train = []
-    Y_train = []
-
-    # featurizes the data     
-    for i in range(0, np.shape(training_data)[0]):
-        for j in range(0, np.shape(training_data)[1]):
-            tmptrain = training_data[i, j, :, :-2] # cut out columns with channel indices
-            tmptrain = utils.featurize(tmptrain, featurization_type=feat, numbins=NUM_BINS, sample_rate=SAMPLE_RATE)
-            X_train.append(tmptrain)
-            Y_train.append(training_labels[i])
-    
-    X_train = np.array(X_train)[:, :, 0]
-    Y_train = np.array(Y_train)
+        return None
+
+    if INCREMENTAL_TRAINING:
+        updated = update_model(current, features, featurization)
+        if updated is not None:
+            return updated + [compile_model(updated[1])]
 
     le = preprocessing.LabelEncoder()
     le.fit(Y_train)
     Y_train = le.transform(Y_train)
     # initializes machine learning classifier/regressor  
 
-    model = init_machine_learning(algos[curr_algo_index], mode)
+    model = init_machine_learning(algos[algo_index], mode)
     model.fit(X_train, Y_train) # trains the model
-    feat_from_last_train = feat
-    return [le, model]
+    return [le, model, featurization, features, compile_model(model)]
+
+
+def compile_model(model):
+    """Compiles model for inference, None if disabled or not supported."""
+    if not COMPILED_INFERENCE:
+        return None
+    try:
+        return compiled.compile_model(model)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def start_training():
+    """Starts training a new model on the trainer thread."""
+    global training, training_generation
+
+    current = [le, model, feat_from_last_train, trained_features]
+    training = trainer.submit(ml_train, curr_algo_index, feat, current)
+    training_generation = model_generation
+
+    # wake up the main loop when the model is ready
+    training.add_done_callback(lambda future: commands.put('TRAINED'))
+
+
+def swap_model():
+    """Swaps the model trained in the background in for the current one."""
+    global training, le, model, feat_from_last_train, trained_features, \
+                    is_inferencing, predictor, input_shape, saved_model, smoother
+
+    future, training = training, None
+    try:
+        result = future.result()
+    except Exception as e:
+        print(e)
+        publish_progress('train', 0, 0)
+        return
+
+    if result is None:
+        publish_progress('train', 0, 0)
+        return
+    # the algorithm was toggled while training, this model is not wanted anymore
+    if training_generation != model_generation:
+        return
+
+    # the prediction loop runs on this thread, so it sees either the old or the new model
+    le, model, feat_from_last_train, trained_features, predictor = result
+    input_shape = training_input_shape()
+    saved_model = None
+    smoother = None
+    is_inferencing = True
+    publish_progress('train', 1, 1)
+
+
+def training_input_shape():
+    """Shape of a frame of the training data, as the data handler publishes it."""
+    try:
+        for label, filename, rounds in datastore.read_manifest('training_data.json'):
+            return datastore.load(filename, mmap_mode='r').shape[2:]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
 
 
 def ml_main():
     """Handles training and predicting of ml algorithm."""
-    global is_training, is_inferencing, le, model, feat_from_last_train
+    global is_training
 
-    if is_training:
-        le, model = ml_train()
+    # train in the background, the current model keeps predicting meanwhile
+    if is_training and training is None:
+        start_training()
         is_training = False
-        is_inferencing = True
 
     if is_inferencing:
-        try:
-            X_test = np.load('tmpframe.npy').astype(np.float)
-            assert(X_test.size != 0)
-            assert(le is not None)
-            assert(model is not None)
-        except Exception as e:
-            return
-        
-        X_test = X_test[:,:-2] # cut out columns with channel indices
-        X_test = utils.featurize(X_test, featurization_type=feat_from_last_train, numbins=NUM_BINS, sample_rate=SAMPLE_RATE)
-        # write prediction to file
-        prediction = le.inverse_transform(model.predict(X_test.T))
-        np.save('prediction', np.array(prediction))
+        if INFERENCE_HOP > 0 and "Camera" not in ds_handler:
+            predict_stream()
+        else:
+            predict_frame()
 
 
-timeloop_ml = Timeloop()
+def predict_frame():
+    """Predicts on the newest frame, once per frame."""
+    global last_seq, last_inference
 
+    seq, X_test = frame_reader.latest()
+    if seq == last_seq:
+        return
+    last_seq = seq
+    last_inference = time.monotonic()
+    record_frame_latency()
+
+    if le is None or (model is None and predictor is None):
+        return
+    # the model cannot predict on frames shaped unlike its training data
+    if X_test.size == 0 or (input_shape is not None and X_test.shape != input_shape):
+        report_skipped_frame("frame of shape {} does not match the training data's {}".format(
+            X_test.shape, input_shape))
+        return
+    try:
+        X_test = X_test.astype(np.float)
+    except (TypeError, ValueError) as e:
+        report_skipped_frame("frame of dtype {} is not numeric: {}".format(X_test.dtype, e))
+        return
+
+    X_test = X_test[:,:-2] # cut out columns with channel indices
+    start = time.monotonic()
+    X_test = utils.featurize(X_test, featurization_type=feat_from_last_train, numbins=NUM_BINS, sample_rate=SAMPLE_RATE)
+    latency_stats.since('featurize', start)
+    start = time.monotonic()
+    encoded, probabilities = predict(X_test.T)
+    latency_stats.since('predict', start)
+    prediction_made(seq, frame_reader.captured, encoded[-1],
+                    probabilities[-1] if probabilities is not None else None)
+
+
+def predict_stream():
+    """Predicts on every window of the sample stream completed since the last call.
+
+    Reads every frame the data handler published, in order, and slides a
+    window as long as a frame over the samples, one window every
+    INFERENCE_HOP samples. The windows are featurized incrementally as the
+    samples arrive.
+    """
+    global last_seq, last_inference, stream_featurizer, dropped_frames
+
+    # far behind (just started, or predicting is slower than the stream),
+    # skip to the newest frame so the latency stays bounded
+    if stream_featurizer is None or frame_reader.head - frame_reader.last_seq > MAX_STREAM_BACKLOG:
+        frame_reader.last_seq = max(0, frame_reader.head - 1)
+        if stream_featurizer is not None:
+            stream_featurizer.reset()
+
+    features = []
+    windows = []        # (seq, captured) of the frame that completed each window
+    featurize_time = 0
+    frame = frame_reader.next()
+    while frame is not None:
+        record_frame_latency()
+        # the model cannot predict on frames shaped unlike its training data
+        if input_shape is not None and frame.shape != input_shape:
+            report_skipped_frame("frame of shape {} does not match the training data's {}".format(
+                frame.shape, input_shape))
+            frame = frame_reader.next()
+            continue
+
+        samples = frame[:, :-2].astype(np.float) # cut out columns with channel indices
+        if stream_featurizer is None or stream_featurizer.length != samples.shape[1] \
+                or stream_featurizer.featurization_type != feat_from_last_train:
+            stream_featurizer = streaming.StreamingFeaturizer(samples.shape[1], INFERENCE_HOP,
+                                                              feat_from_last_train, NUM_BINS,
+                                                              sample_rate=SAMPLE_RATE)
+
+        # frames were overwritten before we read them, the stream has a gap
+        if frame_reader.dropped != dropped_frames:
+            dropped_frames = frame_reader.dropped
+            stream_featurizer.reset()
+
+        start = time.monotonic()
+        window_features = stream_featurizer.push(samples)
+        featurize_time += time.monotonic() - start
+        if len(window_features):
+            features.append(window_features)
+            windows.extend([(frame_reader.last_seq, frame_reader.captured)] * len(window_features))
+        frame = frame_reader.next()
+
+    last_seq = frame_reader.last_seq
+    if not features or le is None or (model is None and predictor is None):
+        return
+    last_inference = time.monotonic()
+    latency_stats.record('featurize', featurize_time)
+
+    X_test = np.concatenate(features)
+    start = time.monotonic()
+    encoded, probabilities = predict(X_test)
+    latency_stats.since('predict', start)
+    for i, (seq, captured) in enumerate(windows):
+        prediction_made(seq, captured, encoded[i],
+                        probabilities[i] if probabilities is not None else None)
+
+
+def report_skipped_frame(reason):
+    """Prints why frames are not predicted on, once per reason."""
+    if reason not in skipped_frames:
+        skipped_frames.add(reason)
+        print("Skipping frames: {}".format(reason))
+
+
+def predict(X):
+    """Predicts the encoded labels of the rows of X with the current model.
+
+    Returns the labels and their (rows, classes) probabilities, or None as
+    probabilities if the model does not give them.
+    """
+    if predictor is not None:
+        return predictor.predict_with_probabilities(X)
+    # e.g. SVC without probability, hard voting or a regressor have no predict_proba
+    if not hasattr(model, 'predict_proba'):
+        return model.predict(X), None
+    probabilities = model.predict_proba(X)
+    return model.classes_[np.argmax(probabilities, axis=1)], probabilities
+
+
+def model_classes():
+    """Encoded labels in the order of the columns of predict()'s probabilities."""
+    if predictor is not None:
+        return predictor.classes
+    return model.classes_
+
+
+def record_frame_latency():
+    """Records how long the frame just read took to get to ml.py."""
+    if frame_reader.captured is not None:
+        latency_stats.record('capture', frame_reader.published - frame_reader.captured)
+        latency_stats.since('transport', frame_reader.published)
+
+
+def prediction_made(seq, captured, encoded, probabilities=None):
+    """Smooths a prediction, records its latency and publishes it on 'predictions'.
+
+    Every prediction is published, with the sequence number of the frame
+    that completed its window, the time that frame's samples arrived and the
+    time of the prediction (time.monotonic()), and the probability of each
+    label if the model gives them. With SMOOTHING, label and probabilities
+    are smoothed and raw_label is the model's own prediction.
+    """
+    global smoother
+
+    classes = model_classes()
+    labels = [str(label) for label in le.inverse_transform(classes)]
+    raw_label = label = str(le.inverse_transform([encoded])[0])
+
+    if SMOOTHING != 'none' and (smoother is None or smoother.num_classes != len(classes)):
+        smoother = smoothing.make_smoother(SMOOTHING, len(classes), SMOOTHING_WINDOW)
+    if smoother is not None:
+        index = int(np.flatnonzero(classes == encoded)[0])
+        probabilities = smoother.update(smoothing.observation(len(classes), index, probabilities))
+        label = labels[int(np.argmax(probabilities))]
+
+    latency_stats.since('total', captured)
+    if predictions is None:
+        return
+    prediction = {'seq': seq, 'label': label, 'raw_label': raw_label, 'probabilities': None,
+                  'captured': captured, 'predicted': time.monotonic()}
+    if probabilities is not None:
+        prediction['probabilities'] = {label: float(p) for label, p in zip(labels, probabilities)}
+    predictions.publish(prediction)
+
+
+def report_latency():
+    """Logs the latency stats every LATENCY_LOG_INTERVAL sec and sends them to ui.py."""
+    summary = latency_stats.report()
+    if summary and events is not None:
+        events.publish({'task': 'latency', 'process': 'ml.py', 'stats': summary})
 
-# adds timeloop job for checking for ml commans
-@timeloop_ml.job(interval=timedelta(seconds=0.3))
-def read_message_wrapper():
-    read_message()
 
+def frame_published(seq):
+    """Wakes up the main loop when the data handler published a frame.
 
-# adds timeloop job for training and predicting
-@timeloop_ml.job(interval=timedelta(seconds=0.2))
-def ml_main_wrapper():
-    ml_main()
+    Runs on the frame subscriber's thread. Only one FRAME command is queued
+    until the main loop handles it, and none while not predicting.
+    """
+    global frame_pending
+    if is_inferencing and not frame_pending:
+        frame_pending = True
+        commands.put('FRAME')
 
 
-if utils.does_support_signals():
-    signal.signal(signal.SIGINT, receive_interrupt)
+def wait_for_work():
+    """Sleeps until a command arrives or, while predicting, a new frame is due."""
+    # a training can start right away, otherwise TRAINED wakes us up
+    if is_training and training is None:
+        return
+
+    # nothing to predict on, sleep until ui.py sends a command
+    if not is_inferencing:
+        read_message(commands.get())
+        return
+
+    # respect the max inference rate, frames published meanwhile wait for it
+    if MAX_INFERENCE_RATE > 0:
+        next_inference = last_inference + 1 / MAX_INFERENCE_RATE
+        while time.monotonic() < next_inference:
+            cmd = commands.get(timeout=max(0, next_inference - time.monotonic()))
+            if cmd is not None:
+                read_message(cmd)
+                if cmd != 'FRAME':
+                    return
+
+    # sleep until the data handler announces a frame we have not predicted on
+    if frame_reader.head == last_seq:
+        read_message(commands.get())
+
+
+def main():
+    global frame_reader, frame_notices, commands, events, predictions
+
+    # Store PID
+    with open("ml_pidnum.txt", "w") as f:
+        f.write(str(os.getpid()))
+
+    # a misspelled SMOOTHING fails right away, not at the first prediction
+    smoothing.make_smoother(SMOOTHING, 2, SMOOTHING_WINDOW)
+
+    frame_reader = framebus.FrameReader()
+    commands = msgbus.CommandServer("ml")
+    events = msgbus.Publisher("ml_events")
+    predictions = msgbus.Publisher("predictions", maxsize=PREDICTION_QUEUE_SIZE)
+    # the data handler announces every frame, frame_published() wakes up wait_for_work()
+    frame_notices = framebus.subscribe(frame_published)
 
     while True:
+        for cmd in commands.poll():
+            read_message(cmd)
         ml_main()
+        report_latency()
+        wait_for_work()
 
 
-if not utils.does_support_signals():
-    # starts the timeloop jobs if OS does not support signals
-    timeloop_ml.start(block=True)
-
-sys.exit()
+if __name__ == '__main__':
+    main()
@@ -16,19 +16,57 @@ class SensorBuffer {
     private var bufferSemaphore = DispatchSemaphore(value: 1)
     var shouldSendData = false
     
+    // over UDP, send binary packets (UDPPacket in UDPManager.swift) of this many samples instead of one string per sample
+    var sendBinaryPackets = true
+    var samplesPerPacket = 5
+    
     // use ids unique to each sensor data provider as keys
     private var messageBuffer: [String:String] = [:]
+    private var sampleBuffer: [String:[Double]] = [:]
     private var channelReadyFlags: [String:Bool] = [:]
     
+    private var packet: UDPPacket?
+    private var packetSequence: UInt32 = 0
+    
     // assumes buffer semaphore is held over duration of call =
     private func sendPushedSamples() {
         // if we're actively sending data, ensure that the most updated data for this sensor is marked as ready
         if !channelReadyFlags.values.contains(false) { // we have as many pending messages as needed
-            ConnectionManager.shared.sendMessage(msg: messageBuffer.values.joined())
+            if sendBinaryPackets && ConnectionManager.shared.connectionType == .UDP {
+                addToPacket()
+            } else {
+                ConnectionManager.shared.sendMessage(msg: messageBuffer.values.joined())
+            }
             channelReadyFlags.keys.forEach {channelReadyFlags[$0] = false}
         }
     }
     
+    // assumes buffer semaphore is held over duration of call
+    private func addToPacket() {
+        let ids = sampleBuffer.keys.sorted()
+        let sensors = ids.map { UDPPacket.Sensor(id: $0, channels: sampleBuffer[$0]!.count) }
+        if let packet = packet, packet.sensors != sensors {
+            // a sensor was turned on or off, the samples of a packet must all have the same sensors
+            sendPacket()
+        }
+        if packet == nil {
+            packet = UDPPacket(sensors: sensors)
+        }
+        packet!.append(sample: ids.flatMap { sampleBuffer[$0]! })
+        if packet!.sampleCount >= samplesPerPacket {
+            sendPacket()
+        }
+    }
+    
+    // assumes buffer semaphore is held over duration of call
+    private func sendPacket() {
+        if let packet = packet, packet.sampleCount > 0 {
+            UDPManager.shared.sendUDP(packet.encode(sequence: packetSequence))
+            packetSequence &+= 1
+        }
+        packet = nil
+    }
+    
     // MARK: - New Interface for sensor buffer
     
     /**
@@ -41,6 +79,7 @@ class SensorBuffer {
         if self.shouldSendData {
             self.bufferSemaphore.wait()
             self.messageBuffer[sensorUniqueId] = "&\(sensorUniqueId):\(sample.map {String($0)}.joined(separator: ",")):"
+            self.sampleBuffer[sensorUniqueId] = sample
             self.channelReadyFlags[sensorUniqueId] = true
             self.sendPushedSamples()
             self.bufferSemaphore.signal()
@@ -57,6 +96,7 @@ class SensorBuffer {
         // when we stop gryo updates, the dataframe being sent should decrease in size
         self.bufferSemaphore.wait()
         self.messageBuffer.removeValue(forKey: sensorUniqueId)
+        self.sampleBuffer.removeValue(forKey: sensorUniqueId)
         self.channelReadyFlags.removeValue(forKey: sensorUniqueId)
         self.bufferSemaphore.signal()
     }
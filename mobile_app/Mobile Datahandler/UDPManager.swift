@@ -112,3 +112,69 @@ class UDPManager: MessageSender {
     }
     
 }
+
+/**
+ Binary packet of sensor samples for ds_mobile_udp.py. It batches several samples of every active sensor in one
+ datagram, instead of sending one "&acc:x,y,z:&gyro:x,y,z:" string per sample.
+ 
+ Layout, little endian:
+ - header: "T4", version (UInt8), number of sensors (UInt8), number of samples (UInt16), 2 reserved bytes,
+   sequence number (UInt32)
+ - per sensor: id (4 bytes ASCII, zero padded), number of channels (UInt8), 3 reserved bytes
+ - per sample: every channel of every sensor, in the order of the sensors, as Float32
+ */
+struct UDPPacket {
+    
+    struct Sensor: Equatable {
+        let id: String
+        let channels: Int
+    }
+    
+    static let magic: [UInt8] = [0x54, 0x34] // "T4"
+    static let version: UInt8 = 1
+    
+    let sensors: [Sensor]
+    private var values: [Float32] = []
+    
+    init(sensors: [Sensor]) {
+        self.sensors = sensors
+    }
+    
+    var sampleCount: Int {
+        let channels = sensors.reduce(0) { $0 + $1.channels }
+        return channels == 0 ? 0 : values.count / channels
+    }
+    
+    /**
+     Adds one sample of every sensor.
+     
+     - Parameter sample: every channel of every sensor, in the order of the sensors
+     */
+    mutating func append(sample: [Double]) {
+        values += sample.map { Float32($0) }
+    }
+    
+    func encode(sequence: UInt32) -> Data {
+        var data = Data(capacity: 12 + 8 * sensors.count + 4 * values.count)
+        data.append(contentsOf: UDPPacket.magic)
+        data.append(UDPPacket.version)
+        data.append(UInt8(sensors.count))
+        appendLittleEndian(UInt16(sampleCount), to: &data)
+        appendLittleEndian(UInt16(0), to: &data)
+        appendLittleEndian(sequence, to: &data)
+        
+        for sensor in sensors {
+            let id = Array(sensor.id.utf8.prefix(4))
+            data.append(contentsOf: id + [UInt8](repeating: 0, count: 4 - id.count))
+            data.append(UInt8(sensor.channels))
+            data.append(contentsOf: [UInt8](repeating: 0, count: 3))
+        }
+        
+        values.forEach { appendLittleEndian($0.bitPattern, to: &data) }
+        return data
+    }
+    
+    private func appendLittleEndian<T: FixedWidthInteger>(_ value: T, to data: inout Data) {
+        withUnsafeBytes(of: value.littleEndian) { data.append(contentsOf: $0) }
+    }
+}
@@ -0,0 +1,110 @@
+"""
+modelbundle.py
+
+Saved models that ml.py can predict with right away, without retraining.
+
+A bundle is a directory with everything needed to turn a frame into a label:
+
+- bundle.json: the format version, the labels in the order of the label
+  encoder, the featurization type, NUM_BINS and SAMPLE_RATE the features were
+  made with, the shape of a frame as the data handler publishes it, and the
+  algorithm.
+- estimator.joblib: the trained scikit-learn model.
+- compiled/: the model compiled by compiled.py, if it could be compiled.
+
+bundle.json is written last, so a directory without it is not a bundle.
+Loading reads bundle.json only. The compiled model is memory-mapped, and the
+estimator is only read when it is first needed (e.g. to predict with a model
+that could not be compiled), so even a large forest loads in milliseconds.
+"""
+import json
+import os
+import shutil
+
+import joblib
+import numpy as np
+from sklearn import preprocessing
+
+import utils
+import compiled
+
+
+FORMAT_VERSION = 1
+DESCRIPTION_FILE = 'bundle.json'
+ESTIMATOR_FILE = 'estimator.joblib'
+COMPILED_DIR = 'compiled'
+
+
+def save(dirname, le, model, predictor, featurization, numbins, sample_rate, input_shape, algo):
+    """Saves a trained model and what it needs to predict to dirname."""
+    if os.path.exists(os.path.join(dirname, DESCRIPTION_FILE)):
+        os.remove(os.path.join(dirname, DESCRIPTION_FILE))
+    os.makedirs(dirname, exist_ok=True)
+
+    joblib.dump(model, os.path.join(dirname, ESTIMATOR_FILE))
+    compiled_dir = os.path.join(dirname, COMPILED_DIR)
+    if os.path.exists(compiled_dir):
+        shutil.rmtree(compiled_dir)
+    if predictor is not None:
+        compiled.save(predictor, compiled_dir)
+
+    description = {
+        'version': FORMAT_VERSION,
+        'labels': [str(label) for label in le.classes_],
+        'featurization': featurization.value,
+        'numbins': int(numbins),
+        'sample_rate': int(sample_rate),
+        'input_shape': [int(n) for n in input_shape] if input_shape is not None else None,
+        'algo': algo,
+        'compiled': predictor is not None,
+    }
+    tmp_filename = os.path.join(dirname, DESCRIPTION_FILE + '.tmp')
+    with open(tmp_filename, 'w') as f:
+        json.dump(description, f, indent=1)
+    os.replace(tmp_filename, os.path.join(dirname, DESCRIPTION_FILE))
+
+
+class Bundle:
+    """A saved model, see load()."""
+
+    def __init__(self, dirname, description):
+        self.dirname = dirname
+        self.featurization = utils.Featurization(description['featurization'])
+        self.numbins = description['numbins']
+        self.sample_rate = description['sample_rate']
+        self.algo = description['algo']
+        self.input_shape = None
+        if description['input_shape'] is not None:
+            self.input_shape = tuple(description['input_shape'])
+
+        self.le = preprocessing.LabelEncoder()
+        self.le.classes_ = np.array(description['labels'])
+
+        self.predictor = None
+        if description['compiled']:
+            self.predictor = compiled.load(os.path.join(dirname, COMPILED_DIR))
+        self._model = None
+
+    @property
+    def model(self):
+        """The scikit-learn model, read from disk the first time it is used."""
+        if self._model is None:
+            self._model = joblib.load(os.path.join(self.dirname, ESTIMATOR_FILE))
+        return self._model
+
+
+def load(dirname):
+    """Loads the bundle in dirname. Raises ValueError if it is not a bundle."""
+    try:
+        with open(os.path.join(dirname, DESCRIPTION_FILE), 'r') as f:
+            description = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError('{}: not a model bundle ({})'.format(dirname, e))
+    if description.get('version') != FORMAT_VERSION:
+        raise ValueError('{}: unsupported model bundle version {}'.format(
+            dirname, description.get('version')))
+    try:
+        return Bundle(dirname, description)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        # e.g. bundle.json says compiled but compiled/ is missing or truncated
+        raise ValueError('{}: broken model bundle ({!r})'.format(dirname, e))
@@ -0,0 +1,309 @@
+"""
+msgbus.py
+
+Command channel between ui.py, ml.py and the data handlers. Replaces the
+ml_cmd.txt / ds_cmd.txt files and the SIGINT (or Timeloop polling on Windows)
+that told a process to go read them.
+
+Every process that takes commands runs a CommandServer and ui.py talks to it
+with a CommandClient. Messages are framed and authenticated by
+multiprocessing.connection, over a Unix domain socket or a named pipe on
+Windows. The server queues commands in the order they arrive and
+acknowledges each one as soon as it arrives, so two commands sent back to
+back are both delivered, and the receiving process handles them from its own
+main loop instead of inside a signal handler.
+
+Events that go the other way, from one process to whoever is listening (e.g.
+progress of a long ML task, or every prediction), use a Publisher and any
+number of Subscribers. A Subscriber either queues events for get()/poll() or
+hands each one to a callback as soon as it arrives.
+"""
+from multiprocessing.connection import Listener, Client
+import multiprocessing
+import threading
+import tempfile
+import queue
+import time
+import sys
+import os
+
+import utils
+
+
+AUTHKEY = b't4train'
+ACK = 'ACK'
+SEND_TIMEOUT = 5       # sec to wait for an acknowledgement
+CONNECT_TIMEOUT = 30   # sec to wait for a server to come up
+RECONNECT_INTERVAL = 0.1  # sec between a subscriber's connection attempts
+
+
+def address(name):
+    """Address of the server called name in the current T4Train session."""
+    if sys.platform == 'win32':
+        return r'\\.\pipe\t4t_{}_{}'.format(utils.session_id(), name)
+    return os.path.join(tempfile.gettempdir(),
+                        't4t_{}_{}.sock'.format(utils.session_id(), name))
+
+
+class CommandServer:
+    """Receives commands for one process (e.g. 'ml' or 'ds')."""
+
+    def __init__(self, name):
+        self.name = name
+        self.address = address(name)
+
+        # remove the socket of a previous process with the same name
+        if sys.platform != 'win32' and os.path.exists(self.address):
+            os.remove(self.address)
+
+        self._listener = Listener(self.address, authkey=AUTHKEY)
+        self._queue = queue.Queue()
+        self._closed = False
+
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,), daemon=True)
+            thread.start()
+
+    def _serve(self, conn):
+        while not self._closed:
+            try:
+                cmd = conn.recv()
+            except (OSError, EOFError):
+                break
+            # ack before queueing, the command may make this process exit
+            try:
+                conn.send(ACK)
+            except OSError:
+                break
+            finally:
+                self._queue.put(cmd)
+        conn.close()
+
+    def get(self, timeout=None):
+        """Returns the next command, or None if none arrives within timeout sec."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, cmd):
+        """Queues a command from within this process, e.g. from a worker thread."""
+        self._queue.put(cmd)
+
+    def poll(self):
+        """Returns all commands received so far, oldest first."""
+        cmds = []
+        while True:
+            try:
+                cmds.append(self._queue.get_nowait())
+            except queue.Empty:
+                return cmds
+
+    def close(self):
+        self._closed = True
+        try:
+            self._listener.close()
+        except OSError:
+            pass
+
+
+class CommandClient:
+    """Sends commands to the server called name and waits for the ack."""
+
+    def __init__(self, name):
+        self.name = name
+        self.address = address(name)
+        self._conn = None
+
+    def _connect(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return Client(self.address, authkey=AUTHKEY)
+            except (FileNotFoundError, ConnectionRefusedError, OSError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def send(self, cmd, timeout=SEND_TIMEOUT, connect_timeout=CONNECT_TIMEOUT):
+        """Sends cmd, returns True once the server acknowledged it.
+
+        Reconnects once if the server went away (e.g. ml.py was restarted).
+        Without an ack within timeout sec the connection is dropped, and the
+        next command goes over a new one.
+        """
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = self._connect(connect_timeout)
+                self._conn.send(cmd)
+                if self._conn.poll(timeout) and self._conn.recv() == ACK:
+                    return True
+                # a late ack would be taken for the next command's, start over
+                self.close()
+                print("msgbus: no ack from {} for {}".format(self.name, cmd))
+                return False
+            except (OSError, EOFError):
+                self.close()
+        print("msgbus: could not deliver {} to {}".format(cmd, self.name))
+        return False
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
+
+class Publisher:
+    """Sends events to every Subscriber of name (e.g. ml.py's progress).
+
+    Each subscriber gets its own bounded queue and sender thread, so a slow
+    or stuck subscriber never blocks the publisher. Events that do not fit in
+    a subscriber's queue are dropped for that subscriber.
+    """
+
+    def __init__(self, name, maxsize=256):
+        self.name = name
+        self.address = address(name)
+        self.maxsize = maxsize
+        self.dropped = 0
+
+        if sys.platform != 'win32' and os.path.exists(self.address):
+            os.remove(self.address)
+
+        self._listener = Listener(self.address, authkey=AUTHKEY)
+        self._queues = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            events = queue.Queue(self.maxsize)
+            with self._lock:
+                self._queues.append(events)
+            thread = threading.Thread(target=self._send, args=(conn, events), daemon=True)
+            thread.start()
+
+    def _send(self, conn, events):
+        while not self._closed:
+            event = events.get()
+            try:
+                conn.send(event)
+            except (OSError, EOFError):
+                break
+        with self._lock:
+            self._queues.remove(events)
+        conn.close()
+
+    def publish(self, event):
+        """Queues event for every connected subscriber, never blocks."""
+        with self._lock:
+            queues = list(self._queues)
+        for events in queues:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+
+    def close(self):
+        self._closed = True
+        try:
+            self._listener.close()
+        except OSError:
+            pass
+
+
+class Subscriber:
+    """Receives the events of the Publisher called name.
+
+    Connects lazily and reconnects when the publisher is restarted, so it can
+    be created before the publishing process is up. With a callback, a
+    background thread keeps connected and calls callback(event) for every
+    event instead of queueing it.
+    """
+
+    def __init__(self, name, callback=None):
+        self.name = name
+        self.address = address(name)
+        self.callback = callback
+        self._queue = queue.Queue()
+        self._conn = None
+        self._closed = False
+
+        if callback is not None:
+            thread = threading.Thread(target=self._listen, daemon=True)
+            thread.start()
+
+    def _listen(self):
+        while not self._closed:
+            self._connect()
+            time.sleep(RECONNECT_INTERVAL)
+
+    def _connect(self):
+        if self._conn is not None:
+            return
+        try:
+            self._conn = Client(self.address, authkey=AUTHKEY)
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            return
+        thread = threading.Thread(target=self._receive, args=(self._conn,), daemon=True)
+        thread.start()
+
+    def _receive(self, conn):
+        while True:
+            try:
+                event = conn.recv()
+            except (OSError, EOFError):
+                break
+            if self.callback is not None:
+                self.callback(event)
+            else:
+                self._queue.put(event)
+        conn.close()
+        if self._conn is conn:
+            self._conn = None
+
+    def get(self, timeout=None):
+        """Returns the next event, or None if none arrives within timeout sec."""
+        self._connect()
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def poll(self):
+        """Returns all events received so far, oldest first."""
+        self._connect()
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        self._closed = True
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
@@ -0,0 +1,86 @@
+"""
+serialframes.py
+
+Splits the byte stream of a serial port into packets that start with a sync
+word, e.g. the Teensy's b'\\xde\\xad\\xbe\\xef' followed by one channel of
+samples.
+
+Bytes come in blocks of whatever the port has buffered (see devicereader.py)
+and go into one preallocated buffer, sync words are found with
+bytearray.find, and packets are handed out as memoryviews into the buffer.
+There are no per-byte Python calls and packets are not copied until the
+caller decodes them (e.g. with np.frombuffer).
+"""
+
+
+class PacketParser:
+    """Packets of packet_length bytes, each following a sync word.
+
+    Like reading byte by byte until the sync word and then reading
+    packet_length bytes, the search for the next sync word starts right
+    after a packet, and bytes before a sync word are skipped (and counted
+    in discarded).
+    """
+
+    def __init__(self, sync, packet_length, capacity=None):
+        self.sync = bytes(sync)
+        self.packet_length = int(packet_length)
+        if capacity is None:
+            capacity = 64 * 1024
+        # room for a few packets, so a block read always ends in free space
+        self.capacity = max(int(capacity), 4 * (len(self.sync) + self.packet_length))
+        self.buffer = bytearray(self.capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0          # first byte not parsed yet
+        self.end = 0            # after the last byte read
+        self.discarded = 0      # bytes skipped looking for a sync word
+
+    def _compact(self):
+        """Moves the unparsed bytes to the front of the buffer."""
+        if self.start == 0:
+            return
+        pending = self.end - self.start
+        # copied first, the two ranges may overlap
+        self.buffer[:pending] = bytes(self.view[self.start:self.end])
+        self.start, self.end = 0, pending
+
+    def free(self):
+        """Writable memoryview of the free end of the buffer, see commit()."""
+        self._compact()
+        return self.view[self.end:]
+
+    def commit(self, num_bytes):
+        """Adds the num_bytes just written to the start of free()."""
+        self.end += num_bytes
+
+    def feed(self, data):
+        """Adds bytes, e.g. a block read from the port."""
+        free = self.free()
+        if len(data) > len(free):
+            raise ValueError('serialframes: {} bytes do not fit in the buffer'.format(len(data)))
+        free[:len(data)] = data
+        self.commit(len(data))
+
+    def packets(self):
+        """The complete packets read so far, without their sync words.
+
+        The memoryviews point into the buffer and are only valid until the
+        next read.
+        """
+        packets = []
+        sync_length = len(self.sync)
+        while True:
+            found = self.buffer.find(self.sync, self.start, self.end)
+            if found < 0:
+                # keep what could be the start of a sync word
+                keep_from = max(self.start, self.end - sync_length + 1)
+                self.discarded += keep_from - self.start
+                self.start = keep_from
+                return packets
+            self.discarded += found - self.start
+            self.start = found
+            packet_start = found + sync_length
+            if packet_start + self.packet_length > self.end:
+                return packets
+            packets.append(self.view[packet_start:packet_start + self.packet_length])
+            self.start = packet_start + self.packet_length
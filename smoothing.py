@@ -0,0 +1,142 @@
+"""
+smoothing.py
+
+Temporal smoothing of the predictions ml.py makes frame after frame, so a
+gesture is reported once it is stable instead of flickering between labels.
+
+A smoother takes one prediction at a time, as class probabilities (see
+observation() for models without probabilities), and returns smoothed class
+probabilities whose argmax is the smoothed label:
+
+- ExponentialSmoother: exponential moving average of the probabilities.
+- MajoritySmoother: share of each label among the last predictions.
+- HMMSmoother: forward algorithm of a hidden Markov model whose hidden state
+  is the gesture being performed and whose observations are the
+  predictions. The gesture changes with probability 1 / window per
+  prediction, so a single odd prediction does not change it, but a few in a
+  row do.
+
+All of them are tuned by window, the number of predictions they smooth over.
+"""
+from collections import deque
+
+import numpy as np
+
+
+HARD_LABEL_WEIGHT = 0.6     # probability given to a label predicted without probabilities
+MIN_PROBABILITY = 1e-6      # keeps one confident prediction from ruling out a label for good
+
+
+def observation(num_classes, index, probabilities=None):
+    """Class probabilities of a prediction of the class at index.
+
+    Models without probabilities only give the label, which is trusted with
+    HARD_LABEL_WEIGHT and the rest is spread over the other classes.
+    """
+    if probabilities is not None:
+        return np.asarray(probabilities, dtype=np.float64)
+    if num_classes == 1:
+        return np.ones(1)
+    observed = np.full(num_classes, (1 - HARD_LABEL_WEIGHT) / (num_classes - 1))
+    observed[index] = HARD_LABEL_WEIGHT
+    return observed
+
+
+class Smoother:
+    """Smooths the class probabilities of consecutive predictions."""
+
+    def __init__(self, num_classes, window):
+        if window < 1:
+            raise ValueError('smoothing: window must be at least 1')
+        self.num_classes = num_classes
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """Forgets the predictions so far, e.g. after the stream had a gap."""
+        raise NotImplementedError
+
+    def update(self, probabilities):
+        """Adds a prediction, returns the smoothed class probabilities."""
+        raise NotImplementedError
+
+
+class ExponentialSmoother(Smoother):
+    """Exponential moving average, with the weight of a window-long simple average."""
+
+    def reset(self):
+        self.alpha = 2 / (self.window + 1)
+        self.average = None
+
+    def update(self, probabilities):
+        if self.average is None:
+            self.average = np.array(probabilities, dtype=np.float64)
+        else:
+            self.average += self.alpha * (probabilities - self.average)
+        return self.average.copy()
+
+
+class MajoritySmoother(Smoother):
+    """Share of each label among the last window predictions.
+
+    Ties go to the label predicted most recently.
+    """
+
+    def reset(self):
+        self.labels = deque(maxlen=self.window)
+        self.counts = np.zeros(self.num_classes)
+
+    def update(self, probabilities):
+        label = int(np.argmax(probabilities))
+        if len(self.labels) == self.labels.maxlen:
+            self.counts[self.labels[0]] -= 1
+        self.labels.append(label)
+        self.counts[label] += 1
+
+        shares = self.counts / len(self.labels)
+        if (shares == shares.max()).sum() > 1 and shares[label] == shares.max():
+            # break the tie without changing the shares noticeably
+            shares[label] += 1e-9
+        return shares
+
+
+class HMMSmoother(Smoother):
+    """Forward algorithm of a hidden Markov model of the gesture.
+
+    The gesture stays the same with probability 1 - 1 / window and changes
+    to any other with equal probability. The model's probabilities are taken
+    as the likelihood of the prediction under each gesture, which holds for
+    classes that are about equally frequent in the training data.
+    """
+
+    def reset(self):
+        self.belief = np.full(self.num_classes, 1 / self.num_classes)
+        self.stay = 1 - 1 / self.window if self.num_classes > 1 else 1
+
+    def update(self, probabilities):
+        if self.num_classes > 1:
+            move = (1 - self.stay) / (self.num_classes - 1)
+            prior = self.stay * self.belief + move * (1 - self.belief)
+        else:
+            prior = self.belief
+        belief = prior * np.maximum(probabilities, MIN_PROBABILITY)
+        self.belief = belief / belief.sum()
+        return self.belief.copy()
+
+
+SMOOTHERS = {
+    'ema': ExponentialSmoother,
+    'majority': MajoritySmoother,
+    'hmm': HMMSmoother,
+}
+
+
+def make_smoother(kind, num_classes, window):
+    """Smoother called kind (ema, majority or hmm), None for none."""
+    kind = kind.strip().lower()
+    if kind in ('', 'none'):
+        return None
+    if kind not in SMOOTHERS:
+        raise ValueError('smoothing: unknown smoothing {}, use one of none, {}'.format(
+            kind, ', '.join(SMOOTHERS)))
+    return SMOOTHERS[kind](num_classes, window)
@@ -0,0 +1,237 @@
+"""
+streaming.py
+
+Building blocks for running inference on a continuous stream of samples
+instead of on whole frames.
+
+The data handlers publish frames that are consecutive blocks of samples,
+shaped (channels, samples). SlidingWindow stitches these blocks back into one
+stream and cuts a window of fixed length out of it every hop samples, so
+predictions happen at a fixed rate (sample rate / hop) and every window is
+exactly as long as a training frame, no matter how large the published
+blocks are. StreamingFeaturizer gives the features of these windows without
+featurizing every window from scratch.
+"""
+from functools import reduce
+from math import gcd
+
+import numpy as np
+
+from utils import Featurization, featurize_batch
+
+
+class SlidingWindow:
+    """Windows of length samples over a stream of blocks, one every hop samples.
+
+    Samples are kept in a buffer that is only compacted when it is full, so
+    pushing a block costs O(block) amortized.
+    """
+
+    def __init__(self, length, hop):
+        if length <= 0 or hop <= 0:
+            raise ValueError('streaming: length and hop must be positive')
+        self.length = int(length)
+        self.hop = int(hop)
+        self.reset()
+
+    def reset(self):
+        """Forgets all samples, e.g. after samples of the stream were lost."""
+        self._buffer = None
+        self._start = 0             # stream index of the first buffered sample
+        self._end = 0               # stream index after the newest sample
+        self._next = self.length    # stream index where the next window ends
+
+    def _make_room(self, num_samples):
+        if self._end - self._start + num_samples <= self._buffer.shape[1]:
+            return
+
+        # drop the samples no window needs anymore
+        keep_from = min(max(self._start, self._next - self.length), self._end)
+        keep = self._end - keep_from
+        offset = keep_from - self._start
+
+        buffer = self._buffer
+        if keep + num_samples > buffer.shape[1]:
+            buffer = np.empty((buffer.shape[0], keep + num_samples + self.length),
+                              dtype=buffer.dtype)
+        buffer[:, :keep] = self._buffer[:, offset:offset + keep]
+        self._buffer = buffer
+        self._start = keep_from
+
+    def push(self, block):
+        """Adds a (channels, samples) block, returns the windows it completed.
+
+        The windows are returned oldest first as a (windows, channels, length)
+        array, which is empty if the block did not complete a window.
+        """
+        block = np.atleast_2d(np.asarray(block))
+        windows = self.windows(block)
+        if not windows:
+            return np.empty((0, block.shape[0], self.length), dtype=block.dtype)
+        return np.stack(windows)
+
+    def windows(self, block):
+        """Adds a (channels, samples) block, returns a list of the windows it
+        completed, oldest first.
+
+        Like push(), but every window is a (channels, length) view into the
+        buffer instead of a copy, so no samples are copied per window. A
+        window is only valid until the next block is added.
+        """
+        block = np.atleast_2d(np.asarray(block))
+        channels, num_samples = block.shape
+
+        if self._buffer is None or self._buffer.shape[0] != channels \
+                or self._buffer.dtype != block.dtype:
+            self.reset()
+            self._buffer = np.empty((channels, 2 * self.length + num_samples), dtype=block.dtype)
+
+        self._make_room(num_samples)
+        offset = self._end - self._start
+        self._buffer[:, offset:offset + num_samples] = block
+        self._end += num_samples
+
+        windows = []
+        while self._next <= self._end:
+            start = self._next - self.length - self._start
+            windows.append(self._buffer[:, start:start + self.length])
+            self._next += self.hop
+        return windows
+
+
+class StreamingFeaturizer:
+    """Features of every window of a stream, as utils.featurize_batch gives them.
+
+    Takes the same (channels, samples) blocks as SlidingWindow. Variance,
+    Mean, Sum, Min, Max and Derivative are binned statistics, so instead of
+    featurizing every window from scratch the stream is summarized in chunks
+    of g samples as it arrives (sum, sum of squared deviations, min, max,
+    first or last sample, whichever the featurization needs). g divides the
+    hop, the bin size and the window, so every bin of every window is made of
+    whole chunks and its feature is combined from chunk summaries. A push then
+    costs O(block) plus O(window / g) per window, instead of O(window).
+
+    Chunk summaries only pay off for long windows, the other featurizations
+    and short windows are featurized from the windows of a SlidingWindow.
+    """
+
+    CHUNK_FEATURIZATIONS = {
+        Featurization.Variance: ('sum', 'm2'),
+        Featurization.Mean: ('sum',),
+        Featurization.Sum: ('sum',),
+        Featurization.Min: ('min',),
+        Featurization.Max: ('max',),
+        Featurization.Derivative: ('first', 'last'),
+    }
+    MIN_CHUNK = 4                   # smallest chunk worth summarizing
+    MIN_CHUNK_WINDOW = 16384        # samples over all channels
+
+    def __init__(self, length, hop, featurization_type, numbins, sample_rate=None):
+        self.length = int(length)
+        self.hop = int(hop)
+        self.featurization_type = featurization_type
+        self.numbins = numbins
+        self.sample_rate = sample_rate
+        self.binnable_length = self.length // numbins * numbins
+        if self.binnable_length == 0:
+            raise ValueError('streaming: window of {} samples is shorter than {} bins'.format(
+                self.length, numbins))
+        self.reset()
+
+    def reset(self):
+        """Forgets the stream, e.g. after samples were lost."""
+        self._channels = None
+        self._windows = None
+        self._chunk = None
+        self._tail = None
+
+    def _start(self, channels):
+        """Sets up the state for a stream of channels channels."""
+        self._channels = channels
+        self._chunk = None
+        self._windows = SlidingWindow(self.length, self.hop)
+        if self.featurization_type not in self.CHUNK_FEATURIZATIONS \
+                or channels * self.length < self.MIN_CHUNK_WINDOW:
+            return
+
+        bin_size = channels * self.binnable_length // self.numbins
+        chunk = reduce(gcd, [self.hop, bin_size, self.binnable_length, self.length])
+        if chunk < self.MIN_CHUNK:
+            return
+        self._chunk = chunk
+        self._tail = np.empty((channels, 0))
+        # windows over the stream of chunk summaries, one row per field and channel
+        self._windows = SlidingWindow(self.length // chunk, self.hop // chunk)
+
+    def push(self, block):
+        """Adds a (channels, samples) block, returns a (windows, features) array
+        with the features of the windows it completed, oldest first."""
+        block = np.atleast_2d(np.asarray(block, dtype=float))
+        if self._channels != block.shape[0]:
+            self.reset()
+            self._start(block.shape[0])
+
+        if self._chunk is not None:
+            return self._push_chunks(block)
+
+        windows = self._windows.push(block)
+        if len(windows) == 0:
+            return np.empty((0, 0))
+        return featurize_batch(windows, featurization_type=self.featurization_type,
+                               numbins=self.numbins, sample_rate=self.sample_rate, batch_dims=1)
+
+    def _summarize(self, chunks):
+        """Summaries of (channels, chunks, g) samples, stacked field by field."""
+        fields = []
+        for field in self.CHUNK_FEATURIZATIONS[self.featurization_type]:
+            if field == 'sum':
+                fields.append(chunks.sum(axis=2))
+            elif field == 'm2':
+                means = fields[0] / self._chunk
+                fields.append(((chunks - means[:, :, None]) ** 2).sum(axis=2))
+            elif field == 'min':
+                fields.append(chunks.min(axis=2))
+            elif field == 'max':
+                fields.append(chunks.max(axis=2))
+            elif field == 'first':
+                fields.append(chunks[:, :, 0])
+            else:
+                fields.append(chunks[:, :, -1])
+        return np.concatenate(fields)
+
+    def _push_chunks(self, block):
+        g = self._chunk
+        samples = np.concatenate([self._tail, block], axis=1)
+        complete = samples.shape[1] // g * g
+        self._tail = samples[:, complete:]
+
+        chunks = samples[:, :complete].reshape(self._channels, -1, g)
+        windows = self._windows.push(self._summarize(chunks))
+        if len(windows) == 0:
+            return np.empty((0, self.numbins))
+
+        # (windows, fields, channels, chunks) of the binnable part, channels
+        # flattened like featurize does, then split into bins of whole chunks
+        num_windows = len(windows)
+        num_fields = len(self.CHUNK_FEATURIZATIONS[self.featurization_type])
+        windows = windows.reshape(num_windows, num_fields, self._channels, -1)
+        windows = windows[:, :, :, :self.binnable_length // g]
+        bins = windows.reshape(num_windows, num_fields, self.numbins, -1)
+        bin_size = bins.shape[3] * g
+
+        if self.featurization_type == Featurization.Mean:
+            return bins[:, 0].sum(axis=2) / bin_size
+        if self.featurization_type == Featurization.Sum:
+            return bins[:, 0].sum(axis=2)
+        if self.featurization_type == Featurization.Min:
+            return bins[:, 0].min(axis=2)
+        if self.featurization_type == Featurization.Max:
+            return bins[:, 0].max(axis=2)
+        if self.featurization_type == Featurization.Derivative:
+            # the mean of the differences telescopes to (last - first) / (n - 1)
+            return (bins[:, 1, :, -1] - bins[:, 0, :, 0]) / (bin_size - 1)
+        # variance of a bin from its chunks, Chan et al.'s parallel algorithm
+        chunk_means = bins[:, 0] / g
+        bin_means = chunk_means.mean(axis=2)
+        m2 = bins[:, 1].sum(axis=2) + g * ((chunk_means - bin_means[:, :, None]) ** 2).sum(axis=2)
+        return m2 / bin_size
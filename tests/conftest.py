@@ -0,0 +1,23 @@
+"""
+Fixtures of the tests. Like the benchmarks, the project directory is put on
+the path and ml.py is imported from it so it reads the project's config.ini.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def ml():
+    """ml.py, imported with the project's config.ini."""
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        import ml
+    finally:
+        os.chdir(cwd)
+    return ml
@@ -0,0 +1,69 @@
+"""
+ml.py: commands handled by a single ml.py process.
+"""
+import numpy as np
+
+import datastore
+import framebus
+import msgbus
+from benchmarks import frames
+
+
+def write_training_data(path, rounds):
+    """Appends {label: rounds} to the training data in path and writes its manifest."""
+    files = []
+    for label, data in rounds.items():
+        filename = str(path / datastore.file_name(label))
+        datastore.append(filename, data)
+        files.append(filename)
+    datastore.write_manifest(files, str(path / 'training_data.json'))
+
+
+def train(ml):
+    """Sends TRAIN like ui.py does and runs ml.py's loop until the model is swapped in."""
+    ml.read_message('TRAIN')
+    ml.ml_main()
+    ml.training.result(timeout=60)
+    assert ml.commands.get(timeout=5) == 'TRAINED'
+    ml.read_message('TRAINED')
+
+
+def test_second_train_updates_model(ml, tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(ml, 'INCREMENTAL_TRAINING', True)
+    monkeypatch.setattr(ml, 'COMPILED_INFERENCE', False)
+    monkeypatch.setattr(ml, 'curr_algo_index', ml.algos.index('sgd'))
+    monkeypatch.setattr(ml, 'commands', msgbus.CommandServer('ml'))
+    # no data handler runs, there is never a frame to predict on
+    monkeypatch.setattr(ml, 'frame_reader', framebus.FrameReader())
+    monkeypatch.setattr(ml, 'last_seq', 0)
+    monkeypatch.setattr(ml, 'events', None)
+    for name in ['le', 'model', 'predictor', 'training', 'saved_model']:
+        monkeypatch.setattr(ml, name, None)
+    monkeypatch.setattr(ml, 'trained_features', {})
+    monkeypatch.setattr(ml, 'is_inferencing', False)
+
+    partial_fits = []
+    partial_fit = ml.SGDClassifier.partial_fit
+
+    def spy(model, X, y, *args, **kwargs):
+        partial_fits.append(len(X))
+        return partial_fit(model, X, y, *args, **kwargs)
+
+    monkeypatch.setattr(ml.SGDClassifier, 'partial_fit', spy)
+
+    rng = np.random.default_rng(0)
+    write_training_data(tmp_path, frames.training_rounds('mobile', rng, rounds=2))
+    train(ml)
+    first_model = ml.model
+    assert first_model is not None and ml.is_inferencing
+    assert partial_fits == []
+
+    # one more round of every label, then T again
+    write_training_data(tmp_path, frames.training_rounds('mobile', rng, rounds=1))
+    train(ml)
+    ml.commands.close()
+
+    assert len(partial_fits) == 1
+    assert ml.model is not first_model
+    assert all(len(features) == 3 * 5 for features in ml.trained_features.values())
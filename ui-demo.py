@@ -34,6 +34,10 @@ from ui_assets.ui_steps import StepsBar
 
 # Self-define functions
 import utils
+import msgbus
+import framebus
+import datastore
+import latency
 from functools import partial
 
 #================================================================
@@ -54,6 +58,7 @@ DS_FILE_NUM    =  int(config['DS'    ]['DS_FILE_NUM'    ])
 
 SAMPLE_RATE = int(config['DS']['SAMPLE_RATE'])
 NUM_BINS = int(config['ML']['NUM_BINS'])
+LATENCY_LOG_INTERVAL = float(config['ML'].get('LATENCY_LOG_INTERVAL', 0))
 
 # Get data collection .py filename
 ds_filename = DS_FILENAMES[DS_FILE_NUM]
@@ -65,6 +70,7 @@ does_support_signals=utils.does_support_signals()
 
 # For Qt
 SETUP_TIME = 7 # time for subprocesses to write their pid numbers to file
+PLOT_INTERVAL = 16 # ms between checks for a new frame to plot, about 60 FPS
 window = None # hold onto window for interrupts
 FPS_COUNTER_RATE = 3  # sec
 
@@ -80,6 +86,9 @@ def receive_signal(signum, stack):
 	sys.exit()
 
 class T4Train(QtWidgets.QMainWindow):
+	# predictions pushed by ml.py, emitted from the subscriber's thread
+	prediction_received = QtCore.pyqtSignal(object)
+
 	def __init__(self, ds_filename):
 		super(T4Train, self).__init__()
 		self.ds_filename = ds_filename
@@ -88,6 +97,7 @@ class T4Train(QtWidgets.QMainWindow):
 		
 		# delete any existing files from a previous session
 		utils.delete_files_ending_in([".npy", ".txt", ".png", ".wav"])
+		utils.delete_files_matching(["training_data.json", "features_*.npz"])
 
 
 		# start data collection subprocess
@@ -115,6 +125,18 @@ class T4Train(QtWidgets.QMainWindow):
 			except:
 				continue
 
+		# command channels to the ML and data handler processes
+		self.ml_bus = msgbus.CommandClient("ml")
+		self.ds_bus = msgbus.CommandClient("ds")
+
+		# progress of long ML tasks
+		self.ml_events = msgbus.Subscriber("ml_events")
+		self.latency_stats = latency.LatencyStats("ui.py", LATENCY_LOG_INTERVAL)
+
+		# every prediction, shown as soon as ml.py makes it
+		self.prediction_received.connect(self.update_prediction)
+		self.predictions = msgbus.Subscriber("predictions", callback=self.prediction_received.emit)
+
 		# set up labels from configurations
 		self.labels = Labels(LABELS, self)
 
@@ -127,6 +149,10 @@ class T4Train(QtWidgets.QMainWindow):
 		self.fps_label.setText("FPS: {}".format(self.num_frames))
 		self.setWindowTitle("T for Train - Demo")
 		
+		# live frames published by the data handler
+		self.frame_reader = framebus.FrameReader()
+		self.frame_seq = 0
+
 		# graphs
 		self.graphs = []
 
@@ -214,6 +240,12 @@ class T4Train(QtWidgets.QMainWindow):
 		# change line thickness
 		self.graph_width = []
 		self.feat_width = []
+		self.graph_curves = []
+		self.feat_curves = []
+
+		# x axes of the plots by length of the data, they only change with it
+		self.x_axes = {}
+		self.fft_freqs = {}
 
 		# setup graphs
 		pg.setConfigOption('background', (44, 44, 46))
@@ -228,6 +260,7 @@ class T4Train(QtWidgets.QMainWindow):
 			graphWidget.disableAutoRange(True)
 			graphWidget.setDragMode(0)
 			self.graphs.append(graphWidget)
+			self.graph_curves.append(self.new_curve(graphWidget))
 			self.graph_mins.append(0)
 			self.graph_maxes.append(0)
 			self.graph_width.append(8)
@@ -240,10 +273,12 @@ class T4Train(QtWidgets.QMainWindow):
 			title.setText('Channel %d Featurization (%s)' % (i+1, self.feature.name))
 			self.feature_titles.append(title)
 			self.feat_plots.append(feat)
+			self.feat_curves.append(self.new_curve(feat))
 			self.feat_mins.append(0)
 			self.feat_maxes.append(0)
 			self.feat_width.append(8)
 
+		self.set_pens()
 		self.add_line_thickness_menu()
 
 		# add widgets into layouts
@@ -282,10 +317,10 @@ class T4Train(QtWidgets.QMainWindow):
 		# setup timer
 		self.plot_timer = QtCore.QTimer()
 		self.plot_timer.timeout.connect(self.update_points)
-		self.plot_timer.start(100)
+		self.plot_timer.start(PLOT_INTERVAL)
 
 		self.prediction_timer = QtCore.QTimer()
-		self.prediction_timer.timeout.connect(self.update_prediction)
+		self.prediction_timer.timeout.connect(self.update_ml_progress)
 		self.prediction_timer.start(300)
 
 		self.fps_timer = QtCore.QTimer()
@@ -312,22 +347,17 @@ class T4Train(QtWidgets.QMainWindow):
 		"""Called on exit."""
 		# delete files from current session
 		utils.delete_files_ending_in([".npy", ".txt", ".png", ".wav"])
+		utils.delete_files_matching(["training_data.json", "features_*.npz"])
 
 		# Close data collection .py
 		try:
-			utils.write_cmd_message("ds_cmd.txt", "BYE")
-
-			if does_support_signals:
-				os.kill(self.ds_pid, signal.SIGINT)
+			self.ds_bus.send("BYE")
 		except Exception as e:
 			print(e)
 
 		# Close machine learning .py
 		try:
-			utils.write_cmd_message("ml_cmd.txt", "BYE")
-
-			if does_support_signals:
-				os.kill(self.ml_pid, signal.SIGINT)
+			self.ml_bus.send("BYE")
 		except Exception as e:
 			print(e)
 
@@ -347,7 +377,8 @@ class T4Train(QtWidgets.QMainWindow):
 		# L
 		elif event.key()==QtCore.Qt.Key_L:
 			self.stepsbar.set_state(0, 1)
-			self.on_load()
+			# keep predicting with a loaded model
+			should_stop_predicting = not self.on_load()
 		# S
 		elif event.key()==QtCore.Qt.Key_S:
 			self.stepsbar.set_state(2, 1)
@@ -398,38 +429,57 @@ class T4Train(QtWidgets.QMainWindow):
 	def stop_predicting(self):
 		"""Stop predicting."""
 		self.is_predicting=False
-		utils.write_cmd_message("ml_cmd.txt", "STOP PREDICTING")
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
+		self.ml_bus.send("STOP PREDICTING")
+
+	def update_ml_progress(self, *args):
+		"""Show progress events sent by ml.py."""
+		for event in self.ml_events.poll():
+			if event.get('task') == 'train':
+				if event['total'] == 0:
+					self.footer.setText("Training failed, see the ml.py output.")
+				else:
+					self.is_predicting=True
+					self.model_exists =True
+					self.footer.setText("Model trained.")
+				continue
+			if event.get('task') == 'load':
+				if event['total'] == 0:
+					self.is_predicting=False
+					self.model_exists =False
+					self.footer.setText("Could not load the saved model, press T to train.")
+				continue
+			if event.get('task') != 'confusion':
+				continue
+			if event['total'] == 0:
+				self.footer.setText("Could not compute confusion matrix.")
+			elif event['done'] < event['total']:
+				self.footer.setText("Confusion matrix: fold {} of {} done.".format(
+									event['done'], event['total']))
+			else:
+				self.footer.setText("Confusion matrix written to file.")
+		self.latency_stats.report()
 
-	def update_prediction(self, *args):
-		"""Write prediction."""
-		if self.is_predicting:
-			try:
-				text_str="Current Prediction: {}".format(np.load('prediction.npy')[0])
-				self.footer.setText(text_str)
-			except Exception as e:
-				return
+	def update_prediction(self, prediction):
+		"""Show a prediction pushed by ml.py."""
+		if not self.is_predicting:
+			return
+		text_str="Current Prediction: {}".format(prediction['label'])
+		if prediction['probabilities'] is not None:
+			text_str+=" ({:.0%})".format(prediction['probabilities'][prediction['label']])
+		self.footer.setText(text_str)
+		self.latency_stats.since('display', prediction['predicted'])
+		self.latency_stats.since('total', prediction['captured'])
 
 	def prepare_ml_input_files(self):
-		"""Create training_data.npy and training_labels.npy for training."""
-		try:
-			os.remove("training_labels.npy")
-		except OSError:
-			pass
-
+		"""Create training_data.json, the manifest of the training data, for training."""
 		try:
-			os.remove("training_data.npy")
+			os.remove("training_data.json")
 		except OSError:
 			pass
 
 		training_data_files, labels = utils.get_training_data_files_and_labels(self.labels.label_raw_text)
 
-		utils.write_training_labels(training_data_files,
-									labels,
-									"training_labels.npy")
-
-		utils.compile_all_training_data(training_data_files, "training_data")
+		utils.compile_all_training_data(training_data_files, "training_data.json")
 
 	def update_points(self):
 		"""Read current frame and plot points."""
@@ -446,52 +496,77 @@ class T4Train(QtWidgets.QMainWindow):
 			except Exception as e:
 				pass
 
+		# only redraw when the data handler published a new frame
+		seq, frame = self.frame_reader.latest()
+		if frame is None or seq == self.frame_seq:
+			return
+		self.frame_seq = seq
+
 		try:
-			self.curr_frame = np.load('tmpframe.npy').astype(np.float)
+			self.curr_frame = frame.astype(np.float)
 			npy_data = self.curr_frame[:, :-2]
 		except Exception as e:
 			return
 
-		x_linspace=np.linspace(start=0, stop=100, num=len(npy_data[0]))
-		xs, ys=[], []
-		for i in range(0, CHANNELS):
-			for x_element, y_element in zip(x_linspace, npy_data[i]):
-				xs.append(float(x_element))
-				ys.append(float(y_element))
+		# one row of samples per channel, e.g. camera frames are (2, 21, 1)
+		npy_data = npy_data.reshape(len(npy_data), -1)[:CHANNELS]
+		x_axis = self.x_axis(npy_data.shape[1])
 
-			y_max = max(ys)
-			y_min = min(ys)
+		# featurize every channel at once, one row per channel
+		features = utils.featurize_batch(npy_data, featurization_type=self.feature, numbins=NUM_BINS,
+										 sample_rate=SAMPLE_RATE, batch_dims=1)
+		# special x scale for FFT
+		if self.feature == utils.Featurization.FFT:
+			feat_x_axis = self.fft_x_axis(npy_data.shape[1])
+		else:
+			feat_x_axis = self.x_axis(features.shape[1], stop=features.shape[1] - 1)
 
-			if y_max > self.graph_maxes[i]:
-				self.graph_maxes[i] = y_max
-			if y_min < self.graph_mins[i]: 
-				self.graph_mins[i] = y_min
+		y_maxes = npy_data.max(axis=1)
+		y_mins = npy_data.min(axis=1)
+		for i in range(len(npy_data)):
+			if y_maxes[i] > self.graph_maxes[i] or y_mins[i] < self.graph_mins[i]:
+				self.graph_maxes[i] = max(self.graph_maxes[i], y_maxes[i])
+				self.graph_mins[i] = min(self.graph_mins[i], y_mins[i])
+				self.graphs[i].setYRange(self.graph_mins[i], self.graph_maxes[i], padding=0.1)
 
-			self.graphs[i].clear()
-			self.graphs[i].setYRange(self.graph_mins[i], self.graph_maxes[i], padding=0.1)
-			self.graphs[i].plot(xs, ys, pen = pg.mkPen('w', width = self.graph_width[i]))
+			self.graph_curves[i].setData(x_axis, npy_data[i])
+			self.feat_curves[i].setData(feat_x_axis, features[i])
 
-			xs, ys = [], []
+		self.num_frames += 1
 
-			# featurize plots
-			reframe = utils.featurize(npy_data[i], featurization_type=self.feature, numbins=NUM_BINS, sample_rate=SAMPLE_RATE)
+	def new_curve(self, plot_widget):
+		"""Curve that is kept and updated with setData for every frame.
 
-			self.feat_plots[i].clear()
+		Long frames are drawn downsampled to the width of the plot.
+		"""
+		curve = plot_widget.plot()
+		curve.setDownsampling(auto=True, method='peak')
+		curve.setClipToView(True)
+		return curve
 
-			# special x scale for FFT
-			if self.feature == utils.Featurization.FFT:
-				newfreqs = np.fft.rfftfreq(npy_data[i].shape[0] // NUM_BINS * NUM_BINS, d=1./SAMPLE_RATE)
+	def set_pens(self):
+		"""Draw the curves with the line thickness picked in the menus."""
+		for i in range(CHANNELS):
+			self.graph_curves[i].setPen(pg.mkPen('w', width=self.graph_width[i]))
+			self.feat_curves[i].setPen(pg.mkPen('y', width=self.feat_width[i]))
 
-				# calculating how data can be binned + dropped index
-				binnable_length = (len(newfreqs[1:]) // NUM_BINS * NUM_BINS) + 1
+	def x_axis(self, length, stop=100):
+		"""length points evenly spaced from 0 to stop."""
+		if (length, stop) not in self.x_axes:
+			self.x_axes[(length, stop)] = np.linspace(start=0, stop=stop, num=length)
+		return self.x_axes[(length, stop)]
 
-				# drop first entry in `newfreqs` to ignore 0 hz frequency
-				newfreqs = np.mean(np.reshape(newfreqs[1:binnable_length], (NUM_BINS, -1)), axis=1)
-				self.feat_plots[i].plot(newfreqs, reframe[:, 0], pen = pg.mkPen('y', width=self.feat_width[i]))
-			else:
-				self.feat_plots[i].plot(range(len(reframe)), reframe[:,0], pen=pg.mkPen('y', width=self.feat_width[i]))
+	def fft_x_axis(self, length):
+		"""Center frequency of each FFT feature bin of a channel of length samples."""
+		if length not in self.fft_freqs:
+			newfreqs = np.fft.rfftfreq(length // NUM_BINS * NUM_BINS, d=1./SAMPLE_RATE)
 
-		self.num_frames += 1
+			# calculating how data can be binned + dropped index
+			binnable_length = (len(newfreqs[1:]) // NUM_BINS * NUM_BINS) + 1
+
+			# drop first entry in `newfreqs` to ignore 0 hz frequency
+			self.fft_freqs[length] = np.mean(np.reshape(newfreqs[1:binnable_length], (NUM_BINS, -1)), axis=1)
+		return self.fft_freqs[length]
 
 	def on_spacebar(self):
 		"""Collect frames."""
@@ -502,11 +577,8 @@ class T4Train(QtWidgets.QMainWindow):
 
 		self.footer.setText("Sending message to data source.")
 
-		# send signal to ds.py to collect #instances frames
-		utils.write_cmd_message("ds_cmd.txt", "SPACEBAR")
-
-		if does_support_signals:
-			os.kill(self.ds_pid, signal.SIGINT)
+		# tell ds.py to collect #instances frames
+		self.ds_bus.send("SPACEBAR")
 
 		self.footer.setText("Collecting "+str(INSTANCES)+" frames.")
 
@@ -519,7 +591,7 @@ class T4Train(QtWidgets.QMainWindow):
 
 		num_collected = 0
 		if os.path.exists(current_training_data_file_name):
-			num_collected = np.load(current_training_data_file_name).shape[0]
+			num_collected = datastore.num_rounds(current_training_data_file_name)
 
 		# DVS: this is locking ui up, fix?
 		# Tried semaphore, link keypress to another routine function at init, still locked
@@ -527,8 +599,8 @@ class T4Train(QtWidgets.QMainWindow):
 			if os.path.exists(current_training_data_file_name):
 				try:
 					# DVS: What is this? if a==b+1?
-					if np.load(current_training_data_file_name). \
-							shape[0] == num_collected + 1:
+					if datastore.num_rounds(current_training_data_file_name) == \
+							num_collected + 1:
 						break
 				except Exception as e:
 					continue
@@ -537,7 +609,7 @@ class T4Train(QtWidgets.QMainWindow):
 		self.footer.setText("Done Collecting Frames.")
 
 	def on_load(self):
-		"""L for Load."""
+		"""L for Load. Returns True if a saved model was loaded."""
 		global INSTANCES
 		if not os.path.exists("saved_files/import/"):
 			self.footer.text = "Failed to Load Data. No such path " \
@@ -545,7 +617,8 @@ class T4Train(QtWidgets.QMainWindow):
 		else:
 			# copy files into current directory
 			for item in os.listdir("saved_files/import/"):
-				copy("saved_files/import/%s" % item, os.getcwd())
+				if os.path.isfile("saved_files/import/%s" % item):
+					copy("saved_files/import/%s" % item, os.getcwd())
 			self.footer.setText("Copied saved_files/import/ to current dir")
 
 			# get all training data files
@@ -553,11 +626,20 @@ class T4Train(QtWidgets.QMainWindow):
 
 			# update frame counts based on loaded files
 			for i in range(len(training_data_files)):
-				num_frames=np.load(training_data_files[i]).shape[0]
+				num_frames=datastore.num_rounds(training_data_files[i])
 				self.labels.frames_collected[i]=num_frames*INSTANCES
 
 			self.labels.set_label_text()
 
+			# predict with the saved model right away, without retraining
+			if os.path.isdir("saved_files/import/model_bundle/"):
+				self.ml_bus.send("LOAD_MODEL, saved_files/import/model_bundle/")
+				self.is_predicting=True
+				self.model_exists =True
+				self.footer.setText("Loaded saved_files/import/ and its model")
+				return True
+		return False
+
 	def on_save(self):
 		"""S for save."""
 		self.is_predicting=False
@@ -571,11 +653,8 @@ class T4Train(QtWidgets.QMainWindow):
 		if not os.path.exists(os.path.join(os.getcwd(), curr_time)):
 			os.makedirs(os.path.join("saved_files", curr_time))
 
-		# send signal to ml to save model
-		utils.write_cmd_message("ml_cmd.txt", "SAVE, {}".format(curr_time))
-
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
+		# tell ml to save model
+		self.ml_bus.send("SAVE, {}".format(curr_time))
 
 		for item in os.listdir(os.getcwd()):
 			if item.startswith('training_data_') and item.endswith('.npy'):
@@ -590,54 +669,26 @@ class T4Train(QtWidgets.QMainWindow):
 		# prepare compiled file of training data and training labels
 		self.prepare_ml_input_files()
 
-		# send signal to ML to begin training
-		utils.write_cmd_message("ml_cmd.txt", "TRAIN")
-
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
+		# tell ML to begin training
+		self.ml_bus.send("TRAIN")
 
 		self.is_predicting=True
 		self.model_exists =True
 
 	def on_retrain(self):
 		"""T for Retrain."""
-		self.is_predicting=False
-		self.model_exists =False
-
 		self.footer.setText("Retraining...")
 
-		# kill current ml process
-		utils.write_cmd_message("ml_cmd.txt", "BYE")
-
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
-
-		# restart ml process
-		self.ml_subprocess=subprocess.Popen("python ml.py", shell=True)
-		while True:
-			try:
-				self.ml_pid = utils.read_pid_num("ml_pidnum.txt")
-				break
-			except:
-				continue
-
 		# prepare compiled file of training data and training labels
 		self.prepare_ml_input_files()
 
-		utils.write_cmd_message("ml_cmd.txt", "TRAIN")
-
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
-
-		self.is_predicting=True
-		self.model_exists =True
+		# the current model keeps predicting until ml.py swaps the new one in
+		self.ml_bus.send("TRAIN")
 
 	def on_feature_importance(self):
 		"""I for feature importance."""
 		self.prepare_ml_input_files()
-		utils.write_cmd_message("ml_cmd.txt", "FEATURE_IMPORTANCE")
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
+		self.ml_bus.send("FEATURE_IMPORTANCE")
 		self.footer.setText("Feature Importances written to feature_"
 							"importances.csv")
 
@@ -645,9 +696,7 @@ class T4Train(QtWidgets.QMainWindow):
 		"""M for ML algorithm toggle."""
 		global ALGOS, CURR_ALGO_INDEX
 		CURR_ALGO_INDEX = utils.increment_algo_ind(CURR_ALGO_INDEX, ALGOS)
-		utils.write_cmd_message("ml_cmd.txt", "TOGGLE_ALGO_" + str(CURR_ALGO_INDEX))
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
+		self.ml_bus.send("TOGGLE_ALGO_" + str(CURR_ALGO_INDEX))
 		self.footer.setText("Machine Learning Algorithm Switched to %s" %
 							ALGOS[CURR_ALGO_INDEX])
 
@@ -655,10 +704,8 @@ class T4Train(QtWidgets.QMainWindow):
 		"""C for confusion matrix."""
 		# prepare compiled file of training data and training labels
 		self.prepare_ml_input_files()
-		utils.write_cmd_message("ml_cmd.txt", "CONFUSION")
-		if does_support_signals:
-			os.kill(self.ml_pid, signal.SIGINT)
-		self.footer.setText("Confusion matrix written to file.")
+		self.ml_bus.send("CONFUSION")
+		self.footer.setText("Computing confusion matrix...")
 
 	def on_delete_frame(self):
 		"""Backspace for delete frame."""
@@ -670,9 +717,8 @@ class T4Train(QtWidgets.QMainWindow):
 
 		# delete frame from selected label
 		if os.path.exists(current_training_data_file_name):
-			current_frames=np.load(current_training_data_file_name)
-			current_frames=current_frames[:-1]
-			np.save(current_training_data_file_name, current_frames)
+			datastore.truncate(current_training_data_file_name,
+							   datastore.num_rounds(current_training_data_file_name) - 1)
 
 		# decrement frame count on UI
 		self.labels.add_frames_current_label(-INSTANCES)
@@ -728,6 +774,7 @@ class T4Train(QtWidgets.QMainWindow):
 		"""add line thickness into context menu"""
 		def line_thickness_change(width_list, index, value):
 			width_list[index] = value
+			self.set_pens()
 
 		def new_slider_thickness():
 			slider = QtWidgets.QSlider(Qt.Horizontal)
@@ -771,9 +818,7 @@ class T4Train(QtWidgets.QMainWindow):
 				CURR_ALGO_INDEX = index
 
 				# send algo change message to ml
-				utils.write_cmd_message("ml_cmd.txt", "TOGGLE_ALGO_" + str(CURR_ALGO_INDEX))
-				if does_support_signals:
-					os.kill(self.ml_pid, signal.SIGINT)
+				self.ml_bus.send("TOGGLE_ALGO_" + str(CURR_ALGO_INDEX))
 
 			self.footer.setText("Machine Learning Algorithm Switched to %s" % \
 					ALGOS[CURR_ALGO_INDEX])
@@ -833,6 +878,7 @@ class T4Train(QtWidgets.QMainWindow):
 			for i in range(CHANNELS):
 				self.graph_width[i] = value
 				self.feat_width[i] = value
+			self.set_pens()
 
 		self.menu_line_thickness = self.menuUser.addMenu('Line Thickness')
 		slider = get_slider(value=5, minimum=1, maximum=10)
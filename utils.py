@@ -8,13 +8,22 @@ Reusable in other py files.
 """
 from sys import platform
 import numpy as np
+import fnmatch
+import hashlib
 import os
 
+import datastore
+
 
 def does_support_signals():
     return not platform == "win32"
 
 
+def session_id():
+    """Short id shared by all processes of the T4Train session in this dir."""
+    return hashlib.md5(os.getcwd().encode()).hexdigest()[:10]
+
+
 def delete_files_ending_in(file_types):
     """Deletes any files that have a extension in file_types (List)."""
     dir = os.getcwd()
@@ -29,6 +38,14 @@ def delete_files_ending_in(file_types):
                 break
 
 
+def delete_files_matching(patterns):
+    """Deletes any files whose name matches a glob pattern in patterns (List)."""
+    dir = os.getcwd()
+    for item in os.listdir(dir):
+        if any(fnmatch.fnmatch(item, pattern) for pattern in patterns):
+            os.remove(os.path.join(dir, item))
+
+
 def write_label(label, filename):
     """Sanitizes and writes label to filename."""
     label = label.lower().strip().replace(" ", "_")
@@ -37,11 +54,6 @@ def write_label(label, filename):
         f.close()
 
 
-def write_cmd_message(filename, message):
-    with open(filename, "w") as f:
-      f.write(message)
-
-
 def read_pid_num(filename):
     ml_path = os.path.join(os.getcwd(), filename)
     f = open(ml_path, "r")
@@ -70,46 +82,12 @@ def get_training_data_files_and_labels(labels_raw_text):
     return [training_data_files, labels]
 
 
-def write_training_labels(training_data_files, labels, filename):
-    """Write npy file of labels (input for ML)."""
-    # write as many labels as rounds collected for each training file
-    for file, label in zip(training_data_files, labels):
-
-        num_rounds = np.load(file).shape[0]
-
-        training_labels = np.array([])
-
-        if os.path.exists(filename):
-            # read current training_labels file if exists
-            training_labels = np.load(filename)
-
-        # write labels for each round
-        for i in range(0, num_rounds):
-            training_labels = np.append(training_labels,
-                                        [label],
-                                        axis=0)
-
-        # save ndarray of shape (rounds, 1) to npy file
-        np.save(filename, training_labels)
-
-
 def compile_all_training_data(training_data_files, filename):
-    """Compiles all training data files into one file (input for ML)."""
-    if len(training_data_files) > 0:
-        all_training_data = np.load(training_data_files[0])
+    """Writes the manifest of all training data files and labels (input for ML).
 
-        np.save(filename, all_training_data)
-
-        for i in range(1, len(training_data_files)):
-            file = training_data_files[i]
-
-            current_training_data = np.load(file)
-
-            all_training_data = np.append(all_training_data,
-                                          current_training_data,
-                                          axis=0)
-
-            np.save(filename, all_training_data)
+    Only the number of rounds in each file is recorded, the data is not copied.
+    """
+    datastore.write_manifest(training_data_files, filename)
 
 
 def increment_algo_ind(curr_ind, algos):
@@ -191,3 +169,53 @@ def featurize(input_frame, featurization_type=Featurization.Raw, numbins=60, sam
         rfft_out = np.reshape(rfft_out, (-1, 1))
         return rfft_out
 
+
+
+# input shape is (..., c, s): the first batch_dims axes index the frames, e.g.
+# (rounds, instances, c, s) for training data. Returns (n_frames, n_features)
+# with the same features featurize gives for every frame on its own.
+def featurize_batch(frames, featurization_type=Featurization.Raw, numbins=60, sample_rate=None, batch_dims=2):
+    frames = np.asarray(frames)
+    frame_shape = frames.shape[batch_dims:]
+    frames = np.reshape(frames, (-1,) + frame_shape)
+    num_frames = frames.shape[0]
+
+    # for feats that don't use binning, just ravel the data without a bin check
+    if featurization_type == Featurization.Raw:
+        return np.reshape(frames, (num_frames, -1))
+    if featurization_type == Featurization.Delta:
+        return np.reshape(frames - frames[:, :1], (num_frames, -1))
+
+    # same cut as featurize: samples which do not make up a multiple of numbins
+    if len(frame_shape) > 1:
+        binnable_length = frame_shape[1] // numbins * numbins
+        frames = frames[:, :, :binnable_length]
+    else:
+        binnable_length = frame_shape[0] // numbins * numbins # case of only one channel
+        frames = frames[:, :binnable_length]
+    frames = np.reshape(frames, (num_frames, -1))
+
+    if featurization_type == Featurization.RootMeanSquare:
+        return np.sqrt((1/numbins)*(frames**2))
+    if featurization_type == Featurization.FFT:
+        # one rfft per frame over all of its channels, like featurize
+        rfft_out = np.abs(np.fft.rfft(frames, axis=1, norm=None))
+
+        # drop the 0th index representing 0 * fs, then bin
+        binnable_length = ((rfft_out.shape[1] - 1) // numbins * numbins) + 1
+        rfft_out = np.reshape(rfft_out[:, 1:binnable_length], (num_frames, numbins, -1))
+        return np.sum(rfft_out, axis=2)
+
+    reframe = np.reshape(frames, (num_frames, numbins, -1))
+    if featurization_type == Featurization.Variance:
+        return np.var(reframe, axis=2)
+    elif featurization_type == Featurization.Sum:
+        return np.sum(reframe, axis=2)
+    elif featurization_type == Featurization.Derivative:
+        return -1 * np.mean(reframe[:, :, 0:-1] - reframe[:, :, 1:], axis=2)
+    elif featurization_type == Featurization.Mean:
+        return np.mean(reframe, axis=2)
+    elif featurization_type == Featurization.Min:
+        return np.min(reframe, axis=2)
+    elif featurization_type == Featurization.Max:
+        return np.max(reframe, axis=2)